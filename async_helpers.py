@@ -0,0 +1,98 @@
+# asyncio API for the query helpers of filter_data_helpers.py, e.g. for dashboards and notebooks
+# running several queries at the same time.
+# Queries run in a bounded pool of threads, each with its own read-only connection to the database
+# (SQLite releases the GIL while it reads, and in WAL mode, readers do not block each other nor the writer).
+# Cancelling a query (e.g. task.cancel(), or a timeout) interrupts its running SQLite statement.
+#
+# Example:
+#   async with AsyncQueryPool("sample.db", max_connections=8) as pool:
+#       halos = await pool.get_halos_based_on_filters([("M_Crit200", 30, 200)], [])
+#       profiles, subhalos = await gather(
+#           pool.get_profiles(halos["ID"], [], [], ["gas_density"]),
+#           pool.get_subhalos([], halos["ID"], [], [], [], []),
+#       )
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from database_helpers import Database
+import filter_data_helpers
+
+async def gather(*awaitables):
+    """ Run the queries concurrently and return their results in order
+    Unlike asyncio.gather, the other queries are cancelled as soon as one of them fails.
+    """
+    tasks = [asyncio.ensure_future(a) for a in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # Let the cancelled queries interrupt their statements, before e.g. the pool is closed (which waits for them)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class AsyncQueryPool:
+    """ Async versions of the filter_data_helpers functions, on a pool of max_connections read-only connections """
+
+    def __init__(self, database_filename=None, max_connections=4):
+        self.database = Database(database_filename or filter_data_helpers.DATABASE_FILENAME, read_only=True)
+        # Each thread of the executor opens (and keeps) its own connection
+        self._executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="query")
+        self._lock = threading.Lock()
+
+    async def _run(self, function, *args, **kwargs):
+        """ Run function(*args, database=..., **kwargs) in the pool, interrupting it if the calling task is cancelled """
+        # Connection running the query, if it started
+        state = {"connection" : None, "cancelled" : False}
+
+        def run():
+            with self._lock:
+                if state["cancelled"]:
+                    raise asyncio.CancelledError()
+                state["connection"] = self.database.connection
+            try:
+                return function(*args, database=self.database, **kwargs)
+            finally:
+                # So that a late cancellation does not interrupt the next query of this connection
+                with self._lock:
+                    state["connection"] = None
+
+        future = asyncio.get_running_loop().run_in_executor(self._executor, run)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            with self._lock:
+                state["cancelled"] = True
+                if state["connection"] is not None:
+                    state["connection"].interrupt()
+            raise
+
+    async def get_all_simulation_details(self):
+        return await self._run(filter_data_helpers.get_all_simulation_details)
+
+    async def get_halos_based_on_filters(self, list_of_inequality_filters, list_of_equality_filters, columns=None, physical_units=False):
+        return await self._run(filter_data_helpers.get_halos_based_on_filters, list_of_inequality_filters, list_of_equality_filters, columns, physical_units=physical_units)
+
+    async def get_profiles(self, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_properties, packed=False, columns=None, physical_units=False):
+        return await self._run(filter_data_helpers.get_profiles, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_properties, packed, columns, physical_units=physical_units)
+
+    async def get_halo_profiles(self, list_of_inequality_filters, list_of_equality_filters, list_of_properties, halo_columns=None, packed=False, physical_units=False):
+        return await self._run(filter_data_helpers.get_halo_profiles, list_of_inequality_filters, list_of_equality_filters, list_of_properties, halo_columns, packed, physical_units=physical_units)
+
+    async def get_subhalos(self, list_of_subhalo_ids, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_inequality_filters, list_of_equality_filters, columns=None, lazy_arrays=False, physical_units=False):
+        return await self._run(filter_data_helpers.get_subhalos, list_of_subhalo_ids, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_inequality_filters, list_of_equality_filters, columns, lazy_arrays, physical_units=physical_units)
+
+    async def get_mergertree(self, starting_subfind_id, starting_snapshot, simulation_unique_id):
+        return await self._run(filter_data_helpers.get_mergertree, starting_subfind_id, starting_snapshot, simulation_unique_id)
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self.database.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
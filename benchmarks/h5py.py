@@ -0,0 +1,25 @@
+# Local stand-in for h5py, used together with the illustris_python stand-in of this directory
+# Implements h5py.File(name, "r") for the SubLink tree files written by synthetic_data.py,
+# which are .npz archives (with the .hdf5 names of the real files): datasets are read with f[field][start:stop].
+import numpy as np
+
+class File:
+    def __init__(self, name, mode="r"):
+        if mode != "r":
+            raise ValueError("The h5py stand-in only reads files")
+        self._file = np.load(name)
+
+    def __getitem__(self, key):
+        return self._file[key]
+
+    def keys(self):
+        return self._file.files
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,9 @@
+# Local stand-in for illustris_python, reading the synthetic data of benchmarks/synthetic_data.py
+# Implements the calls used by illustris_helpers.py, with the same signatures and return values:
+# - groupcat.loadSubhalos(basePath, snapNum, fields) and groupcat.loadHeader(basePath, snapNum)
+# - sublink.treeOffsets(basePath, snapNum, id, treeName)
+# - sublink.loadTree(basePath, snapNum, id, fields, onlyMPB)
+# - sublink.treePath(basePath, treeName, chunkNum) and sublink.subLinkOffsets(basePath, treeName)
+# It is used instead of the real package when the benchmarks directory comes first in sys.path.
+# The SubLink tree files are read with the h5py stand-in of this directory (see h5py.py).
+from . import groupcat, sublink
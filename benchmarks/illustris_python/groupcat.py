@@ -0,0 +1,26 @@
+import os
+
+import numpy as np
+
+def loadSubhalos(basePath, snapNum, fields=None):
+    """ Subhalo catalog of a snapshot: dict of {field : array} with the number of subhalos in "count",
+    or a single array if only one field is requested (as in illustris_python)
+    """
+    with np.load(os.path.join(basePath, f"groupcat_{snapNum:03d}.npz")) as f:
+        if fields is None:
+            fields = [k for k in f.files if k != "count"]
+        if isinstance(fields, str):
+            fields = [fields]
+
+        result = {"count" : int(f["count"])}
+        for field in fields:
+            result[field] = f[field]
+
+    if len(fields) == 1:
+        return result[fields[0]]
+    return result
+
+def loadHeader(basePath, snapNum):
+    """ Header of the group catalog of a snapshot: dict of {attribute : value} """
+    with np.load(os.path.join(basePath, f"groupcat_header_{snapNum:03d}.npz")) as f:
+        return {k : f[k].item() for k in f.files}
@@ -0,0 +1,80 @@
+import glob
+import os
+
+import numpy as np
+
+import h5py
+
+# The trees of a basepath are split into trees/SubLink/tree_extended.<n>.hdf5 files, as in the
+# simulation outputs. Row numbers (RowNum) are counted across all files.
+# The offsets of the trees are cached per basepath, since treeOffsets is called once per subhalo
+_offsets = {}
+
+def treePath(basePath, treeName, chunkNum=0):
+    """ Path of a SubLink tree file """
+    return os.path.join(basePath, "trees", treeName, f"tree_extended.{chunkNum}.hdf5")
+
+def subLinkOffsets(basePath, treeName, cache=True):
+    """ Row number of the first row of each SubLink tree file """
+    return _load_offsets(basePath, treeName)["file_offsets"]
+
+def _load_offsets(basePath, treeName):
+    if (basePath, treeName) not in _offsets:
+        number_files = len(glob.glob(treePath(basePath, treeName, "*")))
+        columns = {k : [] for k in ["SubhaloID", "SubfindID", "SnapNum", "LastProgenitorID"]}
+        file_offsets = np.zeros(number_files, dtype=np.int64)
+        for i in range(number_files):
+            with h5py.File(treePath(basePath, treeName, i), "r") as f:
+                for k in columns:
+                    columns[k].append(f[k][:])
+            if i + 1 < number_files:
+                file_offsets[i + 1] = file_offsets[i] + len(columns["SubhaloID"][-1])
+
+        offsets = {k : np.concatenate(v) for k, v in columns.items()}
+        offsets["file_offsets"] = file_offsets
+        # Row of each (snapshot, subfind ID)
+        offsets["_keys"] = offsets["SnapNum"] * 2**32 + offsets["SubfindID"]
+        offsets["_order"] = np.argsort(offsets["_keys"])
+        _offsets[(basePath, treeName)] = offsets
+    return _offsets[(basePath, treeName)]
+
+def treeOffsets(basePath, snapNum, id, treeName):
+    """ (RowNum, LastProgenitorID, SubhaloID) of a subhalo in the trees, with RowNum -1 if it is not in the trees """
+    offsets = _load_offsets(basePath, treeName)
+    key = snapNum * 2**32 + id
+    keys = offsets["_keys"][offsets["_order"]]
+    index = np.searchsorted(keys, key)
+    if index == len(keys) or keys[index] != key:
+        return -1, -1, -1
+    row = offsets["_order"][index]
+    return row, offsets["LastProgenitorID"][row], offsets["SubhaloID"][row]
+
+def loadTree(basePath, snapNum, id, fields=None, onlyMPB=False, treeName="SubLink"):
+    """ Tree of a subhalo: dict of {field : array} with the number of rows in "count", or None if the subhalo is not in the trees """
+    row_number, last_progenitor_id, subhalo_id = treeOffsets(basePath, snapNum, id, treeName)
+    if row_number == -1:
+        return None
+
+    # Trees are never split across files
+    file_offsets = subLinkOffsets(basePath, treeName)
+    file_number = np.searchsorted(file_offsets, row_number, side="right") - 1
+    start = row_number - file_offsets[file_number]
+
+    with h5py.File(treePath(basePath, treeName, file_number), "r") as f:
+        if onlyMPB:
+            stop = start + (f["MainLeafProgenitorID"][start] - subhalo_id) + 1
+        else:
+            stop = start + (last_progenitor_id - subhalo_id) + 1
+
+        if fields is None:
+            fields = list(f.keys())
+        if isinstance(fields, str):
+            fields = [fields]
+
+        result = {"count" : int(stop - start)}
+        for field in fields:
+            result[field] = f[field][start:stop]
+
+    if len(fields) == 1:
+        return result[fields[0]]
+    return result
@@ -0,0 +1,278 @@
+# Benchmarks of the ingest scripts and of the filter_data_helpers queries, on synthetic data
+# (see synthetic_data.py), so that they can run on any machine without the CAMELS simulations.
+# 1. Generates the synthetic simulations in the work directory
+# 2. Runs the ingest scripts, each in its own process, with the illustris_python stand-in of this directory,
+#    and reports rows/s, peak RSS (of the script and its worker processes), and the database size after each step
+# 3. Times each filter_data_helpers query with random arguments, and reports p50/p99 latencies
+#
+# Example:
+#   python benchmarks/run_benchmarks.py -w /tmp/benchmark --simulations 4 --halos 2000 -o results.json
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+BENCHMARKS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIRECTORY = os.path.dirname(BENCHMARKS_DIRECTORY)
+sys.path.insert(0, REPOSITORY_DIRECTORY)
+sys.path.insert(0, BENCHMARKS_DIRECTORY)
+
+from synthetic_data import SUITE, generate_simulations, get_simulation_names
+from database_helpers import set_database_filename, get_database, close_database, populate_table, enable_query_tracing
+from illstack_helpers import profile_properties_list
+import filter_data_helpers
+
+TABLES = ["simulations", "halos", "profiles", "profiles_packed", "subhalos", "mergertree"]
+
+# Interval between two samples of the RSS of the ingest processes
+RSS_SAMPLING_SECONDS = 0.05
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+####################
+# Ingest
+
+def get_database_size(database_filename):
+    """ Size in bytes of the database, including its write-ahead log """
+    return sum(os.path.getsize(f) for f in [database_filename, f"{database_filename}-wal"] if os.path.exists(f))
+
+def get_table_counts(database_filename):
+    database = get_database(database_filename)
+    existing_tables = {row["name"] for row in database.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    counts = {
+        table_name : database.execute(f"SELECT COUNT(*) AS count FROM {table_name}")[0]["count"]
+        for table_name in TABLES
+        if table_name in existing_tables
+    }
+    # Closed, so that the ingest processes see a database without other connections
+    close_database(database_filename)
+    return counts
+
+def get_process_tree_rss(pid):
+    """ Sum of the resident set sizes (in bytes) of a process and of all its descendants, read from /proc,
+    or None where /proc is not available
+    """
+    if not os.path.isdir("/proc"):
+        return None
+
+    parent_pids = {}
+    rss = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue # Exited
+        # The command name (2nd field) may contain spaces, so the fields are split after it
+        fields = stat[stat.rindex(")") + 2:].split()
+        parent_pids[int(entry)] = int(fields[1])
+        rss[int(entry)] = int(fields[21]) * PAGE_SIZE
+
+    tree_pids = [pid]
+    for tree_pid in tree_pids:
+        tree_pids.extend(p for p, parent_pid in parent_pids.items() if parent_pid == tree_pid)
+    return sum(rss.get(p, 0) for p in tree_pids)
+
+def run_step(name, arguments, database_filename, new_database=False):
+    """ Run an ingest script in its own process, returning its duration, peak RSS and inserted rows
+    new_database: the script replaces the database (e.g. create_empty_database.py), so all its rows are counted as inserted
+    The RSS of the script and of its worker processes (e.g. the ProcessPoolExecutor of bulk_populate_profiles.py)
+    is summed every RSS_SAMPLING_SECONDS, so peaks shorter than that may be missed.
+    """
+    counts_before = get_table_counts(database_filename) if os.path.exists(database_filename) and not new_database else {}
+
+    # The benchmarks directory comes first, so that illustris_helpers imports the illustris_python stand-in
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join([BENCHMARKS_DIRECTORY, REPOSITORY_DIRECTORY, os.environ.get("PYTHONPATH", "")]))
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable] + arguments, cwd=REPOSITORY_DIRECTORY, env=environment, stdout=subprocess.DEVNULL)
+    peak_tree_rss = 0
+    while True:
+        pid, status, resource_usage = os.wait4(process.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        peak_tree_rss = max(peak_tree_rss, get_process_tree_rss(process.pid) or 0)
+        time.sleep(RSS_SAMPLING_SECONDS)
+    seconds = time.perf_counter() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"{name} failed: {' '.join(arguments)}")
+
+    counts_after = get_table_counts(database_filename)
+    rows = sum(counts_after.values()) - sum(counts_before.values())
+
+    return {
+        "step" : name,
+        "seconds" : seconds,
+        "rows" : rows,
+        "rows_per_second" : rows / seconds,
+        # Largest single process: the script, or any of the worker processes it waited for
+        # (ru_maxrss is in kilobytes on Linux)
+        "peak_process_rss_bytes" : resource_usage.ru_maxrss * 1024,
+        # Whole process tree, sampled; at least the largest single process
+        "peak_rss_bytes" : max(peak_tree_rss, resource_usage.ru_maxrss * 1024),
+        "database_bytes" : get_database_size(database_filename),
+    }
+
+def populate_simulations(database_filename, simulation_names, rng):
+    """ Rows of the simulations table for the synthetic simulations, with random CAMELS parameters """
+    set_database_filename(database_filename)
+    database = get_database(database_filename)
+    rows = [
+        [f"{SUITE}_{name}", SUITE, name, rng.uniform(0.1, 0.5), rng.uniform(0.6, 1.0), rng.uniform(0.25, 4), rng.uniform(0.25, 4), rng.uniform(0.5, 2), rng.uniform(0.5, 2), int(rng.integers(0, 2**20))]
+        for name in simulation_names
+    ]
+    with database.transaction():
+        populate_table("simulations", ["simulation_unique_id", "simulation_suite", "simulation_name", "Omega_m", "sigma_8", "A_SN1", "A_AGN1", "A_SN2", "A_AGN2", "seed"], rows, database=database)
+    close_database(database_filename)
+
+def run_ingest(work_directory, database_filename, profile_filenames, simulation_names, workers, rng):
+    simulations_basepath = os.path.join(work_directory, "simulations")
+    steps = [
+        ("create_empty_database", ["create_empty_database.py", "-f", database_filename, "--profile_filename", profile_filenames[0], "--profile_layout", "both", "--defer_indexes"]),
+        ("bulk_populate_profiles", ["bulk_populate_profiles.py", "-f", database_filename, "--profile_layout", "both", "-j", str(workers)] + profile_filenames),
+        ("build_indexes", ["index_helpers.py", "-f", database_filename, "--build"]),
+        ("bulk_populate_subhalos", ["bulk_populate_subhalos.py", "-f", database_filename, "--basepath", simulations_basepath]),
+        ("bulk_populate_mergertree", ["bulk_populate_mergertree.py", "-f", database_filename, "--basepath", simulations_basepath]),
+    ]
+
+    results = []
+    for name, arguments in steps:
+        results.append(run_step(name, arguments, database_filename, new_database=name == "create_empty_database"))
+        if name == "create_empty_database":
+            populate_simulations(database_filename, simulation_names, rng)
+    return results
+
+
+####################
+# Queries
+
+def get_query_benchmarks(database, rng, number_halos=100):
+    """ Dict of {name : function}, where each call of the function runs a query with new random arguments """
+    halos = filter_data_helpers.get_halos_based_on_filters([], [], columns=["ID", "simulation_unique_id", "snapshot", "M_Crit200"], database=database)
+    mergertree_starts = database.execute("SELECT subfindID, snapshot, simulation_unique_id FROM mergertree WHERE DescendantID = -1")
+    masses = np.sort(halos["M_Crit200"].to_numpy())
+
+    def get_random_halos():
+        simulation_unique_id = rng.choice(halos["simulation_unique_id"].unique())
+        simulation_halos = halos[halos["simulation_unique_id"] == simulation_unique_id]
+        selected = simulation_halos.iloc[rng.choice(len(simulation_halos), min(number_halos, len(simulation_halos)), replace=False)]
+        return selected["ID"].tolist(), [simulation_unique_id], selected["snapshot"].unique().tolist()
+
+    def get_random_filters():
+        # Mass range with about 10% of the halos, in one simulation
+        lower_index = int(rng.integers(0, int(0.9 * len(masses))))
+        inequality_filters = [("M_Crit200", masses[lower_index], masses[lower_index + len(masses) // 10])]
+        equality_filters = [("simulation_unique_id", [rng.choice(halos["simulation_unique_id"].unique())])]
+        return inequality_filters, equality_filters
+
+    def get_random_properties():
+        return list(rng.choice(profile_properties_list, 2, replace=False))
+
+    def consume(iterator):
+        for _ in iterator:
+            pass
+
+    def get_mergertree():
+        start = mergertree_starts[int(rng.integers(0, len(mergertree_starts)))]
+        return filter_data_helpers.get_mergertree(start["subfindID"], start["snapshot"], start["simulation_unique_id"], database=database)
+
+    return {
+        "get_all_simulation_details" : lambda: filter_data_helpers.get_all_simulation_details(database=database),
+        "get_halos_based_on_filters" : lambda: filter_data_helpers.get_halos_based_on_filters(*get_random_filters(), database=database),
+        "iter_halos_based_on_filters" : lambda: consume(filter_data_helpers.iter_halos_based_on_filters(*get_random_filters(), database=database)),
+        "get_profiles" : lambda: filter_data_helpers.get_profiles(*get_random_halos(), get_random_properties(), database=database),
+        "get_profiles(packed)" : lambda: filter_data_helpers.get_profiles(*get_random_halos(), get_random_properties(), packed=True, database=database),
+        "iter_profiles" : lambda: consume(filter_data_helpers.iter_profiles(*get_random_halos(), get_random_properties(), database=database)),
+        "iter_profiles(packed)" : lambda: consume(filter_data_helpers.iter_profiles(*get_random_halos(), get_random_properties(), packed=True, database=database)),
+        "get_halo_profiles" : lambda: filter_data_helpers.get_halo_profiles(*get_random_filters(), get_random_properties(), database=database),
+        "get_halo_profiles(packed)" : lambda: filter_data_helpers.get_halo_profiles(*get_random_filters(), get_random_properties(), packed=True, database=database),
+        "iter_halo_profiles" : lambda: consume(filter_data_helpers.iter_halo_profiles(*get_random_filters(), get_random_properties(), database=database)),
+        "iter_halo_profiles(packed)" : lambda: consume(filter_data_helpers.iter_halo_profiles(*get_random_filters(), get_random_properties(), packed=True, database=database)),
+        "get_subhalos" : lambda: filter_data_helpers.get_subhalos([], *get_random_halos(), [], [], database=database),
+        "get_subhalos(lazy_arrays)" : lambda: filter_data_helpers.get_subhalos([], *get_random_halos(), [], [], lazy_arrays=True, database=database),
+        "iter_subhalos" : lambda: consume(filter_data_helpers.iter_subhalos([], *get_random_halos(), [], [], database=database)),
+        "get_mergertree" : get_mergertree,
+    }
+
+def run_queries(database_filename, repetitions, rng):
+    set_database_filename(database_filename)
+    database = get_database(database_filename)
+
+    results = []
+    for name, function in get_query_benchmarks(database, rng).items():
+        function() # Warm-up: statement cache and page cache
+        seconds = []
+        for _ in range(repetitions):
+            start = time.perf_counter()
+            function()
+            seconds.append(time.perf_counter() - start)
+
+        results.append({
+            "query" : name,
+            "repetitions" : repetitions,
+            "p50_ms" : 1000 * np.percentile(seconds, 50),
+            "p99_ms" : 1000 * np.percentile(seconds, 99),
+        })
+    return results
+
+
+####################
+# Report
+
+def print_results(ingest_results, query_results):
+    if ingest_results:
+        # peak RSS: all processes of the step; process RSS: largest single process
+        print(f"{'step':<28}{'seconds':>10}{'rows':>12}{'rows/s':>12}{'peak RSS (MB)':>16}{'process RSS (MB)':>18}{'database (MB)':>16}")
+        for r in ingest_results:
+            print(f"{r['step']:<28}{r['seconds']:>10.2f}{r['rows']:>12d}{r['rows_per_second']:>12.0f}{r['peak_rss_bytes'] / 2**20:>16.1f}{r['peak_process_rss_bytes'] / 2**20:>18.1f}{r['database_bytes'] / 2**20:>16.1f}")
+        print()
+
+    print(f"{'query':<28}{'p50 (ms)':>12}{'p99 (ms)':>12}")
+    for r in query_results:
+        print(f"{r['query']:<28}{r['p50_ms']:>12.2f}{r['p99_ms']:>12.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--work_directory", help="Directory of the synthetic data and of the benchmark database", default="benchmark_data", type=str)
+    parser.add_argument("-o", "--output_filename", help="Optional JSON file with the results", default=None, type=str)
+    parser.add_argument("--simulations", help="Number of simulations", default=2, type=int)
+    parser.add_argument("--halos", help="Number of halos (with profiles) per simulation", default=1000, type=int)
+    parser.add_argument("--subhalos_per_group", help="Number of subhalos per FoF group", default=3, type=int)
+    parser.add_argument("--tree_depth", help="Maximum number of snapshots of the main branches", default=10, type=int)
+    parser.add_argument("--repetitions", help="Number of timed calls of each query", default=50, type=int)
+    parser.add_argument("-j", "--workers", help="Number of worker processes of bulk_populate_profiles.py", default=os.cpu_count(), type=int)
+    parser.add_argument("--queries_only", help="Skip data generation and ingest, and run the queries on the existing benchmark database", action="store_true")
+    parser.add_argument("--result_cache", help="Enable the result cache of filter_data_helpers (see cache_helpers.py)", action="store_true")
+    parser.add_argument("--trace_filename", help="Optional JSON file with the query trace of the query benchmarks (see database_helpers.QueryTracer)", default=None, type=str)
+    parser.add_argument("--seed", help="Random seed", default=0, type=int)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    work_directory = os.path.abspath(args.work_directory)
+    database_filename = os.path.join(work_directory, "benchmark.db")
+
+    ingest_results = []
+    if not args.queries_only:
+        profile_filenames = generate_simulations(work_directory, args.simulations, args.halos, subhalos_per_group=args.subhalos_per_group, tree_depth=args.tree_depth, seed=args.seed)
+        ingest_results = run_ingest(work_directory, database_filename, profile_filenames, get_simulation_names(args.simulations), args.workers, rng)
+
+    if args.result_cache:
+        filter_data_helpers.enable_result_cache()
+    if args.trace_filename is not None:
+        tracer = enable_query_tracing()
+    query_results = run_queries(database_filename, args.repetitions, rng)
+    if args.trace_filename is not None:
+        tracer.save(args.trace_filename)
+
+    print_results(ingest_results, query_results)
+
+    if args.output_filename is not None:
+        with open(args.output_filename, "w") as f:
+            json.dump({"arguments" : vars(args), "ingest" : ingest_results, "queries" : query_results}, f, indent=4)
@@ -0,0 +1,234 @@
+# Generators of synthetic CAMELS-like data, to run the ingest scripts and the benchmarks without the simulations:
+# - Illstack profile files (.npz), with the same keys and shapes as e.g. IllustrisTNG_1P_22_033.npz
+# - groupcat-like subhalo catalogs, with the fields of illustris_helpers.subhalo_fields, and their headers
+# - SubLink-like merger trees, with depth-first subhalo IDs
+# The catalogs and trees are written to <basepath>/<suite>/<name>/, where they are read by the
+# illustris_python stand-in of this directory (see illustris_python/__init__.py).
+#
+# Example:
+#   python benchmarks/synthetic_data.py -o /tmp/synthetic --simulations 4 --halos 1000
+import argparse
+import os
+import sys
+
+import numpy as np
+
+# The repository (for the helpers), and this directory (for the illustris_python stand-in, imported by illustris_helpers)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from illstack_helpers import global_properties_list, profile_properties_list
+from illustris_helpers import subhalo_fields
+
+SUITE = "IllustrisTNG"
+
+# Vector fields of the subhalo catalogs: field : number of components (other fields are scalars)
+SUBHALO_VECTOR_FIELDS = {
+    "SubhaloCM" : 3, "SubhaloPos" : 3, "SubhaloSpin" : 3, "SubhaloVel" : 3,
+    "SubhaloHalfmassRadType" : 6, "SubhaloLenType" : 6, "SubhaloMassInHalfRadType" : 6, "SubhaloMassInMaxRadType" : 6, "SubhaloMassInRadType" : 6, "SubhaloMassType" : 6,
+    "SubhaloGasMetalFractions" : 10, "SubhaloGasMetalFractionsHalfRad" : 10, "SubhaloGasMetalFractionsMaxRad" : 10, "SubhaloGasMetalFractionsSfr" : 10, "SubhaloGasMetalFractionsSfrWeighted" : 10,
+    "SubhaloStarMetalFractions" : 10, "SubhaloStarMetalFractionsHalfRad" : 10, "SubhaloStarMetalFractionsMaxRad" : 10,
+    "SubhaloStellarPhotometrics" : 8,
+}
+SUBHALO_INTEGER_FIELDS = {"SubhaloGrNr" : np.int32, "SubhaloIDMostbound" : np.uint64, "SubhaloLen" : np.int32, "SubhaloLenType" : np.int32, "SubhaloParent" : np.int32}
+
+BOX_SIZE = 25000.0 # ckpc/h
+
+def get_simulation_names(number_simulations):
+    return [f"LH_{i}" for i in range(number_simulations)]
+
+
+####################
+# Illstack profiles
+
+def make_illstack_profiles(halo_ids, rng, number_radial_bins=25):
+    """ Dict with the keys of an Illstack .npz file, for the given (FoF group) halo IDs """
+    number_halos = len(halo_ids)
+    masses = 10 ** rng.uniform(0, 3, number_halos) # 1e10 Msun/h
+
+    data = {k : rng.lognormal(0, 1, number_halos) for k in global_properties_list}
+    # Counts are stored as float64 in the Illstack files
+    for k in ["GroupFirstSub", "GroupLen", "GroupNsubs"]:
+        data[k] = np.round(100 * data[k])
+    data["ID"] = np.asarray(halo_ids, dtype=np.int64)
+    data["M_Crit200"] = masses
+    data["R_Crit200"] = 100 * masses ** (1 / 3)
+
+    # Radial bins in ckpc/h, and power-law profiles with some scatter and empty bins
+    radius = np.logspace(-1, 4, number_radial_bins)
+    slopes = rng.uniform(-3, -1, (len(profile_properties_list), number_halos, 1))
+    values = masses[None, :, None] * (radius[None, None, :] / 100) ** slopes * rng.lognormal(0, 0.3, (len(profile_properties_list), number_halos, number_radial_bins))
+    values[rng.random(values.shape) < 0.1] = 0
+
+    # As in the Illstack files, "val" and "n" are object arrays
+    data["r"] = radius
+    data["val"] = values.astype(object)
+    data["n"] = rng.poisson(10, values.shape).astype(object)
+    data["nprofs"] = np.array(number_halos)
+    data["nbins"] = np.array(number_radial_bins)
+    return data
+
+def write_illstack_file(directory, simulation_name, snapshot, halo_ids, rng, number_radial_bins=25):
+    filename = os.path.join(directory, f"{SUITE}_{simulation_name}_{snapshot:03d}.npz")
+    np.savez(filename, **make_illstack_profiles(halo_ids, rng, number_radial_bins))
+    return filename
+
+
+####################
+# Subhalo catalogs
+
+def make_subhalo_catalog(number_groups, subhalos_per_group, rng, fields=None):
+    """ Dict with the fields of a groupcat subhalo catalog (as returned by il.groupcat.loadSubhalos),
+    with subhalos_per_group subhalos for each of the number_groups FoF groups
+    """
+    fields = subhalo_fields if fields is None else fields
+    number_subhalos = number_groups * subhalos_per_group
+
+    catalog = {"count" : number_subhalos}
+    for field in fields:
+        shape = (number_subhalos, SUBHALO_VECTOR_FIELDS[field]) if field in SUBHALO_VECTOR_FIELDS else (number_subhalos,)
+        if field in SUBHALO_INTEGER_FIELDS:
+            catalog[field] = rng.integers(0, 1000, shape).astype(SUBHALO_INTEGER_FIELDS[field])
+        else:
+            catalog[field] = rng.lognormal(0, 1, shape).astype(np.float32)
+
+    catalog["SubhaloGrNr"] = np.repeat(np.arange(number_groups, dtype=np.int32), subhalos_per_group)
+    catalog["SubhaloPos"] = rng.uniform(0, BOX_SIZE, (number_subhalos, 3)).astype(np.float32)
+    return catalog
+
+def get_snapshot_redshift(snapshot):
+    # z = 0 for the last CAMELS snapshot (33), and increasing by 0.1 per earlier snapshot
+    return 0.1 * (33 - snapshot)
+
+def make_groupcat_header(snapshot):
+    """ Dict with the attributes of a groupcat header (as returned by il.groupcat.loadHeader) used by illustris_helpers """
+    redshift = get_snapshot_redshift(snapshot)
+    return {"Redshift" : redshift, "Time" : 1 / (1 + redshift), "BoxSize" : BOX_SIZE, "HubbleParam" : 0.6711}
+
+
+####################
+# SubLink trees
+
+def make_sublink_trees(root_snapshot, number_roots, rng, max_depth=10, branching_probability=0.1):
+    """ Dict of SubLink fields (as returned by il.sublink.loadTree), for number_roots trees whose roots are
+    the subfind IDs 0 ... number_roots - 1 of root_snapshot. Rows are in depth-first order, i.e. sorted by SubhaloID.
+    Each node has a main progenitor (until max_depth snapshots before the root, or a random leaf), and
+    with branching_probability a secondary progenitor, which starts a shorter branch.
+    """
+    columns = {k : [] for k in ["SubhaloID", "SubfindID", "SnapNum", "LastProgenitorID", "MainLeafProgenitorID", "RootDescendantID", "TreeID", "FirstProgenitorID", "NextProgenitorID", "DescendantID"]}
+    next_subfind_ids = {root_snapshot : number_roots}
+
+    def add_branch(descendant_row, snapshot, depth, root_id, tree_id, subfind_id=None):
+        # Adds a branch (and its secondary branches) in depth-first order, returning the row of its first node
+        rows = []
+        row = None
+        for d in range(depth):
+            row = len(columns["SubhaloID"])
+            if subfind_id is None or d > 0:
+                subfind_id = next_subfind_ids.get(snapshot - d, 0)
+                next_subfind_ids[snapshot - d] = subfind_id + 1
+            columns["SubhaloID"].append(row)
+            columns["SubfindID"].append(subfind_id)
+            columns["SnapNum"].append(snapshot - d)
+            columns["RootDescendantID"].append(root_id)
+            columns["TreeID"].append(tree_id)
+            columns["DescendantID"].append(descendant_row if d == 0 else row - 1)
+            columns["FirstProgenitorID"].append(-1)
+            columns["NextProgenitorID"].append(-1)
+            columns["LastProgenitorID"].append(row)
+            columns["MainLeafProgenitorID"].append(row)
+            if d > 0:
+                columns["FirstProgenitorID"][rows[-1]] = row
+            rows.append(row)
+
+        # Main leaf of the branch
+        for r in rows:
+            columns["MainLeafProgenitorID"][r] = rows[-1]
+
+        # Secondary progenitors, added after the whole main branch, deepest first, so that the
+        # subtree of each node of the main branch is a contiguous range of rows (depth-first order)
+        for d in range(len(rows) - 1, -1, -1):
+            if d < len(rows) - 1 and rng.random() < branching_probability and snapshot - d - 1 > 0:
+                first = add_branch(rows[d], snapshot - d - 1, int(rng.integers(1, max(2, (depth - d) // 2 + 1))), root_id, tree_id)
+                columns["NextProgenitorID"][rows[d + 1]] = first
+            # Last progenitor: last row of the subtree of the node
+            columns["LastProgenitorID"][rows[d]] = len(columns["SubhaloID"]) - 1
+        return rows[0]
+
+    for root in range(number_roots):
+        root_id = len(columns["SubhaloID"])
+        add_branch(-1, root_snapshot, int(rng.integers(1, max_depth + 1)), root_id, root, subfind_id=root)
+
+    tree = {k : np.asarray(v, dtype=np.int64) for k, v in columns.items()}
+    number_rows = len(tree["SubhaloID"])
+    tree["FirstSubhaloInFOFGroupID"] = tree["SubhaloID"].copy()
+    tree["NextSubhaloInFOFGroupID"] = np.full(number_rows, -1, dtype=np.int64)
+    tree["NumParticles"] = rng.integers(20, 100000, number_rows).astype(np.uint32)
+    tree["Mass"] = rng.lognormal(0, 1, number_rows).astype(np.float32)
+    tree["MassHistory"] = rng.lognormal(0, 1, number_rows).astype(np.float32)
+    tree["count"] = number_rows
+    return tree
+
+
+def write_sublink_tree_files(simulation_directory, tree, number_files):
+    """ Write the trees to number_files trees/SubLink/tree_extended.<n>.hdf5 files, as in the simulation outputs,
+    split between trees (a tree is never split across files). The files are .npz archives read by the h5py stand-in.
+    """
+    tree_directory = os.path.join(simulation_directory, "trees", "SubLink")
+    os.makedirs(tree_directory, exist_ok=True)
+
+    root_rows = np.flatnonzero(tree["RootDescendantID"] == tree["SubhaloID"])
+    file_starts = root_rows[np.linspace(0, len(root_rows), number_files, endpoint=False).astype(np.int64)]
+    file_stops = np.append(file_starts[1:], len(tree["SubhaloID"]))
+
+    for i, (start, stop) in enumerate(zip(file_starts, file_stops)):
+        # Written through a file object, so that np.savez does not add the .npz extension
+        with open(os.path.join(tree_directory, f"tree_extended.{i}.hdf5"), "wb") as f:
+            np.savez(f, **{k : v[start:stop] for k, v in tree.items() if k != "count"})
+
+
+####################
+# Synthetic simulations
+
+def generate_simulations(output_directory, number_simulations=2, halos_per_simulation=1000, groups_per_simulation=None, subhalos_per_group=3, snapshot=33, tree_depth=10, branching_probability=0.1, tree_files=2, number_radial_bins=25, seed=0):
+    """ Write synthetic data for number_simulations simulations:
+    - <output_directory>/profiles/<suite>_<name>_<snapshot>.npz: Illstack profiles of halos_per_simulation FoF groups
+    - <output_directory>/simulations/<suite>/<name>/: subhalo catalog, its header and SubLink trees (the basepath of the illustris_python stand-in)
+    Returns the list of profile filenames.
+    """
+    rng = np.random.default_rng(seed)
+    profiles_directory = os.path.join(output_directory, "profiles")
+    os.makedirs(profiles_directory, exist_ok=True)
+
+    groups_per_simulation = groups_per_simulation or 2 * halos_per_simulation
+
+    profile_filenames = []
+    for simulation_name in get_simulation_names(number_simulations):
+        halo_ids = np.sort(rng.choice(groups_per_simulation, halos_per_simulation, replace=False))
+        profile_filenames.append(write_illstack_file(profiles_directory, simulation_name, snapshot, halo_ids, rng, number_radial_bins))
+
+        simulation_directory = os.path.join(output_directory, "simulations", SUITE, simulation_name)
+        os.makedirs(simulation_directory, exist_ok=True)
+
+        catalog = make_subhalo_catalog(groups_per_simulation, subhalos_per_group, rng)
+        np.savez(os.path.join(simulation_directory, f"groupcat_{snapshot:03d}.npz"), **catalog)
+        np.savez(os.path.join(simulation_directory, f"groupcat_header_{snapshot:03d}.npz"), **make_groupcat_header(snapshot))
+
+        tree = make_sublink_trees(snapshot, catalog["count"], rng, max_depth=tree_depth, branching_probability=branching_probability)
+        write_sublink_tree_files(simulation_directory, tree, tree_files)
+
+    return profile_filenames
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output_directory", help="Directory of the synthetic data", default="synthetic", type=str)
+    parser.add_argument("--simulations", help="Number of simulations", default=2, type=int)
+    parser.add_argument("--halos", help="Number of halos (with profiles) per simulation", default=1000, type=int)
+    parser.add_argument("--subhalos_per_group", help="Number of subhalos per FoF group", default=3, type=int)
+    parser.add_argument("--snapshot", help="Snapshot", default=33, type=int)
+    parser.add_argument("--tree_depth", help="Maximum number of snapshots of the main branches", default=10, type=int)
+    parser.add_argument("--seed", help="Random seed", default=0, type=int)
+    args = parser.parse_args()
+
+    profile_filenames = generate_simulations(args.output_directory, args.simulations, args.halos, subhalos_per_group=args.subhalos_per_group, snapshot=args.snapshot, tree_depth=args.tree_depth, seed=args.seed)
+    print(f"Wrote {len(profile_filenames)} simulations to {args.output_directory}")
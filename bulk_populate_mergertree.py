@@ -1,13 +1,72 @@
-import os
-import subprocess
+# Populate the mergertree table for many subhalos at once.
+# For each simulation, the SubLink offsets of all target subhalos are read first.
+# Targets whose depth-first ID range lies inside the range of another target (or of a tree
+# already in the database) are part of that tree, so each tree is loaded and inserted only once.
+# The trees are then read from the SubLink files once per file, and sliced by their row ranges.
+# By default, the targets are all subhalos of the "subhalos" table.
+import argparse
+import numpy as np
+import pandas as pd
 
-filenames = os.listdir()
+from database_helpers import set_database_filename, execute_query, get_database, populate_table
+from query_helpers import Query
+from illustris_helpers import mergertree_columns, get_simulation_basepath, iter_trees, get_mergertree_rows, get_tree_ranges, get_root_trees
 
-for filename in filenames:
-    if not filename.endswith(".npz"):
-        continue
+def get_stored_subhalo_ids(simulation_unique_id, subhalo_ids, database=None):
+    """ Subset of the (mergertree) subhaloIDs that are already in the mergertree table """
+    subhalo_ids = [int(i) for i in subhalo_ids]
+    if len(subhalo_ids) == 0:
+        return set()
 
-    command = f"""python3 populate_profile_data.py -f "sample.db" --profile_filename "{filename}" """
-    cmd = subprocess.run(command, shell=True)
-    print(cmd)
+    query = Query("mergertree", ["subhaloID"])
+    query.where_equal("simulation_unique_id", simulation_unique_id)
+    query.where_in("subhaloID", subhalo_ids)
 
+    return {row["subhaloID"] for row in query.execute(database=database)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--database_filename", help="Database filename to be populated", default="sample.db", type=str)
+    parser.add_argument("--basepath", help="Absolute basepath to the CAMELS output files, used by illustris_python (e.g. '/home/jovyan/Simulations/')", default="/home/jovyan/Simulations/", type=str)
+    parser.add_argument("--targets_filename", help="Optional CSV file with columns simulation_unique_id, snapshot, subfindID listing the subhalos whose trees should be loaded. Defaults to all subhalos of the subhalos table", default=None, type=str)
+    args = parser.parse_args()
+
+    set_database_filename(args.database_filename)
+    database = get_database()
+
+    if args.targets_filename is not None:
+        targets = pd.read_csv(args.targets_filename)
+    else:
+        query = """
+        SELECT
+        DISTINCT simulation_unique_id, snapshot, subhaloID AS subfindID
+        FROM subhalos
+        """
+        targets = pd.DataFrame(execute_query(query), columns=["simulation_unique_id", "snapshot", "subfindID"])
+
+    for simulation_unique_id, simulation_targets in targets.groupby("simulation_unique_id"):
+        simulation_details = simulation_unique_id.split("_")
+        simulation_suite = simulation_details[0]
+        simulation_name = f"{simulation_details[1]}_{simulation_details[2]}"
+        basepath = get_simulation_basepath(args.basepath, simulation_suite, simulation_name)
+
+        snapshots = simulation_targets["snapshot"].to_numpy()
+        subfind_ids = simulation_targets["subfindID"].to_numpy()
+
+        # Keep only the targets that are not part of another target's tree
+        tree_subhalo_ids, tree_last_progenitor_ids, tree_row_numbers = get_tree_ranges(basepath, snapshots, subfind_ids)
+        roots = get_root_trees(tree_subhalo_ids, tree_last_progenitor_ids)
+
+        # Skip trees already in the database (trees are always inserted whole)
+        stored_subhalo_ids = get_stored_subhalo_ids(simulation_unique_id, tree_subhalo_ids[roots], database=database)
+        roots = np.array([i for i in roots if tree_subhalo_ids[i] not in stored_subhalo_ids], dtype=np.int64)
+
+        number_rows = 0
+        with database.transaction():
+            for _, tree in iter_trees(basepath, tree_subhalo_ids[roots], tree_last_progenitor_ids[roots], tree_row_numbers[roots]):
+                rows = get_mergertree_rows(tree, simulation_unique_id)
+                populate_table("mergertree", mergertree_columns, rows)
+                number_rows += len(rows)
+
+        print(f"{simulation_unique_id}: {len(simulation_targets)} targets, {len(roots)} trees loaded, {number_rows} rows")
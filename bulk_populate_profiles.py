@@ -1,13 +1,142 @@
+# Populate the halos and profiles tables from many Illstack .npz files.
+# The .npz files are parsed in a pool of worker processes, which return the loaded NumPy arrays.
+# The batches of rows are built from them and written by this (single) process in large transactions.
+# Files already ingested are recorded in the ingest_manifest table (see manifest_helpers.py):
+# only new or changed files are parsed, and the rows of changed files are replaced atomically.
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import glob
 import os
-import subprocess
 
-filenames = os.listdir()
+from database_helpers import set_database_filename, get_database, execute_query, populate_table
+from illstack_helpers import load_illstack_file, iter_illstack_table_batches_from_arrays, get_simulation_details_from_profile_filename
+from index_helpers import create_indexes, drop_indexes, get_existing_tables
+from manifest_helpers import create_manifest_table, get_changed_files, get_content_hash, get_file_stat, record_ingest
 
-for filename in filenames:
-    if not filename.endswith(".npz"):
-        continue
+MANIFEST_LOADER = "profiles"
 
-    command = f"""python3 populate_profile_data.py -f "sample.db" --profile_filename "{filename}" """
-    cmd = subprocess.run(command, shell=True)
-    print(cmd)
+def find_profile_files(paths):
+    """ Expand a list of .npz files, directories and glob patterns into a sorted list of .npz files """
+    filenames = set()
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.update(glob.glob(os.path.join(path, "*.npz")))
+        elif glob.has_magic(path):
+            filenames.update(f for f in glob.glob(path, recursive=True) if f.endswith(".npz"))
+        elif os.path.isfile(path):
+            filenames.add(path)
+        else:
+            print(f"Skipping {path}: no such file or directory")
 
+    return sorted(filenames)
+
+def load_profile_file(profile_filename, cache_directory=None):
+    # Executed in the worker processes
+    # The file is identified before parsing, so that changes during parsing are detected by the next run
+    file_stat = get_file_stat(profile_filename)
+    content_hash = get_content_hash(profile_filename)
+    # Only the arrays are sent back to the writer: they are pickled as raw buffers, and are much
+    # smaller than the rows built from them
+    return profile_filename, (file_stat, content_hash), load_illstack_file(profile_filename, cache_directory, content_hash)
+
+def delete_profile_file_rows(simulation_unique_id, snapshot, existing_tables, database=None):
+    """ Delete the rows previously ingested from the file of a (simulation, snapshot) """
+    # The profiles are selected by the IDs of the halos, so that the UNIQUE (ID, ...) indexes are used
+    # even when the secondary indexes are deferred
+    for table_name in ["profiles", "profiles_packed"]:
+        if table_name in existing_tables:
+            execute_query(f"""
+            DELETE FROM {table_name}
+            WHERE ID IN (SELECT ID FROM halos WHERE snapshot = ? AND simulation_unique_id = ?)
+            AND simulation_unique_id = ? AND snapshot = ?
+            """, (snapshot, simulation_unique_id, simulation_unique_id, snapshot), database=database)
+
+    execute_query("DELETE FROM halos WHERE snapshot = ? AND simulation_unique_id = ?", (snapshot, simulation_unique_id), database=database)
+
+def iter_loaded_profile_files(profile_filenames, workers, cache_directory=None):
+    """ Yield (profile_filename, ((source_path, size, mtime_ns), content_hash), illstack arrays) as files are parsed
+    The illstack arrays are (global_properties_dict, radial_bins, profile_properties_dict), see illstack_helpers.load_illstack_file.
+    At most 2 * workers files are parsed ahead of the writer, to bound memory usage.
+    """
+    if workers <= 1:
+        for profile_filename in profile_filenames:
+            yield load_profile_file(profile_filename, cache_directory)
+        return
+
+    pending_filenames = iter(profile_filenames)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = set()
+        for profile_filename in pending_filenames:
+            futures.add(executor.submit(load_profile_file, profile_filename, cache_directory))
+            if len(futures) >= 2 * workers:
+                break
+
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+                for profile_filename in pending_filenames:
+                    futures.add(executor.submit(load_profile_file, profile_filename, cache_directory))
+                    break
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", help=".npz files, directories containing .npz files, or glob patterns (e.g. 'profiles/IllustrisTNG_LH_*_033.npz'). Defaults to the current directory", nargs="*", default=["."])
+    parser.add_argument("-f", "--database_filename", help="Database filename to be populated", default="sample.db", type=str)
+    parser.add_argument("-j", "--workers", help="Number of worker processes parsing .npz files", default=os.cpu_count(), type=int)
+    parser.add_argument("--profile_layout", help="Storage layout of the radial profiles, see create_empty_database.py", default="rows", choices=["rows", "packed", "both"], type=str)
+    parser.add_argument("--batch_size", help="Number of rows inserted per executemany batch", default=100000, type=int)
+    parser.add_argument("--files_per_transaction", help="Number of .npz files written per transaction", default=50, type=int)
+    parser.add_argument("--defer_indexes", help="Drop the secondary indexes before loading, and build them once at the end", action="store_true")
+    parser.add_argument("--npz_cache", help="Optional directory where the arrays loaded from the .npz files are cached as uncompressed .npy files, which are memory-mapped when a file is ingested again (see illstack_helpers.load_illstack_arrays)", default=None, type=str)
+    parser.add_argument("--force", help="Ingest all files again, even if they are unchanged since they were last ingested", action="store_true")
+
+    args = parser.parse_args()
+
+    set_database_filename(args.database_filename)
+    database = get_database()
+
+    create_manifest_table(database=database)
+    existing_tables = get_existing_tables(database=database)
+
+    profile_filenames = find_profile_files(args.paths)
+    number_found_files = len(profile_filenames)
+    if not args.force:
+        profile_filenames = get_changed_files(MANIFEST_LOADER, profile_filenames, database=database)
+    print(f"Populating {args.database_filename} from {len(profile_filenames)} new or changed files (of {number_found_files}) with {args.workers} workers")
+
+    # Indexes are only rebuilt when there is something to load
+    defer_indexes = args.defer_indexes and len(profile_filenames) != 0
+    if defer_indexes:
+        drop_indexes(database=database)
+
+    loaded_files = iter_loaded_profile_files(profile_filenames, args.workers, args.npz_cache)
+
+    number_files = 0
+    while number_files < len(profile_filenames):
+        with database.transaction():
+            for profile_filename, ((source_path, size, mtime_ns), content_hash), illstack_arrays in loaded_files:
+                _, _, snapshot, simulation_unique_id = get_simulation_details_from_profile_filename(profile_filename)
+
+                # Replace the rows of a previous version of the file, in the same transaction
+                delete_profile_file_rows(simulation_unique_id, snapshot, existing_tables, database=database)
+
+                row_counts = defaultdict(int)
+                for table_name, columns, rows in iter_illstack_table_batches_from_arrays(profile_filename, illstack_arrays, args.profile_layout, batch_size=args.batch_size):
+                    populate_table(table_name, columns, rows)
+                    row_counts[table_name] += len(rows)
+
+                record_ingest(MANIFEST_LOADER, source_path, content_hash, row_counts, simulation_unique_id, snapshot, size, mtime_ns, database=database)
+
+                number_files += 1
+                print(f"[{number_files}/{len(profile_filenames)}] {profile_filename}")
+
+                if number_files % args.files_per_transaction == 0:
+                    break
+            else:
+                break
+
+    if defer_indexes:
+        create_indexes(database=database)
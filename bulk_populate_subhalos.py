@@ -1,32 +1,84 @@
 # The first step is to populate the "halos" table.
 # Then, we load all subhalos belonging to the stored FoF halos,
-# and populate the :subhalos" table accordingly.
+# and populate the "subhalos" table accordingly.
+# The subhalo catalog of each (simulation, snapshot) is loaded only once, and the
+# subhalos of all its stored halos are inserted in a single transaction.
+# Each (simulation, snapshot) is recorded in the ingest_manifest table (see manifest_helpers.py) with
+# a hash of its halo IDs: it is skipped if its halos did not change since it was last loaded, and
+# its subhalos are replaced atomically otherwise.
+# If the database has a spatial index (see spatial_helpers.py), it is updated in the same transaction.
+# The redshift of each snapshot, from the header of its group catalog, is stored in the snapshots table
+# (used for the conversions to physical units, see units_helpers.py).
+import argparse
+import hashlib
 
-from database_helpers import execute_query
-import pandas as pd
-import subprocess
+import numpy as np
 
-BASEPATH = "/home/jovyan/Simulations/"
+from database_helpers import set_database_filename, execute_query, get_database, populate_table
+from illustris_helpers import subhalos_columns, get_simulation_basepath, load_subhalos, load_redshift, get_subhalo_rows, get_subhalo_ids_by_halo
+from manifest_helpers import create_manifest_table, is_unchanged_source, record_ingest
+from spatial_helpers import has_spatial_index, update_spatial_index
+from units_helpers import create_snapshots_table, store_snapshot_redshift
+
+MANIFEST_LOADER = "subhalos"
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-f", "--database_filename", help="Database filename to be populated", default="sample.db", type=str)
+parser.add_argument("--basepath", help="Absolute basepath to the CAMELS output files, used by illustris_python (e.g. '/home/jovyan/Simulations/')", default="/home/jovyan/Simulations/", type=str)
+parser.add_argument("--force", help="Load all snapshots again, even if their halos are unchanged since they were last loaded", action="store_true")
+args = parser.parse_args()
+
+set_database_filename(args.database_filename)
+database = get_database()
+create_manifest_table(database=database)
+create_snapshots_table(database=database)
+spatial_index = has_spatial_index(database=database)
 
 # Determine all unique (simulation, snapshot, halo_id) combinations from the "halos" table.
 query = """
 SELECT
 DISTINCT snapshot, simulation_unique_id, ID
 FROM halos
+ORDER BY simulation_unique_id, snapshot
 """
 
 data = execute_query(query)
-halos = pd.DataFrame(data)
-for _, halo in halos.iterrows():
-    snapshot = halo["snapshot"]
-    halo_id = halo['ID']
-    simulation_unique_id = halo["simulation_unique_id"]
+
+# Group halo IDs by (simulation, snapshot)
+halo_ids_by_snapshot = {}
+for row in data:
+    halo_ids_by_snapshot.setdefault((row["simulation_unique_id"], row["snapshot"]), []).append(row["ID"])
+
+for (simulation_unique_id, snapshot), halo_ids in halo_ids_by_snapshot.items():
     simulation_details = simulation_unique_id.split("_")
     simulation_suite = simulation_details[0]
     simulation_name = f"{simulation_details[1]}_{simulation_details[2]}"
+    basepath = get_simulation_basepath(args.basepath, simulation_suite, simulation_name)
+
+    # Also stored for unchanged snapshots, which may have been loaded before the snapshots table existed
+    store_snapshot_redshift(simulation_unique_id, snapshot, load_redshift(basepath, snapshot), database=database)
+
+    # The source is the group catalog of the snapshot, and its inputs are the stored halos
+    source_path = f"{basepath}groups_{snapshot:03d}"
+    content_hash = hashlib.sha256(np.sort(np.asarray(halo_ids, dtype=np.int64)).tobytes()).hexdigest()
+    if not args.force and is_unchanged_source(MANIFEST_LOADER, source_path, content_hash, database=database):
+        print(f"{simulation_unique_id} snapshot {snapshot}: unchanged, skipped")
+        continue
+
+    # Load the catalog once, and select the subhalos of all requested halos
+    subhalos = load_subhalos(basepath, snapshot)
+    subhalo_ids = get_subhalo_ids_by_halo(subhalos["SubhaloGrNr"], halo_ids)
 
-    command = f"""python3 populate_subhalos.py -f "sample.db" --snapshot {snapshot} --halo_id {halo_id} --simulation_suite {simulation_suite} --simulation_name {simulation_name} --basepath {BASEPATH}"""
-    print(command)
+    with database.transaction():
+        # Replace the subhalos of a previous load
+        execute_query("DELETE FROM subhalos WHERE simulation_unique_id = ? AND snapshot = ?", (simulation_unique_id, snapshot))
+        populate_table(
+            "subhalos",
+            subhalos_columns,
+            get_subhalo_rows(subhalos, subhalo_ids, simulation_unique_id, snapshot),
+        )
+        if spatial_index:
+            update_spatial_index(simulation_unique_id, snapshot, database=database)
+        record_ingest(MANIFEST_LOADER, source_path, content_hash, {"subhalos" : len(subhalo_ids)}, simulation_unique_id, snapshot, database=database)
 
-    cmd = subprocess.run(command, shell=True)
-    print(cmd)
+    print(f"{simulation_unique_id} snapshot {snapshot}: {len(subhalo_ids)} subhalos of {len(halo_ids)} halos")
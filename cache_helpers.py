@@ -0,0 +1,164 @@
+# Result cache for the query helpers of filter_data_helpers.py
+# Results are keyed on the database file and the normalized query with its bound
+# parameters (query_helpers.Query.cache_key). Each entry stores the version of the
+# database when it was computed, and is discarded as soon as the database changes:
+# - in memory, the version is Database.get_data_version() (PRAGMA data_version and the file version)
+# - on disk, the version is Database.get_file_version(), which is also valid across processes
+# The memory tier has a budget in bytes, and evicts the least recently used entries first.
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+import threading
+
+import numpy as np
+import pandas as pd
+
+def get_result_size(result):
+    """ Approximate memory footprint of a cached result, in bytes """
+    if isinstance(result, pd.DataFrame):
+        return int(result.memory_usage(index=True, deep=True).sum())
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if isinstance(result, (tuple, list)):
+        return sum(get_result_size(r) for r in result)
+    if isinstance(result, dict):
+        # e.g. the {property : profiles} of get_halo_profiles
+        return sum(get_result_size(r) for r in result.values())
+    return 0
+
+def copy_result(result):
+    """ Copy of a cached result, so that callers can modify it without changing the cache """
+    if isinstance(result, (pd.DataFrame, np.ndarray)):
+        return result.copy()
+    if isinstance(result, tuple):
+        return tuple(copy_result(r) for r in result)
+    if isinstance(result, list):
+        return [copy_result(r) for r in result]
+    if isinstance(result, dict):
+        return {k : copy_result(r) for k, r in result.items()}
+    return result
+
+
+class ResultCache:
+    """ LRU cache of query results, with an optional on-disk tier
+    Example:
+        cache = ResultCache(max_memory_bytes=2**30, cache_directory="query_cache")
+        result = cache.get_or_compute(database, query.cache_key, lambda: query.execute(database=database))
+    """
+
+    def __init__(self, max_memory_bytes=512 * 2**20, cache_directory=None, copy_results=True):
+        """ copy_results: return copies of the cached results, so that callers can modify them.
+        Without copies, cache hits are faster, but the returned results must not be modified.
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.copy_results = copy_results
+        self.cache_directory = cache_directory
+        if cache_directory is not None:
+            os.makedirs(cache_directory, exist_ok=True)
+
+        self._entries = OrderedDict() # key : (data version, result, size)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _get_disk_filename(self, key):
+        return os.path.join(self.cache_directory, hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".pkl")
+
+    def get_or_compute(self, database, key, compute):
+        """ Cached result for the key, or the result of compute(), which is then cached """
+        # Writes inside an open transaction are not visible to the version tokens
+        if database.in_transaction:
+            return compute()
+
+        key = (os.path.abspath(database.filename), key)
+        # The versions are read before computing the result, so that a change of the
+        # database during the computation invalidates the new entry
+        data_version = database.get_data_version()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] == data_version:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return copy_result(entry[1]) if self.copy_results else entry[1]
+                self._pop(key)
+
+        result = self._get_from_disk(database, key)
+        if result is not None:
+            self._set_in_memory(key, data_version, result)
+            with self._lock:
+                self.hits += 1
+            return copy_result(result) if self.copy_results else result
+
+        with self._lock:
+            self.misses += 1
+
+        file_version = database.get_file_version()
+        result = compute()
+        self._set_in_memory(key, data_version, copy_result(result) if self.copy_results else result)
+
+        if self.cache_directory is not None:
+            # Written to a temporary file first, so that other processes never read partial files
+            filename = self._get_disk_filename(key)
+            with open(f"{filename}.tmp{os.getpid()}", "wb") as f:
+                pickle.dump((key, file_version, result), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f"{filename}.tmp{os.getpid()}", filename)
+
+        return result
+
+    def _get_from_disk(self, database, key):
+        if self.cache_directory is None:
+            return None
+
+        filename = self._get_disk_filename(key)
+        try:
+            with open(filename, "rb") as f:
+                stored_key, file_version, result = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+        if stored_key != key or file_version != database.get_file_version():
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            return None
+        return result
+
+    def _set_in_memory(self, key, data_version, result):
+        size = get_result_size(result)
+        if size > self.max_memory_bytes:
+            return
+
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (data_version, result, size)
+            self._memory_bytes += size
+
+            # Evict the least recently used entries
+            while self._memory_bytes > self.max_memory_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._memory_bytes -= entry[2]
+
+    @property
+    def memory_bytes(self):
+        return self._memory_bytes
+
+    def clear(self):
+        """ Remove all entries, from memory and from disk """
+        with self._lock:
+            self._entries = OrderedDict()
+            self._memory_bytes = 0
+
+        if self.cache_directory is not None:
+            for filename in os.listdir(self.cache_directory):
+                if filename.endswith(".pkl"):
+                    os.remove(os.path.join(self.cache_directory, filename))
@@ -0,0 +1,376 @@
+# Read-only columnar replica of the database, as a directory of .npy files
+# Each column of the simulations, halos and subhalos tables is stored as one .npy file, and the
+# profiles are stored as dense cubes aligned with the rows of the halos table:
+# - profiles/values.npy: (halos, properties, radial bins), NaN for missing values
+# - profiles/radius.npy: (halos, radial bins)
+# A manifest.json file describes the tables, columns and dtypes.
+# TEXT columns are dictionary encoded: <column>.npy holds int32 codes into the "categories" of the manifest.
+#
+# The files are opened with np.load(mmap_mode="r"), so queries read the data without any decoding,
+# and processes reading the same replica share one copy of it in the page cache.
+#
+# Export:
+#   python columnar_replica.py -f sample.db -o sample_replica
+# Read (same interface as filter_data_helpers.py):
+#   replica = ColumnarReplica("sample_replica")
+#   halos = replica.get_halos_based_on_filters([("M_Crit200", 30, 200)], [("simulation_unique_id", ["IllustrisTNG_1P_22"])])
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from database_helpers import set_database_filename, get_database, execute_query, iter_query
+from filter_data_helpers import iter_halo_profiles
+from index_helpers import get_existing_tables
+from query_helpers import check_identifier
+from units_helpers import SNAPSHOTS_TABLE, to_physical_units, profiles_to_physical_units
+
+MANIFEST_FILENAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+# table name : columns defining the order of the rows of the replica
+REPLICA_TABLES = {
+    "simulations" : ["simulation_unique_id"],
+    "halos" : ["simulation_unique_id", "snapshot", "ID"],
+    "subhalos" : ["simulation_unique_id", "snapshot", "subhaloID"],
+    # Redshifts, for physical_units=True
+    "snapshots" : ["simulation_unique_id", "snapshot"],
+}
+
+
+####################
+# Export
+
+def _get_column_layouts(table_name, database=None):
+    """ {column name : (kind, dtype, shape of each value)} for the columns of a table
+    kind is "number", "text" or "array". INTEGER columns with NULL values are stored as float64, with NaN.
+    """
+    column_types = database.get_column_types(table_name)
+    null_counts = execute_query(
+        f"SELECT {', '.join(f'SUM({c} IS NULL) AS {c}' for c in column_types)} FROM {table_name}",
+        database=database,
+    )
+    null_counts = null_counts[0] if len(null_counts) != 0 else {}
+
+    layouts = {}
+    for column_name, column_type in column_types.items():
+        if column_type == "ARRAY":
+            first_values = execute_query(f"SELECT {column_name} FROM {table_name} WHERE {column_name} IS NOT NULL LIMIT 1", database=database)
+            if len(first_values) == 0:
+                continue
+            value = first_values[0][column_name]
+            layouts[column_name] = ("array", value.dtype, value.shape)
+        elif column_type == "TEXT":
+            layouts[column_name] = ("text", np.dtype(np.int32), ())
+        elif column_type == "INTEGER" and not null_counts.get(column_name):
+            layouts[column_name] = ("number", np.dtype(np.int64), ())
+        else:
+            layouts[column_name] = ("number", np.dtype(np.float64), ())
+    return layouts
+
+def export_table(table_name, directory, chunk_size=100000, database=None):
+    """ Write each column of a table to <directory>/<table name>/<column>.npy, returning its manifest entry """
+    database = database or get_database()
+    table_directory = os.path.join(directory, table_name)
+    os.makedirs(table_directory, exist_ok=True)
+
+    number_rows = execute_query(f"SELECT COUNT(*) AS n FROM {table_name}", database=database)[0]["n"]
+    layouts = _get_column_layouts(table_name, database=database)
+
+    arrays = {
+        column_name : np.lib.format.open_memmap(os.path.join(table_directory, f"{column_name}.npy"), mode="w+", dtype=dtype, shape=(number_rows,) + shape)
+        for column_name, (kind, dtype, shape) in layouts.items()
+    }
+    categories = {column_name : {} for column_name, (kind, _, _) in layouts.items() if kind == "text"}
+    skipped_columns = set()
+
+    query = f"""
+    SELECT {', '.join(layouts.keys())}
+    FROM {table_name}
+    ORDER BY {', '.join(REPLICA_TABLES[table_name])}
+    """
+    start = 0
+    for columns, rows in iter_query(query, chunk_size=chunk_size, database=database):
+        stop = start + len(rows)
+        for i, column_name in enumerate(columns):
+            kind, dtype, shape = layouts[column_name]
+            values = [row[i] for row in rows]
+
+            if kind == "text":
+                # Codes are assigned in order of appearance, i.e. in sorted order for the ordering columns
+                codes = categories[column_name]
+                arrays[column_name][start:stop] = [-1 if v is None else codes.setdefault(v, len(codes)) for v in values]
+            elif kind == "array":
+                if column_name in skipped_columns:
+                    continue
+                if any(v is not None and v.shape != shape for v in values):
+                    print(f"Skipping {table_name}.{column_name}: values with different shapes")
+                    skipped_columns.add(column_name)
+                    continue
+                fill_value = np.full(shape, np.nan if dtype.kind == "f" else 0, dtype=dtype)
+                arrays[column_name][start:stop] = np.stack([fill_value if v is None else v for v in values]) if len(values) != 0 else values
+            else:
+                arrays[column_name][start:stop] = np.array([np.nan if v is None else v for v in values], dtype=dtype)
+        start = stop
+
+    manifest_columns = {}
+    for column_name, (kind, dtype, shape) in layouts.items():
+        arrays[column_name].flush()
+        if column_name in skipped_columns:
+            os.remove(os.path.join(table_directory, f"{column_name}.npy"))
+            continue
+        manifest_columns[column_name] = {"kind" : kind, "dtype" : dtype.str, "shape" : list(shape)}
+        if kind == "text":
+            manifest_columns[column_name]["categories"] = list(categories[column_name].keys())
+
+    return {"number_rows" : number_rows, "order_by" : REPLICA_TABLES[table_name], "columns" : manifest_columns}
+
+def _get_halo_keys(simulation_codes, snapshots, halo_ids):
+    # Single int64 key per halo, increasing in the (simulation_unique_id, snapshot, ID) order of the replica
+    return (np.asarray(simulation_codes, dtype=np.int64) * 1024 + np.asarray(snapshots, dtype=np.int64)) * 2**32 + np.asarray(halo_ids, dtype=np.int64)
+
+def export_profiles(directory, halos_manifest, packed=False, chunk_size=10000, database=None):
+    """ Write the profiles as dense cubes aligned with the exported halos, returning the manifest entry """
+    database = database or get_database()
+    profiles_directory = os.path.join(directory, "profiles")
+    os.makedirs(profiles_directory, exist_ok=True)
+
+    # Dimensions of the cubes
+    if packed:
+        property_keys, number_radial_bins = [], 0
+        for _, rows in iter_query("SELECT property_keys, radius FROM profiles_packed", chunk_size=chunk_size, database=database):
+            for keys, radius in rows:
+                property_keys.extend(k for k in keys.split(",") if k not in property_keys)
+                number_radial_bins = max(number_radial_bins, len(radius))
+    else:
+        property_keys = [row["property_key"] for row in execute_query("SELECT DISTINCT property_key FROM profiles ORDER BY property_key", database=database)]
+        number_radial_bins = execute_query("""
+        SELECT MAX(n) AS n FROM (
+            SELECT COUNT(*) AS n FROM profiles GROUP BY ID, simulation_unique_id, snapshot, property_key
+        )
+        """, database=database)[0]["n"] or 0
+
+    number_halos = halos_manifest["number_rows"]
+    values = np.lib.format.open_memmap(os.path.join(profiles_directory, "values.npy"), mode="w+", dtype=np.float64, shape=(number_halos, len(property_keys), number_radial_bins))
+    radius = np.lib.format.open_memmap(os.path.join(profiles_directory, "radius.npy"), mode="w+", dtype=np.float64, shape=(number_halos, number_radial_bins))
+    values[:] = np.nan
+    radius[:] = np.nan
+
+    # Row of each profile in the exported halos
+    simulation_categories = halos_manifest["columns"]["simulation_unique_id"]["categories"]
+    simulation_codes = {s : i for i, s in enumerate(simulation_categories)}
+    halo_keys = _get_halo_keys(
+        np.load(os.path.join(directory, "halos", "simulation_unique_id.npy"), mmap_mode="r"),
+        np.load(os.path.join(directory, "halos", "snapshot.npy"), mmap_mode="r"),
+        np.load(os.path.join(directory, "halos", "ID.npy"), mmap_mode="r"),
+    )
+
+    for halos, radii, profiles in iter_halo_profiles([], [], [], halo_columns=[], packed=packed, chunk_size=chunk_size, database=database):
+        if len(halos) == 0:
+            continue
+        keys = _get_halo_keys([simulation_codes[s] for s in halos["simulation_unique_id"]], halos["snapshot"], halos["ID"])
+        rows = np.searchsorted(halo_keys, keys)
+
+        radius[rows, :radii.shape[1]] = radii
+        for property_key, property_values in profiles.items():
+            values[rows, property_keys.index(property_key), :property_values.shape[1]] = property_values
+
+    values.flush()
+    radius.flush()
+    return {"property_keys" : property_keys, "number_radial_bins" : number_radial_bins, "layout" : "packed" if packed else "rows"}
+
+def export_replica(directory, chunk_size=100000, database=None):
+    """ Export the simulations, halos, subhalos and profiles tables to a columnar replica in directory """
+    database = database or get_database()
+    os.makedirs(directory, exist_ok=True)
+    existing_tables = get_existing_tables(database=database)
+
+    manifest = {"version" : MANIFEST_VERSION, "database_filename" : os.path.abspath(database.filename), "tables" : {}}
+    for table_name in REPLICA_TABLES:
+        if table_name not in existing_tables:
+            continue
+        print(f"Exporting {table_name}")
+        manifest["tables"][table_name] = export_table(table_name, directory, chunk_size=chunk_size, database=database)
+
+    profile_tables = [t for t in ["profiles_packed", "profiles"] if t in existing_tables]
+    if "halos" in manifest["tables"] and len(profile_tables) != 0:
+        print(f"Exporting {profile_tables[0]}")
+        manifest["profiles"] = export_profiles(directory, manifest["tables"]["halos"], packed=profile_tables[0] == "profiles_packed", database=database)
+
+    # The manifest is written last, so that incomplete replicas are never read
+    with open(os.path.join(directory, MANIFEST_FILENAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
+
+
+####################
+# Reader
+
+class ColumnarReplica:
+    """ Queries on a columnar replica, with the same interface as the functions of filter_data_helpers.py
+    Columns are memory-mapped on first use, and filters are evaluated as vectorized masks.
+    Example:
+        replica = ColumnarReplica("sample_replica")
+        halos, radii, profiles = replica.get_halo_profiles([("M_Crit200", 30, 200)], [], ["gas_density"])
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST_FILENAME)) as f:
+            self.manifest = json.load(f)
+        self._arrays = {}
+        self._codes = {} # (table name, column name) : {category : code}
+        self._stored_redshifts = None
+
+    def _get_array(self, *path):
+        if path not in self._arrays:
+            self._arrays[path] = np.load(os.path.join(self.directory, *path[:-1], f"{path[-1]}.npy"), mmap_mode="r")
+        return self._arrays[path]
+
+    def get_columns(self, table_name):
+        return list(self.manifest["tables"][table_name]["columns"].keys())
+
+    def get_column(self, table_name, column_name, rows=slice(None)):
+        """ Values of a column (decoded for TEXT columns), for the given rows (indices, mask or slice) """
+        column = self.manifest["tables"][table_name]["columns"][check_identifier(column_name)]
+        values = self._get_array(table_name, column_name)[rows]
+        if column["kind"] == "text":
+            categories = np.array(column["categories"] + [None], dtype=object)
+            return categories[values] # Code -1 (NULL) maps to None
+        return values
+
+    def _get_codes(self, table_name, column_name, values):
+        key = (table_name, column_name)
+        if key not in self._codes:
+            self._codes[key] = {c : i for i, c in enumerate(self.manifest["tables"][table_name]["columns"][column_name]["categories"])}
+        codes = self._codes[key]
+        return [codes[v] for v in values if v in codes]
+
+    def get_mask(self, table_name, list_of_inequality_filters, list_of_equality_filters):
+        """ Boolean mask of the rows selected by the filters (with the semantics of query_helpers.Query) """
+        mask = np.ones(self.manifest["tables"][table_name]["number_rows"], dtype=bool)
+
+        for (column_name, lower_limit, upper_limit) in list_of_inequality_filters:
+            values = self._get_array(table_name, check_identifier(column_name))
+            if lower_limit is not None:
+                mask &= values >= lower_limit
+            if upper_limit is not None:
+                mask &= values <= upper_limit
+
+        for (column_name, values) in list_of_equality_filters:
+            values = list(values)
+            if len(values) == 0:
+                continue
+            if self.manifest["tables"][table_name]["columns"][check_identifier(column_name)]["kind"] == "text":
+                values = self._get_codes(table_name, column_name, values)
+            mask &= np.isin(self._get_array(table_name, column_name), values)
+
+        return mask
+
+    def _get_dataframe(self, table_name, rows, columns=None):
+        columns = self.get_columns(table_name) if columns is None else columns
+        data = {}
+        for column_name in columns:
+            values = self.get_column(table_name, column_name, rows)
+            # Array columns are returned as one array per row, as by the database
+            data[column_name] = list(values) if values.ndim > 1 else values
+        return pd.DataFrame(data, columns=columns)
+
+    def get_stored_redshifts(self):
+        """ {(simulation_unique_id, snapshot) : redshift} of the exported snapshots table, as units_helpers.get_stored_redshifts """
+        if self._stored_redshifts is None:
+            self._stored_redshifts = {}
+            if SNAPSHOTS_TABLE in self.manifest["tables"]:
+                snapshots = self._get_dataframe(SNAPSHOTS_TABLE, slice(None))
+                self._stored_redshifts = {(s, int(n)) : float(z) for s, n, z in zip(snapshots["simulation_unique_id"], snapshots["snapshot"], snapshots["redshift"])}
+        return self._stored_redshifts
+
+    def get_all_simulation_details(self):
+        return self._get_dataframe("simulations", slice(None))
+
+    def get_halos_based_on_filters(self, list_of_inequality_filters, list_of_equality_filters, columns=None, physical_units=False):
+        rows = np.flatnonzero(self.get_mask("halos", list_of_inequality_filters, list_of_equality_filters))
+        halos = self._get_dataframe("halos", rows, columns)
+        return to_physical_units(halos, stored_redshifts=self.get_stored_redshifts()) if physical_units else halos
+
+    def _get_property_indices(self, list_of_properties):
+        property_keys = self.manifest["profiles"]["property_keys"]
+        if len(list_of_properties) == 0:
+            return property_keys, list(range(len(property_keys)))
+        return list_of_properties, [property_keys.index(k) for k in list_of_properties]
+
+    def get_profiles(self, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_properties, packed=False, columns=None, physical_units=False):
+        """ Same results as filter_data_helpers.get_profiles (without the rows of missing values) """
+        rows = np.flatnonzero(self.get_mask("halos", [], [("ID", list_of_halo_ids), ("simulation_unique_id", list_of_simulation_ids), ("snapshot", list_of_snapshots)]))
+        list_of_properties, property_indices = self._get_property_indices(list_of_properties)
+
+        values = self._get_array("profiles", "values")[rows][:, property_indices]
+        radii = self._get_array("profiles", "radius")[rows]
+        # Only halos with profiles
+        has_profiles = ~np.all(np.isnan(radii), axis=1)
+        rows, values, radii = rows[has_profiles], values[has_profiles], radii[has_profiles]
+
+        if packed:
+            halos = self._get_dataframe("halos", rows, ["ID", "simulation_unique_id", "snapshot"])
+            if physical_units:
+                return profiles_to_physical_units(halos, radii, values, list_of_properties, stored_redshifts=self.get_stored_redshifts())
+            return halos, radii, values
+
+        # One row per (halo, property, radial bin), as in the profiles table
+        halo_index, property_index, radial_bin = np.nonzero(~np.isnan(values))
+        halos = self._get_dataframe("halos", rows[halo_index], ["ID", "simulation_unique_id", "snapshot"])
+        halos["radius"] = radii[halo_index, radial_bin]
+        halos["property_key"] = np.array(list_of_properties, dtype=object)[property_index]
+        halos["property_value"] = values[halo_index, property_index, radial_bin]
+        if physical_units:
+            halos = to_physical_units(halos, stored_redshifts=self.get_stored_redshifts())
+        return halos if columns is None else halos[columns]
+
+    def get_halo_profiles(self, list_of_inequality_filters, list_of_equality_filters, list_of_properties, halo_columns=None, packed=False, physical_units=False):
+        """ Same results as filter_data_helpers.get_halo_profiles (packed is accepted for compatibility) """
+        rows = np.flatnonzero(self.get_mask("halos", list_of_inequality_filters, list_of_equality_filters))
+        radii = self._get_array("profiles", "radius")[rows]
+        has_profiles = ~np.all(np.isnan(radii), axis=1)
+        rows, radii = rows[has_profiles], radii[has_profiles]
+
+        key_columns = ["ID", "simulation_unique_id", "snapshot"]
+        halo_columns = self.get_columns("halos") if halo_columns is None else halo_columns
+        halos = self._get_dataframe("halos", rows, key_columns + [c for c in halo_columns if c not in key_columns])
+
+        list_of_properties, property_indices = self._get_property_indices(list_of_properties)
+        values = self._get_array("profiles", "values")
+        profiles = {k : values[rows, i] for k, i in zip(list_of_properties, property_indices)}
+        if physical_units:
+            return profiles_to_physical_units(halos, radii, profiles, stored_redshifts=self.get_stored_redshifts())
+        return halos, radii, profiles
+
+    def get_subhalos(self, list_of_subhalo_ids, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_inequality_filters, list_of_equality_filters, columns=None, lazy_arrays=False, physical_units=False):
+        """ Same results as filter_data_helpers.get_subhalos (lazy_arrays is accepted for compatibility) """
+        list_of_equality_filters = list(list_of_equality_filters) + [
+            ("subhaloID", list_of_subhalo_ids),
+            ("haloID", list_of_halo_ids),
+            ("simulation_unique_id", list_of_simulation_ids),
+            ("snapshot", list_of_snapshots),
+        ]
+        rows = np.flatnonzero(self.get_mask("subhalos", list_of_inequality_filters, list_of_equality_filters))
+        subhalos = self._get_dataframe("subhalos", rows, columns)
+        return to_physical_units(subhalos, stored_redshifts=self.get_stored_redshifts()) if physical_units else subhalos
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--database_filename", help="Database filename to be exported", default="sample.db", type=str)
+    parser.add_argument("-o", "--output_directory", help="Directory of the replica", default="sample_replica", type=str)
+    parser.add_argument("--chunk_size", help="Number of rows read at a time", default=100000, type=int)
+    args = parser.parse_args()
+
+    set_database_filename(args.database_filename)
+
+    manifest = export_replica(args.output_directory, chunk_size=args.chunk_size, database=get_database())
+    for table_name, table in manifest["tables"].items():
+        print(f"{table_name}: {table['number_rows']} rows, {len(table['columns'])} columns")
+    if "profiles" in manifest:
+        print(f"profiles: {len(manifest['profiles']['property_keys'])} properties, {manifest['profiles']['number_radial_bins']} radial bins")
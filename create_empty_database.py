@@ -1,16 +1,21 @@
 import argparse
-import numpy as np
 
 from database_helpers import set_database_filename, create_table, remove_existing_db_files
-from illstack_helpers import get_illstack_global_properties
+from illstack_helpers import global_properties_list, integer_dtypes, get_illstack_dtypes
+from index_helpers import create_indexes
+from manifest_helpers import create_manifest_table
+from units_helpers import create_snapshots_table
 
 # Accept optional name of database file
 parser = argparse.ArgumentParser()
 parser.add_argument("-f", "--database_filename", help="Database filename to be generated", default="sample.db", type=str)
 parser.add_argument("--profile_filename", help="Profiles .npz file, used to determine columns for the profiles table", required=True, type=str)
+parser.add_argument("--profile_layout", help="Storage layout of the radial profiles: 'rows' (one row per value, profiles table), 'packed' (one row per halo, profiles_packed table) or 'both'", default="rows", choices=["rows", "packed", "both"], type=str)
+parser.add_argument("--defer_indexes", help="Do not create the secondary indexes (see index_helpers.py). Use for bulk loads, and build the indexes once at the end with 'python index_helpers.py --build'", action="store_true")
 args = parser.parse_args()
 db_filename = args.database_filename
 profile_filename = args.profile_filename
+profile_layout = args.profile_layout
 
 # Set filename to be used in database creation
 set_database_filename(db_filename)
@@ -46,11 +51,11 @@ halos_columns = {
     "simulation_unique_id" : "TEXT NOT NULL",
 }
 
-illstack_global_properties = get_illstack_global_properties(profile_filename)
+# Column types are inferred from the .npy headers of the file, without loading the arrays
+illstack_global_properties_dtypes = get_illstack_dtypes(profile_filename, global_properties_list)
 
-for k in illstack_global_properties.keys():
-    element = illstack_global_properties[k][0]
-    if isinstance(element, np.uint32) or isinstance(element, np.int16) or isinstance(element, np.int32) or isinstance(element, np.int64) or isinstance(element, int):
+for k, dtype in illstack_global_properties_dtypes.items():
+    if dtype in integer_dtypes:
         halos_columns[k] = "INTEGER"
     else:
         halos_columns[k] = "REAL"
@@ -62,18 +67,35 @@ create_table(
 )
 
 ### profiles
-create_table(
-    "profiles",
-    {
-        "ID" : "INTEGER NOT NULL",
-        "simulation_unique_id" : "TEXT NOT NULL",
-        "snapshot" : "INTEGER NOT NULL",
-        "radius" : "REAL NOT NULL",
-        "property_key" : "TEXT NOT NULL",
-        "property_value" : "REAL",
-    },
-    unique=("ID", "simulation_unique_id", "snapshot", "radius", "property_key")
-)
+if profile_layout in ("rows", "both"):
+    create_table(
+        "profiles",
+        {
+            "ID" : "INTEGER NOT NULL",
+            "simulation_unique_id" : "TEXT NOT NULL",
+            "snapshot" : "INTEGER NOT NULL",
+            "radius" : "REAL NOT NULL",
+            "property_key" : "TEXT NOT NULL",
+            "property_value" : "REAL",
+        },
+        unique=("ID", "simulation_unique_id", "snapshot", "radius", "property_key")
+    )
+
+### profiles_packed
+# One row per halo, with the whole profile stored as binary arrays
+if profile_layout in ("packed", "both"):
+    create_table(
+        "profiles_packed",
+        {
+            "ID" : "INTEGER NOT NULL",
+            "simulation_unique_id" : "TEXT NOT NULL",
+            "snapshot" : "INTEGER NOT NULL",
+            "property_keys" : "TEXT NOT NULL", # Comma-separated property keys, in the order of the rows of property_values, e.g. "gas_density,gas_pressure,metallicity,temperature"
+            "radius" : "ARRAY NOT NULL", # 1D array with the radial bins
+            "property_values" : "ARRAY NOT NULL", # 2D array with shape (number of properties, number of radial bins)
+        },
+        unique=("ID", "simulation_unique_id", "snapshot")
+    )
 
 ### subhalos
 # Properties motivated by https://www.tng-project.org/data/docs/specifications/#sec2b
@@ -161,3 +183,15 @@ create_table(
     },
     unique=("subhaloID", "subfindID", "snapshot", "simulation_unique_id")
 )
+
+### snapshots
+# Redshift of each (simulation, snapshot), stored when its subhalos are loaded, see units_helpers.py
+create_snapshots_table()
+
+### ingest_manifest
+# Sources ingested by the bulk loaders, see manifest_helpers.py
+create_manifest_table()
+
+### Secondary indexes
+if not args.defer_indexes:
+    create_indexes()
@@ -1,9 +1,18 @@
-from collections import defaultdict
+import atexit
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from functools import lru_cache
 import io
+import json
 from matplotlib import pyplot as plt
 import numpy as np
 import os
+import re
 import sqlite3
+import struct
+import sys
+import threading
+import time
 
 DATABASE_FILE = "sample.db"
 
@@ -13,24 +22,67 @@ def set_database_filename(filename):
 
 def remove_existing_db_files():
     # For demo purposes, remove previous version of database
-    if os.path.isfile(DATABASE_FILE):
-        os.remove(DATABASE_FILE)
+    close_database(DATABASE_FILE)
+    for filename in (DATABASE_FILE, f"{DATABASE_FILE}-wal", f"{DATABASE_FILE}-shm"):
+        if os.path.isfile(filename):
+            os.remove(filename)
 
 
 ####################
 # Helpers for storing numpy arrays
 
-# From https://stackoverflow.com/questions/18621513/python-insert-numpy-array-into-sqlite3-database
+# Arrays are stored as a small fixed header followed by the raw array bytes:
+# - 4 bytes: magic b"\x00NDA" (never the start of a .npy file, which starts with b"\x93NUMPY")
+# - 8 bytes: dtype string, e.g. b"<f8", padded with spaces
+# - 1 byte: number of dimensions, followed by 3 bytes of padding
+# - 8 bytes per dimension: shape, as little-endian uint64
+# All header fields are multiples of 8 bytes, so that the array data is aligned.
+ARRAY_MAGIC = b"\x00NDA"
+_array_header = struct.Struct("<4s8sB3x")
+_array_header_cache = {}
+
 def adapt_array(arr):
+    if arr.dtype.hasobject or arr.dtype.fields is not None or len(arr.dtype.str) > 8:
+        # Object and structured arrays, and dtypes that do not fit in the header, are stored with np.save
+        return adapt_array_npy(arr)
+
+    key = (arr.dtype.str, arr.shape)
+    header = _array_header_cache.get(key)
+    if header is None:
+        header = _array_header.pack(ARRAY_MAGIC, arr.dtype.str.encode("ascii").ljust(8), arr.ndim) + struct.pack(f"<{arr.ndim}Q", *arr.shape)
+        if len(_array_header_cache) < 1024:
+            _array_header_cache[key] = header
+
+    # Viewing as flat bytes also works for empty and datetime arrays, which memoryview.cast rejects
+    return b"".join((header, np.ascontiguousarray(arr).reshape(-1).view(np.uint8)))
+
+def convert_array(blob):
+    """ Decode an ARRAY blob without copying the data
+    Note that the returned array is read-only, since it is a view of the blob.
+    Blobs written with np.save by previous versions are still supported.
+    """
+    if blob[:4] != ARRAY_MAGIC:
+        return convert_array_npy(blob)
+
+    _, dtype, ndim = _array_header.unpack_from(blob)
+    shape = struct.unpack_from(f"<{ndim}Q", blob, _array_header.size)
+    offset = _array_header.size + 8 * ndim
+
+    return np.frombuffer(blob, dtype=np.dtype(dtype.decode("ascii").strip()), offset=offset).reshape(shape)
+
+# Previous format, using np.save
+# From https://stackoverflow.com/questions/18621513/python-insert-numpy-array-into-sqlite3-database
+def adapt_array_npy(arr):
     out = io.BytesIO()
     np.save(out, arr)
     out.seek(0)
     return sqlite3.Binary(out.read())
 
-def convert_array(text):
+def convert_array_npy(text):
     out = io.BytesIO(text)
     out.seek(0)
     return np.load(out)
+
 # Converts np.array to TEXT when inserting
 sqlite3.register_adapter(np.ndarray, adapt_array)
 # Converts TEXT to np.array when selecting
@@ -44,46 +96,637 @@ sqlite3.register_adapter(np.uint32, lambda val: int(val))
 sqlite3.register_adapter(np.float32, lambda val: float(val))
 
 
+class LazyArray:
+    """ ARRAY value that is only decoded when accessed
+    Behaves like the decoded np.ndarray for indexing, len() and np.asarray().
+    """
+    __slots__ = ("_blob", "_array")
+
+    def __init__(self, blob):
+        self._blob = blob
+        self._array = None
+
+    @property
+    def value(self):
+        if self._array is None:
+            self._array = convert_array(self._blob)
+            self._blob = None
+        return self._array
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.value
+        return self.value.astype(dtype)
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __len__(self):
+        return len(self.value)
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __repr__(self):
+        if self._array is None:
+            return f"LazyArray(<{len(self._blob)} bytes, not decoded>)"
+        return f"LazyArray({self._array!r})"
+
+
 ####################
-# Database helper functions
+# Database sessions
+
+class Database:
+    """ Session on one database file, keeping its connections open between queries
+    Each thread gets its own connection (opened on first use), tuned with performance PRAGMAs.
+    Several Database objects can be used at the same time for different files.
+
+    Example:
+        db = Database("sample.db")
+        with db.transaction():
+            db.executemany(query, data)
+        rows = db.execute("SELECT * FROM halos")
+    """
+
+    def __init__(self, filename: str, read_only: bool = False, journal_mode: str = "WAL", synchronous: str = "NORMAL", cache_size: int = -64000, mmap_size: int = 2**30, temp_store: str = "MEMORY", timeout: float = 15, cached_statements: int = 512):
+        # cache_size: negative values are in KiB, i.e. -64000 is a ~64 MB page cache per connection
+        self.filename = filename
+        self.read_only = read_only
+        self.pragmas = {
+            "synchronous" : synchronous,
+            "cache_size" : cache_size,
+            "mmap_size" : mmap_size,
+            "temp_store" : temp_store,
+        }
+        self.journal_mode = journal_mode
+        self.timeout = timeout
+        # Number of prepared statements kept per connection, see query_helpers.py
+        self.cached_statements = cached_statements
+
+        self._column_types = {}
+        # QueryTracer of this session (see enable_query_tracing), instead of the global one
+        self.tracer = None
+
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    def _connect(self):
+        if self.read_only:
+            uri = f"file:{os.path.abspath(self.filename)}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, detect_types=sqlite3.PARSE_DECLTYPES, timeout=self.timeout, check_same_thread=False, isolation_level=None, cached_statements=self.cached_statements)
+        else:
+            conn = sqlite3.connect(self.filename, detect_types=sqlite3.PARSE_DECLTYPES, timeout=self.timeout, check_same_thread=False, isolation_level=None, cached_statements=self.cached_statements)
+        conn.row_factory = sqlite3.Row
+
+        # The journal mode is stored in the database file, so it can only be changed by writers
+        if not self.read_only and self.journal_mode is not None:
+            conn.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+        for k, v in self.pragmas.items():
+            if v is not None:
+                conn.execute(f"PRAGMA {k} = {v}")
+
+        return conn
+
+    @property
+    def connection(self):
+        """ Connection of the calling thread """
+        conn = getattr(self._local, "connection", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.connection = conn
+            self._local.transaction_depth = 0
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _get_tracer(self):
+        """ QueryTracer to be used, with its callbacks installed on the connection of the calling thread """
+        tracer = self.tracer if self.tracer is not None else _query_tracer
+        conn = self.connection
+        if getattr(self._local, "tracer", None) is not tracer:
+            if tracer is None:
+                conn.set_trace_callback(None)
+                conn.set_progress_handler(None, 0)
+            else:
+                tracer._install_callbacks(conn)
+            self._local.tracer = tracer
+        return tracer
+
+    def get_column_types(self, table_name: str):
+        """ Return {column name : declared type} for a table (cached) """
+        if table_name not in self._column_types:
+            columns = self.execute(f"PRAGMA table_info({table_name})")
+            self._column_types[table_name] = {c["name"] : c["type"].upper() for c in columns}
+        return self._column_types[table_name]
+
+    def get_data_version(self):
+        """ Token that changes whenever the content of the database may have changed
+        PRAGMA data_version changes when another connection commits, but not on the commits of
+        the connection itself (nor does total_changes help, as it also counts writes to temporary
+        tables), so the version of the file is included for those. Both are per connection, so
+        the token also identifies the connection of the calling thread.
+        """
+        conn = self.connection
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        return (id(conn), data_version, self.get_file_version())
+
+    def get_file_version(self):
+        """ Token that changes whenever the database file changes, also across processes
+        Made of the file change counter (bytes 24-27 of the header, incremented on each commit
+        outside of WAL mode) and of the size and modification time of the database and WAL files.
+        """
+        with open(self.filename, "rb") as f:
+            header = f.read(28)
+        change_counter = struct.unpack(">I", header[24:28])[0] if len(header) == 28 else 0
+
+        version = [change_counter]
+        for filename in [self.filename, f"{self.filename}-wal"]:
+            try:
+                stat = os.stat(filename)
+                version.extend([stat.st_size, stat.st_mtime_ns])
+            except FileNotFoundError:
+                version.extend([0, 0])
+        return tuple(version)
+
+    @property
+    def in_transaction(self):
+        return getattr(self._local, "transaction_depth", 0) > 0
+
+    @contextmanager
+    def transaction(self):
+        """ Group several statements into one transaction
+        Commits on success and rolls back on error. Nested transactions join the outermost one.
+        """
+        conn = self.connection
+        if self._local.transaction_depth == 0:
+            conn.execute("BEGIN")
+        self._local.transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._local.transaction_depth -= 1
+            if self._local.transaction_depth == 0:
+                conn.execute("ROLLBACK")
+            raise
+        else:
+            self._local.transaction_depth -= 1
+            if self._local.transaction_depth == 0:
+                conn.execute("COMMIT")
+
+    def execute(self, query: str, params: tuple = None):
+        tracer = self._get_tracer()
+        if tracer is not None:
+            return tracer.trace(self, query, params, lambda: self._execute(query, params))
+        return self._execute(query, params)
+
+    def _execute(self, query, params):
+        cursor = self.connection.cursor()
+
+        if params is not None:
+            cursor.execute(query, params)
+        else:
+            cursor.execute(query)
+
+        results = cursor.fetchall()
+
+        # Only SELECT queries return non-empty lists
+        if len(results) > 0:
+            results = [dict(row) for row in results]
+
+        cursor.close()
+
+        return results
+
+    def iter_execute(self, query: str, params: tuple = None, chunk_size: int = 10000):
+        """ Run a SELECT query and yield its results in chunks, instead of fetching all rows at once
+        Yields (columns, rows), with rows a list of at most chunk_size tuples
+        (chunk_size=None yields all rows in a single chunk).
+        """
+        tracer = self._get_tracer()
+        if tracer is not None:
+            return tracer.trace_chunks(self, query, params, self._iter_execute(query, params, chunk_size))
+        return self._iter_execute(query, params, chunk_size)
+
+    def _iter_execute(self, query, params, chunk_size):
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+
+        try:
+            if params is not None:
+                cursor.execute(query, params)
+            else:
+                cursor.execute(query)
+
+            if cursor.description is None:
+                return
+            columns = [d[0] for d in cursor.description]
+
+            if chunk_size is None:
+                yield columns, cursor.fetchall()
+                return
+
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if len(rows) == 0:
+                    break
+                yield columns, rows
+        finally:
+            cursor.close()
+
+    def executemany(self, query: str, data: list):
+        self.executemany_batches(query, [data])
+
+    def executemany_batches(self, query: str, batches):
+        """ Run executemany once per batch of rows, in a single transaction
+        batches: iterable of lists of tuples, e.g. a generator, so that the full
+        dataset never needs to be held in memory
+        """
+        tracer = self._get_tracer()
+        if tracer is not None:
+            tracer.trace(self, query, None, lambda: self._executemany_batches(query, batches), many=True)
+        else:
+            self._executemany_batches(query, batches)
+
+    def _executemany_batches(self, query, batches):
+        # Returns the number of modified rows
+        number_rows = 0
+        with self.transaction():
+            cursor = self.connection.cursor()
+            for batch in batches:
+                cursor.executemany(query, batch)
+                number_rows += max(cursor.rowcount, 0)
+            cursor.close()
+        return number_rows
+
+    def close(self):
+        """ Close the connections of all threads """
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
 
-def get_db_conn():
-    conn = sqlite3.connect(DATABASE_FILE, detect_types=sqlite3.PARSE_DECLTYPES, timeout=15)
-    conn.row_factory = sqlite3.Row
-    return conn
+    def __enter__(self):
+        return self
 
-def execute_query(query: str, params: tuple = None):
-    conn = get_db_conn()
-    cursor = conn.cursor()
+    def __exit__(self, *exc_info):
+        self.close()
 
-    if params is not None:
-        cursor.execute(query, params)
+
+# Open sessions, one per database filename
+_databases = {}
+_databases_lock = threading.Lock()
+
+def get_database(filename: str = None):
+    """ Return the (shared) session for the given file, or for DATABASE_FILE if not given """
+    if filename is None:
+        filename = DATABASE_FILE
+    with _databases_lock:
+        if filename not in _databases:
+            _databases[filename] = Database(filename)
+        return _databases[filename]
+
+def close_database(filename: str = None):
+    if filename is None:
+        filename = DATABASE_FILE
+    with _databases_lock:
+        database = _databases.pop(filename, None)
+    if database is not None:
+        database.close()
+
+def close_all_databases():
+    with _databases_lock:
+        databases = list(_databases.values())
+        _databases.clear()
+    for database in databases:
+        database.close()
+
+atexit.register(close_all_databases)
+
+
+####################
+# Query tracing
+# Opt-in instrumentation of the statements run through Database sessions, to find where query time goes.
+# The sqlite3 trace callback counts the statements run by SQLite (including those of temporary tables and
+# transactions), and the progress handler counts virtual machine steps, i.e. the work done by each statement.
+
+# Upper edges of the latency histogram buckets, in seconds (the last bucket has no upper edge)
+TRACE_LATENCY_EDGES = [1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 1, 3, 10]
+# The progress handler is called every TRACE_PROGRESS_STEPS virtual machine instructions
+TRACE_PROGRESS_STEPS = 1000
+# Full scans of these tables are flagged in the plans of slow statements
+TRACE_LARGE_TABLES = ("profiles", "mergertree")
+# Modules whose frames are skipped when looking for the helper that ran a statement
+_TRACE_INTERNAL_MODULES = {"database_helpers", "query_helpers", "cache_helpers", "contextlib"}
+
+_in_list_pattern = re.compile(r"IN \((?:\?, ?)*\?\)")
+_temp_table_name_pattern = re.compile(r"\b_query_values_\d+\b")
+_literal_pattern = re.compile(r"'(?:[^']|'')*'|(?<![\w.])-?\d+(?:\.\d*)?(?:[eE][+-]?\d+)?\b")
+
+@lru_cache(maxsize=4096)
+def normalize_query(query: str):
+    """ Shape of a query: whitespace collapsed, literals replaced by ?, IN lists of any length
+    replaced by "IN (?...)", and temporary table names (see query_helpers.py) made generic
+    """
+    query = " ".join(query.split())
+    query = _literal_pattern.sub("?", query)
+    query = _in_list_pattern.sub("IN (?...)", query)
+    return _temp_table_name_pattern.sub("_query_values_N", query)
+
+def _get_rows_size(rows):
+    """ Approximate number of bytes decoded for the rows (dicts or tuples), from the types of the first row """
+    if len(rows) == 0:
+        return 0
+
+    first_row = rows[0]
+    size = 0
+    for k in (first_row.keys() if isinstance(first_row, dict) else range(len(first_row))):
+        if isinstance(first_row[k], np.ndarray):
+            size += sum(row[k].nbytes for row in rows if row[k] is not None)
+        elif isinstance(first_row[k], (str, bytes)):
+            size += sum(len(row[k]) for row in rows if row[k] is not None)
+        else:
+            size += 8 * len(rows)
+    return size
+
+
+class QueryTracer:
+    """ Statistics of the statements run through Database sessions, grouped by normalized query shape:
+    number of calls, latency histogram, rows returned, bytes decoded, statements and virtual machine steps.
+    Statements slower than slow_query_seconds are also recorded individually, with their EXPLAIN QUERY PLAN,
+    flagging full scans of the large tables (TRACE_LARGE_TABLES).
+    Each statement is attributed to the helper that ran it (e.g. filter_data_helpers.get_profiles), to the
+    caller of that helper, and to the current label, if any.
+
+    Example:
+        tracer = enable_query_tracing(slow_query_seconds=0.1)
+        with tracer.label("mass function"):
+            halos = get_halos_based_on_filters(...)
+        tracer.print_summary()
+        tracer.save("query_trace.json")
+    """
+
+    def __init__(self, slow_query_seconds: float = 0.1, max_slow_queries: int = 1000):
+        self.slow_query_seconds = slow_query_seconds
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._shapes = {}
+        self._slow_queries = deque(maxlen=max_slow_queries)
+
+    def reset(self):
+        with self._lock:
+            self._shapes = {}
+            self._slow_queries.clear()
+
+    @contextmanager
+    def label(self, name: str):
+        """ Attribute the statements run inside the context to name, e.g. a notebook cell """
+        labels = self._get_local_state()["labels"]
+        labels.append(name)
+        try:
+            yield self
+        finally:
+            labels.pop()
+
+    def _get_local_state(self):
+        # Counters of the calling thread, updated by the callbacks of its connection
+        state = getattr(self._local, "state", None)
+        if state is None:
+            state = self._local.state = {"depth" : 0, "statements" : 0, "vm_steps" : 0, "labels" : []}
+        return state
+
+    def _install_callbacks(self, conn):
+        state = self._get_local_state()
+
+        def trace_callback(statement):
+            if state["depth"] > 0:
+                state["statements"] += 1
+            else:
+                # Statements run directly on the connection (transactions, PRAGMAs), which are not timed
+                self._record(normalize_query(statement), None, 0, 0, 1, 0)
+
+        def progress_handler():
+            state["vm_steps"] += TRACE_PROGRESS_STEPS
+            return 0
+
+        conn.set_trace_callback(trace_callback)
+        conn.set_progress_handler(progress_handler, TRACE_PROGRESS_STEPS)
+
+    def trace(self, database, query, params, run, many=False):
+        """ Run and record a statement: run() returns the rows, or the number of modified rows if many """
+        state = self._get_local_state()
+        statements, vm_steps = state["statements"], state["vm_steps"]
+        state["depth"] += 1
+        start = time.perf_counter()
+        try:
+            result = run()
+        finally:
+            seconds = time.perf_counter() - start
+            state["depth"] -= 1
+
+        if many:
+            number_rows, number_bytes = result, 0
+        else:
+            number_rows, number_bytes = len(result), _get_rows_size(result)
+        self._finish(database, query, params, seconds, number_rows, number_bytes, state["statements"] - statements, state["vm_steps"] - vm_steps, explain=not many)
+        return result
+
+    def trace_chunks(self, database, query, params, chunks):
+        """ Iterate over and record the chunks of Database.iter_execute. Only the time spent fetching the chunks is counted """
+        state = self._get_local_state()
+        statements, vm_steps = state["statements"], state["vm_steps"]
+        seconds, number_rows, number_bytes = 0, 0, 0
+        try:
+            while True:
+                state["depth"] += 1
+                start = time.perf_counter()
+                try:
+                    columns, rows = next(chunks)
+                except StopIteration:
+                    break
+                finally:
+                    seconds += time.perf_counter() - start
+                    state["depth"] -= 1
+
+                number_rows += len(rows)
+                number_bytes += _get_rows_size(rows)
+                yield columns, rows
+        finally:
+            chunks.close()
+            # Recorded here, so that partially consumed iterators are recorded too
+            self._finish(database, query, params, seconds, number_rows, number_bytes, state["statements"] - statements, state["vm_steps"] - vm_steps)
+
+    def _finish(self, database, query, params, seconds, number_rows, number_bytes, statements, vm_steps, explain=True):
+        shape = normalize_query(query)
+        helper, caller = self._get_caller()
+        self._record(shape, seconds, number_rows, number_bytes, statements, vm_steps, helper)
+
+        if seconds < self.slow_query_seconds:
+            return
+
+        plan = self._explain(database, query, params) if explain else []
+        full_scans = [
+            table_name
+            for table_name in TRACE_LARGE_TABLES
+            for detail in plan
+            if re.match(rf"SCAN (TABLE )?{table_name}\b", detail) and "INDEX" not in detail
+        ]
+        labels = self._get_local_state()["labels"]
+        with self._lock:
+            self._slow_queries.append({
+                "time" : time.time(),
+                "shape" : shape,
+                "seconds" : seconds,
+                "rows" : number_rows,
+                "bytes_decoded" : number_bytes,
+                "vm_steps" : vm_steps,
+                "database" : database.filename,
+                "params" : [repr(p) for p in params[:16]] if params is not None else [],
+                "helper" : helper,
+                "caller" : caller,
+                "label" : labels[-1] if len(labels) != 0 else None,
+                "plan" : plan,
+                "full_scans" : full_scans,
+            })
+
+    def _record(self, shape, seconds, number_rows, number_bytes, statements, vm_steps, helper=None):
+        with self._lock:
+            stats = self._shapes.get(shape)
+            if stats is None:
+                stats = self._shapes[shape] = {
+                    "calls" : 0, "untimed_calls" : 0, "total_seconds" : 0.0, "max_seconds" : 0.0,
+                    "histogram" : [0] * (len(TRACE_LATENCY_EDGES) + 1),
+                    "rows" : 0, "bytes_decoded" : 0, "statements" : 0, "vm_steps" : 0, "helpers" : defaultdict(int),
+                }
+
+            stats["calls"] += 1
+            stats["rows"] += number_rows
+            stats["bytes_decoded"] += number_bytes
+            stats["statements"] += statements
+            stats["vm_steps"] += vm_steps
+            if helper is not None:
+                stats["helpers"][helper] += 1
+            if seconds is None:
+                stats["untimed_calls"] += 1
+                return
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["histogram"][np.searchsorted(TRACE_LATENCY_EDGES, seconds)] += 1
+
+    def _explain(self, database, query, params):
+        # Run on the same connection, so that temporary tables of the query still exist
+        state = self._get_local_state()
+        state["depth"] += 1
+        try:
+            cursor = database.connection.execute(f"EXPLAIN QUERY PLAN {query}", params if params is not None else ())
+            return [row["detail"] for row in cursor.fetchall()]
+        except sqlite3.Error:
+            return []
+        finally:
+            state["depth"] -= 1
+
+    @staticmethod
+    def _get_caller():
+        """ (helper, caller): the outermost function of the first module outside of the database
+        and query helpers (e.g. filter_data_helpers.get_profiles), and the code that called it
+        """
+        frame = sys._getframe(1)
+        while frame is not None and frame.f_globals.get("__name__") in _TRACE_INTERNAL_MODULES:
+            frame = frame.f_back
+        if frame is None:
+            return None, None
+
+        module = frame.f_globals.get("__name__")
+        while frame.f_back is not None and frame.f_back.f_globals.get("__name__") == module:
+            frame = frame.f_back
+        helper = f"{module}.{frame.f_code.co_name}"
+
+        frame = frame.f_back
+        if frame is None:
+            return helper, None
+        return helper, f"{frame.f_globals.get('__name__')}.{frame.f_code.co_name}:{frame.f_lineno}"
+
+    def get_summary(self):
+        """ Dict with the statistics of each query shape (sorted by total time), and the slow queries """
+        with self._lock:
+            shapes = [
+                dict(stats, shape=shape, helpers=dict(stats["helpers"]), mean_seconds=stats["total_seconds"] / max(stats["calls"] - stats["untimed_calls"], 1))
+                for shape, stats in self._shapes.items()
+            ]
+            slow_queries = list(self._slow_queries)
+
+        return {
+            "slow_query_seconds" : self.slow_query_seconds,
+            "latency_edges_seconds" : TRACE_LATENCY_EDGES,
+            "queries" : sorted(shapes, key=lambda stats: -stats["total_seconds"]),
+            "slow_queries" : slow_queries,
+        }
+
+    def save(self, filename: str):
+        """ Write the summary as JSON """
+        with open(filename, "w") as f:
+            json.dump(self.get_summary(), f, indent=4)
+
+    def print_summary(self, number_queries: int = 10):
+        summary = self.get_summary()
+        for stats in summary["queries"][:number_queries]:
+            print(f"{stats['total_seconds']:9.3f} s  {stats['calls']:7d} calls  {stats['rows']:10d} rows  {stats['bytes_decoded'] / 2**20:9.1f} MB  {stats['shape'][:120]}")
+        for query in summary["slow_queries"]:
+            flag = f"  <-- full scan of {', '.join(query['full_scans'])}" if len(query["full_scans"]) != 0 else ""
+            print(f"slow: {query['seconds']:.3f} s in {query['helper']} (called from {query['caller']}, label {query['label']}){flag}")
+
+
+# Global tracer, used by all sessions without their own tracer
+_query_tracer = None
+
+def enable_query_tracing(slow_query_seconds: float = 0.1, database: Database = None):
+    """ Trace the statements of all sessions, or only of the given database, and return the QueryTracer """
+    global _query_tracer
+    tracer = QueryTracer(slow_query_seconds=slow_query_seconds)
+    if database is not None:
+        database.tracer = tracer
     else:
-        cursor.execute(query)
+        _query_tracer = tracer
+    return tracer
 
-    results = cursor.fetchall()
+def disable_query_tracing(database: Database = None):
+    global _query_tracer
+    if database is not None:
+        database.tracer = None
+    else:
+        _query_tracer = None
+
+def get_query_tracer():
+    return _query_tracer
 
-    # Only SELECT queries return non-empty lists
-    if len(results) > 0:
-        results = [dict(row) for row in results]
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+####################
+# Database helper functions
+# All functions accept an optional Database; by default, the session on DATABASE_FILE is used.
 
-    return results
+def execute_query(query: str, params: tuple = None, database: Database = None):
+    database = database or get_database()
+    return database.execute(query, params)
 
-def executemany_query(query: str, data: list):
-    conn = get_db_conn()
-    cursor = conn.cursor()
+def iter_query(query: str, params: tuple = None, chunk_size: int = 10000, database: Database = None):
+    """ Yield the results of a SELECT query in chunks of (columns, rows), see Database.iter_execute """
+    database = database or get_database()
+    yield from database.iter_execute(query, params, chunk_size=chunk_size)
 
-    cursor.executemany(query, data)
+def executemany_query(query: str, data: list, database: Database = None):
+    database = database or get_database()
+    database.executemany(query, data)
 
-    conn.commit()
-    cursor.close()
-    conn.close()
+def executemany_batches_query(query: str, batches, database: Database = None):
+    """ Run executemany once per batch of rows, committing once at the end
+    batches: iterable of lists of tuples, e.g. a generator, so that the full
+    dataset never needs to be held in memory
+    """
+    database = database or get_database()
+    database.executemany_batches(query, batches)
 
-def create_table(table_name: str, columns: dict, primary_key: tuple = None, foreign_key: dict = None, unique: list = None):
+def create_table(table_name: str, columns: dict, primary_key: tuple = None, foreign_key: dict = None, unique: list = None, database: Database = None):
     """ Create a table in the database
     table_name: Example = "halos"
     columns: Example = {
@@ -107,18 +750,28 @@ def create_table(table_name: str, columns: dict, primary_key: tuple = None, fore
     )
     """
 
-    execute_query(query)
+    execute_query(query, database=database)
+
+
+def populate_table(table_name: str, columns: list, data: list, database: Database = None):
+    query = _get_insert_query(table_name, columns)
 
+    executemany_query(query, data, database=database)
 
-def populate_table(table_name: str, columns: list, data: list):
+def _get_insert_query(table_name: str, columns: list):
     columns_string = ", ".join(columns)
     values_placeholders = ", ".join(["?" for _ in columns])
 
-    query = f"""
+    return f"""
     INSERT OR IGNORE INTO {table_name}
     ({columns_string})
     VALUES ({values_placeholders})
     """
 
-    executemany_query(query, data)
+def populate_table_in_batches(table_name: str, columns: list, batches, database: Database = None):
+    """ Same as populate_table, but data is given as an iterable of batches of rows
+    """
+    query = _get_insert_query(table_name, columns)
+
+    executemany_batches_query(query, batches, database=database)
 
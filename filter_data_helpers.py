@@ -1,145 +1,433 @@
-from database_helpers import set_database_filename, execute_query
+from database_helpers import set_database_filename, get_database, LazyArray
+from query_helpers import Query
+from cache_helpers import ResultCache
+from units_helpers import to_physical_units, profiles_to_physical_units
 
+import numpy as np
 import pandas as pd
 
 DATABASE_FILENAME = "sample.db"
 set_database_filename(DATABASE_FILENAME)
 
-def get_all_simulation_details():
-    query = f"""
-    SELECT 
-    *
-    FROM simulations
-    """
+# All functions below accept an optional database_helpers.Database, to query another
+# database file than DATABASE_FILENAME, e.g. get_profiles(..., database=Database("other.db"))
 
-    data = execute_query(query)
-    return pd.DataFrame(data)
+# The iter_* functions are streaming variants of the get_* functions: they yield the
+# results in chunks of at most chunk_size rows, to process results larger than memory.
+
+# The columns argument selects the columns to be fetched (default: all columns), e.g.
+# get_subhalos(..., columns=["subhaloID", "SubhaloMass"]). With lazy_arrays=True, ARRAY
+# columns are returned as database_helpers.LazyArray, which are only decoded when accessed.
+
+# With physical_units=True, the results are converted from the CAMELS code units (ckpc/h, 1e10 Msun/h, ...)
+# to physical units (see units_helpers.py). Filters are always given in code units.
 
+# All queries are built with query_helpers.Query, which binds all values as parameters,
+# and joins long lists of IDs through a temporary table.
 
-def get_halos_based_on_filters(list_of_inequality_filters, list_of_equality_filters):
-    query = """
-    SELECT
-    *
-    FROM halos
+# Optional result cache for the get_* functions, e.g. for notebooks repeating the same queries
+# (see cache_helpers.py). Cached results are invalidated whenever the database changes.
+_result_cache = None
+
+def enable_result_cache(max_memory_bytes=512 * 2**20, cache_directory=None, copy_results=True):
+    """ Cache the results of the get_* functions, in memory (least recently used results are
+    evicted beyond max_memory_bytes) and optionally in cache_directory, shared across processes.
     """
+    global _result_cache
+    _result_cache = ResultCache(max_memory_bytes=max_memory_bytes, cache_directory=cache_directory, copy_results=copy_results)
+    return _result_cache
+
+def disable_result_cache():
+    global _result_cache
+    _result_cache = None
+
+def get_result_cache():
+    return _result_cache
+
+def _get_cached(key, compute, database=None):
+    if _result_cache is None:
+        return compute()
+    return _result_cache.get_or_compute(database or get_database(), key, compute)
+
+def _iter_dataframes(query, chunk_size, lazy_array_columns=(), database=None):
+    for columns, rows in query.iter_execute(chunk_size=chunk_size, database=database):
+        yield _wrap_lazy_arrays(pd.DataFrame.from_records(rows, columns=columns), lazy_array_columns)
+
+def _get_dataframe(query, lazy_array_columns=(), database=None):
+    def compute():
+        data = query.execute(database=database)
+        return _wrap_lazy_arrays(pd.DataFrame(data), lazy_array_columns)
+
+    return _get_cached((query.cache_key, tuple(lazy_array_columns)), compute, database=database)
+
+def _wrap_lazy_arrays(df, lazy_array_columns):
+    for c in lazy_array_columns:
+        if c not in df:
+            continue
+        df[c] = [None if b is None else LazyArray(b) for b in df[c]]
+    return df
+
+def _get_lazy_array_columns(table_name, columns, lazy_arrays, database=None):
+    """ Return (columns, lazy_array_columns): the list of ARRAY columns that should not be decoded """
+    if not lazy_arrays:
+        return columns, []
+
+    column_types = (database or get_database()).get_column_types(table_name)
+    if columns is None:
+        columns = list(column_types.keys())
 
-    query_where_clauses = []
+    return columns, [c for c in columns if column_types.get(c) == "ARRAY"]
 
+def _add_filters(query, list_of_inequality_filters, list_of_equality_filters):
     for (column_name, lower_limit, upper_limit) in list_of_inequality_filters:
-        if lower_limit is not None:
-            query_where_clauses.append(f"{column_name} >= {lower_limit}")
-        if upper_limit is not None:
-            query_where_clauses.append(f"{column_name} <= {upper_limit}")
+        query.where_range(column_name, lower_limit, upper_limit)
 
     for (column_name, values) in list_of_equality_filters:
-        if isinstance(values[0], str):
-            values = [f"'{v}'" for v in values]
-        
-        query_where_clauses.append(f"{column_name} IN ({','.join(values)})")
+        query.where_in(column_name, values)
 
-    if len(query_where_clauses) != 0:
-        query += " WHERE " + " AND ".join(query_where_clauses)
+    return query
 
-    data = execute_query(query)
-    return pd.DataFrame(data)
+def get_all_simulation_details(database=None):
+    query = Query("simulations")
+
+    return _get_dataframe(query, database=database)
+
+
+def _build_halos_query(list_of_inequality_filters, list_of_equality_filters, columns=None):
+    query = Query("halos", columns)
+
+    return _add_filters(query, list_of_inequality_filters, list_of_equality_filters)
+
+
+def get_halos_based_on_filters(list_of_inequality_filters, list_of_equality_filters, columns=None, physical_units=False, database=None):
+    query = _build_halos_query(list_of_inequality_filters, list_of_equality_filters, columns)
 
+    halos = _get_dataframe(query, database=database)
+    return to_physical_units(halos, database=database) if physical_units else halos
 
 
-def get_profiles(list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_properties):
-    query = """
-    SELECT
-    *
-    FROM profiles
+def iter_halos_based_on_filters(list_of_inequality_filters, list_of_equality_filters, chunk_size=100000, columns=None, physical_units=False, database=None):
+    query = _build_halos_query(list_of_inequality_filters, list_of_equality_filters, columns)
+
+    for halos in _iter_dataframes(query, chunk_size, database=database):
+        yield to_physical_units(halos, database=database) if physical_units else halos
+
+
+def get_profiles(list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_properties, packed=False, columns=None, physical_units=False, database=None):
+    """ Fetch radial profiles
+    With packed=False (default), reads the profiles table and returns a DataFrame with one row per value
+    (with the given columns, default all).
+    With packed=True, reads the profiles_packed table and returns a tuple (halos, radii, profiles):
+    - halos: DataFrame with the ID, simulation_unique_id and snapshot of each halo
+    - radii: ndarray with shape (halos, radial bins)
+    - profiles: ndarray with shape (halos, properties, radial bins), with properties in the order of list_of_properties
     """
+    if packed:
+        halos, radii, profiles, property_keys = _get_packed_profiles(list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_properties, database=database)
+        return profiles_to_physical_units(halos, radii, profiles, property_keys, database=database) if physical_units else (halos, radii, profiles)
+
+    query = _build_profiles_query(list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_properties, columns)
+
+    profiles = _get_dataframe(query, database=database)
+    return to_physical_units(profiles, database=database) if physical_units else profiles
 
-    query_where_clauses = []
-
-    if len(list_of_halo_ids) != 0:
-        halo_in_clause = "ID IN (" + ",".join([f"'{h}'" for h in list_of_halo_ids]) + ")"
-        query_where_clauses.append(halo_in_clause)
-    if len(list_of_simulation_ids) != 0:
-        simulation_in_clause = "simulation_unique_id IN (" + ",".join([f"'{s}'" for s in list_of_simulation_ids]) + ")"
-        query_where_clauses.append(simulation_in_clause)
-    if len(list_of_snapshots) != 0:
-        snapshot_in_clause = "snapshot IN (" + ",".join([f"'{s}'" for s in list_of_snapshots]) + ")"
-        query_where_clauses.append(snapshot_in_clause)
-    if len(list_of_properties) != 0:
-        properties_in_clause = "property_key IN (" + ",".join([f"'{p}'" for p in list_of_properties]) + ")"
-        query_where_clauses.append(properties_in_clause)
-
-    if len(query_where_clauses) != 0:
-        query += " WHERE " + " AND ".join(query_where_clauses)
-
-    data = execute_query(query)
-    return pd.DataFrame(data)
 
+def _build_profiles_query(list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_properties, columns=None):
+    query = Query("profiles", columns)
 
-def get_subhalos(list_of_subhalo_ids, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_inequality_filters, list_of_equality_filters):
-    query = """
-    SELECT
-    *
-    FROM subhalos
+    query.where_in("ID", list_of_halo_ids)
+    query.where_in("simulation_unique_id", list_of_simulation_ids)
+    query.where_in("snapshot", list_of_snapshots)
+    query.where_in("property_key", list_of_properties)
+
+    return query
+
+
+def _build_packed_profiles_query(list_of_halo_ids, list_of_simulation_ids, list_of_snapshots):
+    query = Query("profiles_packed", ["ID", "simulation_unique_id", "snapshot", "property_keys", "radius", "property_values"])
+
+    query.where_in("ID", list_of_halo_ids)
+    query.where_in("simulation_unique_id", list_of_simulation_ids)
+    query.where_in("snapshot", list_of_snapshots)
+
+    return query.set_order_by("simulation_unique_id", "snapshot", "ID")
+
+
+def iter_profiles(list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_properties, packed=False, chunk_size=100000, columns=None, physical_units=False, database=None):
+    """ Streaming variant of get_profiles
+    With packed=False, yields DataFrames of at most chunk_size values.
+    With packed=True, yields (halos, radii, profiles) tuples of at most chunk_size halos.
     """
+    if packed:
+        query = _build_packed_profiles_query(list_of_halo_ids, list_of_simulation_ids, list_of_snapshots)
+        for _, rows in query.iter_execute(chunk_size=chunk_size, database=database):
+            halos, radii, profiles, property_keys = _decode_packed_profiles(rows, list_of_properties)
+            yield profiles_to_physical_units(halos, radii, profiles, property_keys, database=database) if physical_units else (halos, radii, profiles)
+        return
 
-    query_where_clauses = []
-
-    if len(list_of_subhalo_ids) != 0:
-        subhalo_in_clause = "subhaloID IN (" + ",".join([f"'{h}'" for h in list_of_subhalo_ids]) + ")"
-        query_where_clauses.append(subhalo_in_clause)
-    if len(list_of_halo_ids) != 0:
-        halo_in_clause = "haloID IN (" + ",".join([f"'{h}'" for h in list_of_halo_ids]) + ")"
-        query_where_clauses.append(halo_in_clause)
-    if len(list_of_simulation_ids) != 0:
-        simulation_in_clause = "simulation_unique_id IN (" + ",".join([f"'{s}'" for s in list_of_simulation_ids]) + ")"
-        query_where_clauses.append(simulation_in_clause)
-    if len(list_of_snapshots) != 0:
-        snapshot_in_clause = "snapshot IN (" + ",".join([f"'{s}'" for s in list_of_snapshots]) + ")"
-        query_where_clauses.append(snapshot_in_clause)
-    
-    for (column_name, lower_limit, upper_limit) in list_of_inequality_filters:
-        if lower_limit is not None:
-            query_where_clauses.append(f"{column_name} >= {lower_limit}")
-        if upper_limit is not None:
-            query_where_clauses.append(f"{column_name} <= {upper_limit}")
+    query = _build_profiles_query(list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_properties, columns)
 
-    for (column_name, values) in list_of_equality_filters:
-        if isinstance(values[0], str):
-            values = [f"'{v}'" for v in values]
-        
-        query_where_clauses.append(f"{column_name} IN ({','.join(values)})")
+    for profiles in _iter_dataframes(query, chunk_size, database=database):
+        yield to_physical_units(profiles, database=database) if physical_units else profiles
 
-    if len(query_where_clauses) != 0:
-        query += " WHERE " + " AND ".join(query_where_clauses)
 
-    data = execute_query(query)
-    return pd.DataFrame(data)
+def _get_packed_profiles(list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_properties, database=None):
+    query = _build_packed_profiles_query(list_of_halo_ids, list_of_simulation_ids, list_of_snapshots)
 
-def get_mergertree(starting_subfind_id, starting_snapshot, simulation_unique_id):
-    # First, find the subhalo's "MainLeafProgenitorID", which marks the end of the tree
-    query = f"""
-    SELECT 
-    subhaloID, MainLeafProgenitorID
-    FROM mergertree
-    WHERE subfindID = {starting_subfind_id}
-    AND snapshot = {starting_snapshot}
-    AND simulation_unique_id = "{simulation_unique_id}"
+    def compute():
+        # A single chunk with all rows
+        rows = [row for _, chunk in query.iter_execute(chunk_size=None, database=database) for row in chunk]
+        return _decode_packed_profiles(rows, list_of_properties)
+
+    return _get_cached((query.cache_key, tuple(list_of_properties)), compute, database=database)
+
+
+def _decode_packed_profiles(rows, list_of_properties):
+    # rows: tuples of (ID, simulation_unique_id, snapshot, property_keys, radius, property_values)
+    # Returns (halos, radii, profiles, property keys of the rows of profiles)
+    halos = pd.DataFrame(
+        [row[:3] for row in rows],
+        columns=["ID", "simulation_unique_id", "snapshot"],
+    )
+    if len(rows) == 0:
+        return halos, np.empty((0, 0)), np.empty((0, len(list_of_properties), 0)), list(list_of_properties)
+
+    # An empty list_of_properties selects the stored properties (of the first halo, for all halos)
+    requested_keys = list(list_of_properties) if len(list_of_properties) != 0 else rows[0][3].split(",")
+
+    # Map requested properties to rows of the stored (properties x radial bins) matrices.
+    # All halos ingested from Illstack share the same keys, so this is usually computed once.
+    property_indices = {}
+    def get_property_indices(property_keys):
+        if property_keys not in property_indices:
+            stored_keys = property_keys.split(",")
+            property_indices[property_keys] = [stored_keys.index(k) for k in requested_keys]
+        return property_indices[property_keys]
+
+    radii = np.stack([row[4] for row in rows])
+    profiles = np.stack([
+        row[5][get_property_indices(row[3])]
+        for row in rows
+    ])
+
+    return halos, radii, profiles, requested_keys
+
+
+def _get_halo_profiles_columns(halo_columns, database=None):
+    # The joined queries always start with the halo keys
+    key_columns = ["ID", "simulation_unique_id", "snapshot"]
+    if halo_columns is None:
+        halo_columns = list((database or get_database()).get_column_types("halos").keys())
+    return key_columns + [c for c in halo_columns if c not in key_columns]
+
+
+def _build_halo_profiles_query(list_of_inequality_filters, list_of_equality_filters, list_of_properties, halo_columns, packed=False):
+    # halo_columns must start with ID, simulation_unique_id, snapshot
+    query = _build_halos_query(list_of_inequality_filters, list_of_equality_filters, halo_columns)
+
+    # The halos are the outer loop of the join (CROSS JOIN), with whichever index suits the filters,
+    # so that the rows of each halo come out together. There is no ORDER BY, which would sort (and
+    # buffer in the temp store) all joined rows before the first one is returned: the rows of each
+    # halo are sorted by _decode_joined_profiles instead.
+    if packed:
+        return query.join("profiles_packed", ["ID", "simulation_unique_id", "snapshot"], ["property_keys", "radius", "property_values"], cross=True)
+
+    query.join("profiles", ["ID", "simulation_unique_id", "snapshot"], ["property_key", "radius", "property_value"], cross=True)
+    query.where_in("property_key", list_of_properties, table_name="profiles")
+    return query
+
+
+def get_halo_profiles(list_of_inequality_filters, list_of_equality_filters, list_of_properties, halo_columns=None, packed=False, physical_units=False, database=None):
+    """ Fetch the halos selected by the filters (as in get_halos_based_on_filters) together with their
+    radial profiles, with a single query joining halos and profiles on (ID, simulation_unique_id, snapshot).
+    Returns a tuple (halos, radii, profiles):
+    - halos: DataFrame with the halo_columns (default: all) of each halo with profiles
+    - radii: ndarray with shape (halos, radial bins)
+    - profiles: dict of {property : ndarray with shape (halos, radial bins)}, aligned with the rows of halos
+    Missing values are NaN. With packed=True, the profiles are read from the profiles_packed table.
+    An empty list_of_properties selects all stored properties.
     """
+    halo_columns = _get_halo_profiles_columns(halo_columns, database=database)
+
+    query = _build_halo_profiles_query(list_of_inequality_filters, list_of_equality_filters, list_of_properties, halo_columns, packed)
+
+    def compute():
+        rows = [row for _, chunk in query.iter_execute(chunk_size=None, database=database) for row in chunk]
+        if packed:
+            return _decode_joined_packed_profiles(rows, halo_columns, list_of_properties)
+        return _decode_joined_profiles(rows, halo_columns, list_of_properties)
+
+    halos, radii, profiles = _get_cached((query.cache_key, tuple(list_of_properties), packed), compute, database=database)
+    return profiles_to_physical_units(halos, radii, profiles, database=database) if physical_units else (halos, radii, profiles)
+
+
+def iter_halo_profiles(list_of_inequality_filters, list_of_equality_filters, list_of_properties, halo_columns=None, packed=False, chunk_size=10000, physical_units=False, database=None):
+    """ Streaming variant of get_halo_profiles, yielding (halos, radii, profiles) tuples of at most chunk_size halos """
+    for halos, radii, profiles in _iter_halo_profiles(list_of_inequality_filters, list_of_equality_filters, list_of_properties, halo_columns, packed, chunk_size, database=database):
+        yield profiles_to_physical_units(halos, radii, profiles, database=database) if physical_units else (halos, radii, profiles)
+
+
+def _iter_halo_profiles(list_of_inequality_filters, list_of_equality_filters, list_of_properties, halo_columns, packed, chunk_size, database=None):
+    halo_columns = _get_halo_profiles_columns(halo_columns, database=database)
+
+    query = _build_halo_profiles_query(list_of_inequality_filters, list_of_equality_filters, list_of_properties, halo_columns, packed)
+
+    if packed:
+        for _, rows in query.iter_execute(chunk_size=chunk_size, database=database):
+            yield _decode_joined_packed_profiles(rows, halo_columns, list_of_properties)
+        return
+
+    # The rows of a halo may be split across fetched chunks, so only complete halos are decoded
+    buffer = []
+    for _, rows in query.iter_execute(chunk_size=100000, database=database):
+        buffer.extend(rows)
+        halo_starts = _get_halo_starts(buffer)
+        # The last halo of the buffer may be incomplete
+        while len(halo_starts) > chunk_size:
+            end = halo_starts[chunk_size]
+            yield _decode_joined_profiles(buffer[:end], halo_columns, list_of_properties)
+            buffer = buffer[end:]
+            halo_starts = halo_starts[chunk_size:] - end
 
-    starting_data = execute_query(query)[0]
+    if len(buffer) != 0:
+        yield _decode_joined_profiles(buffer, halo_columns, list_of_properties)
+
+
+def _get_halo_starts(rows):
+    # Index of the first row of each halo, for rows starting with (ID, simulation_unique_id, snapshot), with the rows of each halo together
+    if len(rows) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.flatnonzero(_get_new_halo_mask(rows))
+
+def _get_new_halo_mask(rows):
+    ids = np.array([row[0] for row in rows])
+    simulation_ids = np.array([row[1] for row in rows], dtype=object)
+    snapshots = np.array([row[2] for row in rows])
+
+    new_halo = np.ones(len(rows), dtype=bool)
+    new_halo[1:] = (ids[1:] != ids[:-1]) | (simulation_ids[1:] != simulation_ids[:-1]) | (snapshots[1:] != snapshots[:-1])
+    return new_halo
+
+
+def _decode_joined_packed_profiles(rows, halo_columns, list_of_properties):
+    # rows: halo columns, then property_keys, radius, property_values
+    halos = pd.DataFrame([row[:len(halo_columns)] for row in rows], columns=halo_columns)
+
+    _, radii, profiles, property_keys = _decode_packed_profiles([row[:3] + row[-3:] for row in rows], list_of_properties)
+    return halos, radii, {k : profiles[:, i] for i, k in enumerate(property_keys)}
+
+
+def _decode_joined_profiles(rows, halo_columns, list_of_properties):
+    # rows: halo columns, then property_key, radius, property_value,
+    # with the rows of each halo together (in any order)
+    if len(rows) == 0:
+        halos = pd.DataFrame([], columns=halo_columns)
+        return halos, np.empty((0, 0)), {k : np.empty((0, 0)) for k in list_of_properties}
+
+    property_keys = np.array([row[-3] for row in rows], dtype=object)
+    radius = np.array([row[-2] for row in rows], dtype=float)
+    values = np.array([row[-1] for row in rows], dtype=float)
+
+    # Index of the halo of each row
+    new_halo = _get_new_halo_mask(rows)
+    halo_index = np.cumsum(new_halo) - 1
+
+    # Sort the rows of each halo by property_key and radius
+    _, key_codes = np.unique(property_keys, return_inverse=True)
+    order = np.lexsort((radius, key_codes, halo_index))
+    property_keys, radius, values = property_keys[order], radius[order], values[order]
+
+    # Radial bin of each row, i.e. its position in its (halo, property) group
+    new_group = new_halo.copy()
+    new_group[1:] |= property_keys[1:] != property_keys[:-1]
+    group_starts = np.flatnonzero(new_group)
+    bin_index = np.arange(len(rows)) - group_starts[np.cumsum(new_group) - 1]
+
+    halos = pd.DataFrame([rows[i][:len(halo_columns)] for i in np.flatnonzero(new_halo)], columns=halo_columns)
+
+    shape = (len(halos), bin_index.max() + 1)
+    radii = np.full(shape, np.nan)
+    radii[halo_index, bin_index] = radius
+
+    if len(list_of_properties) == 0:
+        list_of_properties = sorted(set(property_keys))
+
+    profiles = {}
+    for k in list_of_properties:
+        mask = property_keys == k
+        profiles[k] = np.full(shape, np.nan)
+        profiles[k][halo_index[mask], bin_index[mask]] = values[mask]
+
+    return halos, radii, profiles
+
+
+def _build_subhalos_query(list_of_subhalo_ids, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_inequality_filters, list_of_equality_filters, columns=None, lazy_array_columns=()):
+    query = Query("subhalos", columns, lazy_array_columns)
+
+    query.where_in("subhaloID", list_of_subhalo_ids)
+    query.where_in("haloID", list_of_halo_ids)
+    query.where_in("simulation_unique_id", list_of_simulation_ids)
+    query.where_in("snapshot", list_of_snapshots)
+
+    return _add_filters(query, list_of_inequality_filters, list_of_equality_filters)
+
+
+def get_subhalos(list_of_subhalo_ids, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_inequality_filters, list_of_equality_filters, columns=None, lazy_arrays=False, physical_units=False, database=None):
+    columns, lazy_array_columns = _get_lazy_array_columns("subhalos", columns, lazy_arrays, database=database)
+    query = _build_subhalos_query(list_of_subhalo_ids, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_inequality_filters, list_of_equality_filters, columns, lazy_array_columns)
+
+    subhalos = _get_dataframe(query, lazy_array_columns, database=database)
+    return to_physical_units(subhalos, database=database) if physical_units else subhalos
+
+
+def iter_subhalos(list_of_subhalo_ids, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_inequality_filters, list_of_equality_filters, chunk_size=10000, columns=None, lazy_arrays=False, physical_units=False, database=None):
+    columns, lazy_array_columns = _get_lazy_array_columns("subhalos", columns, lazy_arrays, database=database)
+    query = _build_subhalos_query(list_of_subhalo_ids, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_inequality_filters, list_of_equality_filters, columns, lazy_array_columns)
+
+    for subhalos in _iter_dataframes(query, chunk_size, lazy_array_columns, database=database):
+        yield to_physical_units(subhalos, database=database) if physical_units else subhalos
+
+
+def _build_mergertree_start_query(starting_subfind_id, starting_snapshot, simulation_unique_id):
+    # Finds the subhalo's "MainLeafProgenitorID", which marks the end of the tree
+    query = Query("mergertree", ["subhaloID", "MainLeafProgenitorID"])
+
+    query.where_equal("subfindID", int(starting_subfind_id))
+    query.where_equal("snapshot", int(starting_snapshot))
+    query.where_equal("simulation_unique_id", simulation_unique_id)
+
+    return query
+
+
+def _build_mergertree_query(starting_subhalo_id, main_leaf_progenitor_id, simulation_unique_id):
+    # Finds the entire tree between the subfindID and the MainLeafProgenitorID
+    query = Query("mergertree")
+
+    query.where_range("subhaloID", int(starting_subhalo_id), int(main_leaf_progenitor_id))
+    query.where_equal("simulation_unique_id", simulation_unique_id)
+
+    query.order_by = "mergertree.snapshot DESC"
+
+    return query
+
+
+def get_mergertree(starting_subfind_id, starting_snapshot, simulation_unique_id, database=None):
+    key = ("get_mergertree", int(starting_subfind_id), int(starting_snapshot), simulation_unique_id)
+
+    return _get_cached(key, lambda: _get_mergertree(starting_subfind_id, starting_snapshot, simulation_unique_id, database=database), database=database)
+
+def _get_mergertree(starting_subfind_id, starting_snapshot, simulation_unique_id, database=None):
+    # First, find the subhalo's "MainLeafProgenitorID", which marks the end of the tree
+    query = _build_mergertree_start_query(starting_subfind_id, starting_snapshot, simulation_unique_id)
+
+    starting_data = query.execute(database=database)[0]
     main_leaf_progenitor_id = starting_data["MainLeafProgenitorID"]
     starting_subhalo_id = starting_data["subhaloID"]
 
     # Then, find the entire tree between the subfindID and the MainLeafProgenitorID
-    query = f"""
-    SELECT 
-    *
-    FROM mergertree
-    WHERE subhaloID >= {starting_subhalo_id} and subhaloID <= {main_leaf_progenitor_id}
-    AND simulation_unique_id = "{simulation_unique_id}"
-    ORDER BY snapshot DESC
-    """
+    query = _build_mergertree_query(starting_subhalo_id, main_leaf_progenitor_id, simulation_unique_id)
 
-    data = execute_query(query)
+    data = query.execute(database=database)
     return pd.DataFrame(data)
 
 if __name__ == "__main__":
@@ -152,21 +440,57 @@ if __name__ == "__main__":
     )
     print(halos)
     
-    profiles = get_profiles(
+    # The profiles are stored in the profiles table, the profiles_packed table or both (see --profile_layout of create_empty_database.py)
+    from index_helpers import get_existing_tables
+    existing_tables = get_existing_tables()
+
+    if "profiles" in existing_tables:
+        profiles = get_profiles(
+            list_of_halo_ids=[0, 1],
+            list_of_simulation_ids=["IllustrisTNG_1P_22", "sample ID 2"],
+            list_of_snapshots=[33],
+            list_of_properties=["gas_density"]
+        )
+        print(profiles)
+
+        for profiles_chunk in iter_profiles(
+            list_of_halo_ids=[],
+            list_of_simulation_ids=["IllustrisTNG_1P_22"],
+            list_of_snapshots=[33],
+            list_of_properties=["gas_density"],
+            chunk_size=5000,
+        ):
+            print(len(profiles_chunk))
+
+    if "profiles_packed" in existing_tables:
+        halos, radii, packed_profiles = get_profiles(
+            list_of_halo_ids=[0, 1],
+            list_of_simulation_ids=["IllustrisTNG_1P_22", "sample ID 2"],
+            list_of_snapshots=[33],
+            list_of_properties=["gas_density", "temperature"],
+            packed=True,
+        )
+        print(halos, radii.shape, packed_profiles.shape)
+
+    subhalos = get_subhalos(
+        list_of_subhalo_ids=[290],
         list_of_halo_ids=[0, 1],
-        list_of_simulation_ids=["IllustrisTNG_1P_22", "sample ID 2"],
+        list_of_simulation_ids=["IllustrisTNG_1P_22"],
         list_of_snapshots=[33],
-        list_of_properties=["gas_density"]
+        list_of_inequality_filters=[],
+        list_of_equality_filters=[]
     )
-    print(profiles)
+    print(subhalos)
 
     subhalos = get_subhalos(
-        list_of_subhalo_ids=[290],
+        list_of_subhalo_ids=[],
         list_of_halo_ids=[0, 1],
         list_of_simulation_ids=["IllustrisTNG_1P_22"],
         list_of_snapshots=[33],
         list_of_inequality_filters=[],
-        list_of_equality_filters=[]
+        list_of_equality_filters=[],
+        columns=["subhaloID", "SubhaloMass", "SubhaloPos"],
+        lazy_arrays=True,
     )
     print(subhalos)
 
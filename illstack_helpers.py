@@ -1,4 +1,9 @@
+from itertools import repeat
 import numpy as np
+import os
+import zipfile
+
+from manifest_helpers import get_content_hash
 
 # List of properties
 global_properties_list = ['ID', 'M_Crit200', 'R_Crit200', 'GroupFirstSub', 'sfr', 'mstar', 'GroupBHMass', 'GroupBHMdot', 'Group_GasH', 'Group_GasHe', 'Group_GasC', 'Group_GasN', 'Group_GasO', 'Group_GasNe', 'Group_GasMg', 'Group_GasSi', 'Group_GasFe', 'GroupGasMetallicity', 'GroupLen', 'GroupMass', 'GroupNsubs', 'Group_StarH', 'Group_StarHe', 'Group_StarC', 'Group_StarN', 'Group_StarO', 'Group_StarNe', 'Group_StarMg', 'Group_StarSi', 'Group_StarFe', 'GroupStarMetallicity', 'GroupVelx', 'GroupVely', 'GroupVelz', 'GroupWindMass', 'M_Crit500', 'M_Mean200', 'M_TopHat200', 'R_Crit500', 'R_Mean200', 'R_TopHat200']
@@ -6,30 +11,262 @@ global_properties_list = ['ID', 'M_Crit200', 'R_Crit200', 'GroupFirstSub', 'sfr'
 profile_properties_key = "val"
 profile_properties_list = ["gas_density", "gas_pressure", "metallicity", "temperature"] # data["val"] is a 3D array (profile_type, value, radial bin). This is the list of profile types
 
-def get_illstack_global_properties(profile_filename):
+def get_simulation_details_from_profile_filename(profile_filename):
+    """ Determine simulation details from the filename
+    Filenames: "simulationsuite_simulationname_snapshot.npz", e.g. "IllustrisTNG_1P_22_033.npz"
+    Important! This assumes that all simulation names contain an underscore. E.g. "1P_22"
+    Returns (simulation_suite, simulation_name, snapshot, simulation_unique_id)
+    """
+    simulation_details = os.path.basename(profile_filename).split("_")
+
+    simulation_suite = simulation_details[0]
+    simulation_name = f"{simulation_details[1]}_{simulation_details[2]}" # Assumes all simulation names have an underscore in them
+    snapshot = int(simulation_details[3].replace(".npz", ""))
+    simulation_unique_id = f"{simulation_suite}_{simulation_name}"
+
+    return simulation_suite, simulation_name, snapshot, simulation_unique_id
+
+
+####################
+# Loading Illstack files
+# np.load reads the arrays of a .npz file lazily, so only the requested keys are read. The profile
+# arrays ("val", "n") are pickled object arrays, which are converted to numeric arrays when loaded.
+# With a cache_directory, the loaded arrays are also saved there as uncompressed .npy files, in a
+# directory per content hash of the source file. Later loads memory-map them instead of unpickling
+# the .npz file again (e.g. when ingesting a file again, or inferring a schema from it).
+
+# Types of global properties stored as INTEGER (other types are stored as REAL)
+integer_dtypes = [np.dtype(t) for t in (np.uint32, np.int16, np.int32, np.int64)]
+
+def _to_numeric_array(array):
+    # Object arrays of numbers (e.g. "val") are converted to float64 or int64 arrays
+    if array.dtype.hasobject:
+        converted = np.array(array.tolist())
+        if not converted.dtype.hasobject:
+            return converted
+    return array
+
+def _save_cached_array(filename, array):
+    # Written to a temporary file first, so that concurrent loaders never read partial files
+    np.save(f"{filename}.tmp{os.getpid()}.npy", array)
+    os.replace(f"{filename}.tmp{os.getpid()}.npy", filename)
+
+def load_illstack_arrays(profile_filename, keys, cache_directory=None, content_hash=None):
+    """ Load the given keys of an Illstack .npz file (keys missing from the file are skipped), in a single open
+    cache_directory: optional directory of decoded arrays (see above)
+    content_hash: content hash of the file (see manifest_helpers.get_content_hash), computed if not given
+    """
+    arrays = {}
+    cache_path = None
+    if cache_directory is not None:
+        cache_path = os.path.join(cache_directory, content_hash or get_content_hash(profile_filename))
+        for k in keys:
+            if os.path.exists(os.path.join(cache_path, f"{k}.npy")):
+                arrays[k] = np.load(os.path.join(cache_path, f"{k}.npy"), mmap_mode="r")
+
+    missing_keys = [k for k in keys if k not in arrays]
+    if cache_path is not None:
+        # Keys known to be missing from the file
+        missing_keys = [k for k in missing_keys if not os.path.exists(os.path.join(cache_path, f"{k}.missing"))]
+    if len(missing_keys) == 0:
+        return arrays
+
     with np.load(profile_filename, allow_pickle=True) as f:
-        data = dict(f)
+        file_keys = set(f.files)
+        for k in missing_keys:
+            if k in file_keys:
+                arrays[k] = _to_numeric_array(f[k])
+
+    if cache_path is not None:
+        os.makedirs(cache_path, exist_ok=True)
+        for k in missing_keys:
+            if k not in file_keys:
+                open(os.path.join(cache_path, f"{k}.missing"), "w").close()
+            elif not arrays[k].dtype.hasobject:
+                _save_cached_array(os.path.join(cache_path, f"{k}.npy"), arrays[k])
+
+    return arrays
+
+def get_illstack_dtypes(profile_filename, keys):
+    """ {key : dtype} of the arrays of an Illstack .npz file, read from the .npy headers (without loading the arrays)
+    For object arrays, the dtype is the one of the converted numeric array, which requires loading the array.
+    """
+    dtypes = {}
+    with zipfile.ZipFile(profile_filename) as archive:
+        for name in archive.namelist():
+            k = name[:-len(".npy")]
+            if k not in keys:
+                continue
+            with archive.open(name) as f:
+                version = np.lib.format.read_magic(f)
+                read_array_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+                _, _, dtypes[k] = read_array_header(f)
+
+    object_keys = [k for k, dtype in dtypes.items() if dtype.hasobject]
+    if len(object_keys) != 0:
+        dtypes.update({k : array.dtype for k, array in load_illstack_arrays(profile_filename, object_keys).items()})
+    return {k : dtypes[k] for k in keys if k in dtypes}
+
+def load_illstack_file(profile_filename, cache_directory=None, content_hash=None):
+    """ Load the global properties, radial bins and profiles of an Illstack file, in a single open
+    Returns (global_properties_dict, radial_bins, profile_properties_dict), see the functions below.
+    """
+    arrays = load_illstack_arrays(profile_filename, global_properties_list + ["r", profile_properties_key], cache_directory, content_hash)
+
+    global_properties_dict = {
+        k : arrays[k]
+        for k in global_properties_list
+        if k in arrays
+    }
+    profile_properties_dict = {
+        profile_type : arrays[profile_properties_key][i,:]
+        for i, profile_type in enumerate(profile_properties_list)
+    }
+
+    return global_properties_dict, arrays["r"], profile_properties_dict
+
+def get_illstack_global_properties(profile_filename, cache_directory=None):
+    arrays = load_illstack_arrays(profile_filename, global_properties_list, cache_directory)
 
     global_properties_dict = {
-        k : data[k]
+        k : arrays[k]
         for k in global_properties_list
-        if k in data.keys()
+        if k in arrays
     }
 
     return global_properties_dict
 
 
-def get_illstack_profile_properties(profile_filename):
-    with np.load(profile_filename, allow_pickle=True) as f:
-        data = dict(f)
+def get_illstack_profile_properties(profile_filename, cache_directory=None):
+    arrays = load_illstack_arrays(profile_filename, ["r", profile_properties_key], cache_directory)
 
-    radial_bins = data["r"] # List of length 25 (25 == data["nbins"])
+    radial_bins = arrays["r"] # List of length 25 (25 == data["nbins"])
 
     profile_properties_dict = {
-        profile_type : data[profile_properties_key][i,:]
+        profile_type : arrays[profile_properties_key][i,:]
         for i, profile_type in enumerate(profile_properties_list)
     }
 
-    print(profile_properties_dict)
-
     return radial_bins, profile_properties_dict
+
+
+####################
+# Helpers for building database rows from Illstack arrays
+
+def iter_illstack_halo_rows(global_properties_dict, simulation_unique_id, snapshot, batch_size=10000):
+    """ Yield batches of rows for the halos table
+    Each row is (simulation_unique_id, snapshot, *global properties), with the
+    global properties in the order of global_properties_dict.keys()
+    """
+    columns = [np.asarray(v) for v in global_properties_dict.values()]
+    number_halos = len(columns[0])
+
+    for start in range(0, number_halos, batch_size):
+        stop = min(start + batch_size, number_halos)
+        yield list(zip(
+            repeat(simulation_unique_id),
+            repeat(snapshot),
+            *[c[start:stop].tolist() for c in columns],
+        ))
+
+
+def iter_illstack_profile_rows(halo_ids, radial_bins, profile_properties_dict, simulation_unique_id, snapshot, batch_size=100000):
+    """ Yield batches of rows for the profiles table
+    Each row is (ID, simulation_unique_id, snapshot, radius, property_key, property_value),
+    ordered by halo, then radial bin, then property.
+    batch_size is the (approximate) number of rows per batch; batches always contain whole halos.
+    """
+    property_keys = np.array(list(profile_properties_dict.keys()))
+    # (halo, radial bin, property)
+    values = np.stack(
+        [np.asarray(v, dtype=np.float64) for v in profile_properties_dict.values()],
+        axis=-1,
+    )
+    halo_ids = np.asarray(halo_ids)
+    radial_bins = np.asarray(radial_bins, dtype=np.float64)
+
+    number_halos, number_bins, number_properties = values.shape
+    halos_per_batch = max(1, batch_size // (number_bins * number_properties))
+
+    for start in range(0, number_halos, halos_per_batch):
+        stop = min(start + halos_per_batch, number_halos)
+        shape = (stop - start, number_bins, number_properties)
+
+        ids = np.broadcast_to(halo_ids[start:stop, None, None], shape)
+        radii = np.broadcast_to(radial_bins[None, :, None], shape)
+        keys = np.broadcast_to(property_keys[None, None, :], shape)
+
+        yield list(zip(
+            ids.ravel().tolist(),
+            repeat(simulation_unique_id),
+            repeat(snapshot),
+            radii.ravel().tolist(),
+            keys.ravel().tolist(),
+            values[start:stop].ravel().tolist(),
+        ))
+
+
+def iter_illstack_packed_profile_rows(halo_ids, radial_bins, profile_properties_dict, simulation_unique_id, snapshot, batch_size=10000):
+    """ Yield batches of rows for the profiles_packed table
+    Each row is (ID, simulation_unique_id, snapshot, property_keys, radius, property_values),
+    where property_values is a (properties x radial bins) array.
+    batch_size is the number of halos per batch.
+    """
+    property_keys = ",".join(profile_properties_dict.keys())
+    # (halo, property, radial bin)
+    values = np.ascontiguousarray(np.stack(
+        [np.asarray(v, dtype=np.float64) for v in profile_properties_dict.values()],
+        axis=1,
+    ))
+    halo_ids = np.asarray(halo_ids)
+    radial_bins = np.asarray(radial_bins, dtype=np.float64)
+
+    number_halos = len(values)
+
+    for start in range(0, number_halos, batch_size):
+        stop = min(start + batch_size, number_halos)
+        yield list(zip(
+            halo_ids[start:stop].tolist(),
+            repeat(simulation_unique_id),
+            repeat(snapshot),
+            repeat(property_keys),
+            repeat(radial_bins),
+            values[start:stop],
+        ))
+
+
+def iter_illstack_table_batches(profile_filename, profile_layout="rows", batch_size=100000, cache_directory=None, content_hash=None):
+    """ Yield (table_name, columns, rows) for all rows to be inserted from one Illstack file
+    profile_layout: "rows", "packed" or "both", see create_empty_database.py
+    cache_directory, content_hash: see load_illstack_arrays
+    """
+    illstack_arrays = load_illstack_file(profile_filename, cache_directory, content_hash)
+
+    yield from iter_illstack_table_batches_from_arrays(profile_filename, illstack_arrays, profile_layout, batch_size=batch_size)
+
+
+def iter_illstack_table_batches_from_arrays(profile_filename, illstack_arrays, profile_layout="rows", batch_size=100000):
+    """ Same as iter_illstack_table_batches, for the arrays already loaded from the file
+    illstack_arrays: (global_properties_dict, radial_bins, profile_properties_dict), see load_illstack_file
+    """
+    _, _, snapshot, simulation_unique_id = get_simulation_details_from_profile_filename(profile_filename)
+
+    global_properties, radial_bins, profile_properties = illstack_arrays
+    halo_ids = global_properties["ID"]
+
+    ### halos
+    halos_columns = ["simulation_unique_id", "snapshot"] + list(global_properties.keys())
+    for rows in iter_illstack_halo_rows(global_properties, simulation_unique_id, snapshot, batch_size=batch_size):
+        yield "halos", halos_columns, rows
+
+    ### profiles
+    if profile_layout in ("rows", "both"):
+        profiles_columns = ["ID", "simulation_unique_id", "snapshot", "radius", "property_key", "property_value"]
+        for rows in iter_illstack_profile_rows(halo_ids, radial_bins, profile_properties, simulation_unique_id, snapshot, batch_size=batch_size):
+            yield "profiles", profiles_columns, rows
+
+    ### profiles_packed
+    if profile_layout in ("packed", "both"):
+        profiles_packed_columns = ["ID", "simulation_unique_id", "snapshot", "property_keys", "radius", "property_values"]
+        for rows in iter_illstack_packed_profile_rows(halo_ids, radial_bins, profile_properties, simulation_unique_id, snapshot):
+            yield "profiles_packed", profiles_packed_columns, rows
@@ -0,0 +1,172 @@
+# Helpers for loading data from the CAMELS simulation outputs with illustris_python
+# Should be executed in an environment with the following files available:
+# offsets and postprocessing folders
+from itertools import repeat
+import h5py
+import numpy as np
+import sys
+sys.path.append("/home/jovyan")
+import illustris_python as il
+
+# Properties motivated by https://www.tng-project.org/data/docs/specifications/#sec2b
+subhalo_fields = ["SubhaloBHMass", "SubhaloBHMdot", "SubhaloBfldDisk", "SubhaloBfldHalo", "SubhaloCM", "SubhaloGasMetalFractions", "SubhaloGasMetalFractionsHalfRad", "SubhaloGasMetalFractionsMaxRad", "SubhaloGasMetalFractionsSfr", "SubhaloGasMetalFractionsSfrWeighted", "SubhaloGasMetallicity", "SubhaloGasMetallicityHalfRad", "SubhaloGasMetallicityMaxRad", "SubhaloGasMetallicitySfr", "SubhaloGasMetallicitySfrWeighted", "SubhaloGrNr", "SubhaloHalfmassRad", "SubhaloHalfmassRadType", "SubhaloIDMostbound", "SubhaloLen", "SubhaloLenType", "SubhaloMass", "SubhaloMassInHalfRad", "SubhaloMassInHalfRadType", "SubhaloMassInMaxRad", "SubhaloMassInMaxRadType", "SubhaloMassInRad", "SubhaloMassInRadType", "SubhaloMassType", "SubhaloParent", "SubhaloPos", "SubhaloSFR", "SubhaloSFRinHalfRad", "SubhaloSFRinMaxRad", "SubhaloSFRinRad", "SubhaloSpin", "SubhaloStarMetalFractions", "SubhaloStarMetalFractionsHalfRad", "SubhaloStarMetalFractionsMaxRad", "SubhaloStarMetallicity", "SubhaloStarMetallicityHalfRad", "SubhaloStarMetallicityMaxRad", "SubhaloStellarPhotometrics", "SubhaloStellarPhotometricsMassInRad", "SubhaloStellarPhotometricsRad", "SubhaloVel", "SubhaloVelDisp", "SubhaloVmax", "SubhaloVmaxRad", "SubhaloWindMass"]
+
+# Columns of the subhalos table, in the order of the rows built by get_subhalo_rows
+# "SubhaloGrNr" is stored as "haloID"
+subhalos_columns = ["subhaloID", "haloID", "simulation_unique_id", "snapshot"] + [f for f in subhalo_fields if f != "SubhaloGrNr"]
+
+
+def get_simulation_basepath(basepath, simulation_suite, simulation_name):
+    return f"{basepath}/{simulation_suite}/{simulation_name}/" # e.g. /home/jovyan/Simulations/IllustrisTNG/LH_0/
+
+def load_subhalos(simulation_basepath, snapshot, fields=subhalo_fields):
+    """ Load the whole subhalo catalog of a snapshot """
+    return il.groupcat.loadSubhalos(simulation_basepath, snapshot, fields=fields)
+
+def load_redshift(simulation_basepath, snapshot):
+    """ Redshift of a snapshot, from the header of its group catalog """
+    return il.groupcat.loadHeader(simulation_basepath, snapshot)["Redshift"]
+
+
+def get_subhalo_rows(subhalos, subhalo_ids, simulation_unique_id, snapshot):
+    """ Rows for the subhalos table, for the given subhalo indices of a loaded subhalo catalog """
+    subhalo_ids = np.asarray(subhalo_ids, dtype=np.int64)
+
+    columns = []
+    for field in subhalos_columns[4:]:
+        values = subhalos[field][subhalo_ids]
+        # Vector fields are stored as ARRAY (one 1D array per row), scalar fields as plain Python numbers
+        columns.append(list(values) if values.ndim > 1 else values.tolist())
+
+    return list(zip(
+        subhalo_ids.tolist(), # subhaloID
+        subhalos["SubhaloGrNr"][subhalo_ids].tolist(), # haloID
+        repeat(simulation_unique_id), # simulation_unique_id
+        repeat(snapshot), # Snapshot Number
+        *columns,
+    ))
+
+def get_subhalo_ids_by_halo(subhalo_halo_ids, halo_ids):
+    """ Indices of the subhalos belonging to any of the given FoF halos
+    subhalo_halo_ids: "SubhaloGrNr" of all subhalos of a catalog
+    Uses a single sort of the catalog, instead of one mask per halo.
+    """
+    subhalo_halo_ids = np.asarray(subhalo_halo_ids)
+    halo_ids = np.unique(np.asarray(halo_ids))
+
+    order = np.argsort(subhalo_halo_ids, kind="stable")
+    sorted_halo_ids = subhalo_halo_ids[order]
+
+    starts = np.searchsorted(sorted_halo_ids, halo_ids, side="left")
+    stops = np.searchsorted(sorted_halo_ids, halo_ids, side="right")
+
+    return np.concatenate([order[start:stop] for start, stop in zip(starts, stops)] + [np.empty(0, dtype=order.dtype)])
+
+
+# Properties motivated by https://www.tng-project.org/data/docs/specifications/#sec4a
+mergertree_additional_fields = ["LastProgenitorID", "MainLeafProgenitorID", "RootDescendantID", "TreeID", "FirstProgenitorID", "NextProgenitorID", "DescendantID", "FirstSubhaloInFOFGroupID", "NextSubhaloInFOFGroupID", "NumParticles", "Mass", "MassHistory"]
+mergertree_fields = ["SubhaloID", "SubfindID", "SnapNum"] + mergertree_additional_fields
+
+# Columns of the mergertree table, in the order of the rows built by get_mergertree_rows
+mergertree_columns = ["simulation_unique_id", "snapshot", "subhaloID", "subfindID"] + mergertree_additional_fields
+
+
+def load_tree(simulation_basepath, snapshot, subfind_id, fields=mergertree_fields):
+    """ Load the full SubLink tree (all progenitors) of a subhalo, or None if the subhalo is not in the tree """
+    return il.sublink.loadTree(simulation_basepath, snapshot, subfind_id, fields=fields, onlyMPB=False)
+
+def get_mergertree_rows(tree, simulation_unique_id):
+    """ Rows for the mergertree table, from a tree loaded with load_tree """
+    return list(zip(
+        repeat(simulation_unique_id),
+        tree["SnapNum"].tolist(),
+        tree["SubhaloID"].tolist(),
+        tree["SubfindID"].tolist(),
+        *[tree[field].tolist() for field in mergertree_additional_fields],
+    ))
+
+
+def get_tree_ranges(simulation_basepath, snapshots, subfind_ids):
+    """ Depth-first ID range [SubhaloID, LastProgenitorID] of the tree of each (snapshot, subfindID),
+    and the row number (RowNum) of its first row in the SubLink files.
+    Only reads the SubLink offsets, not the trees. Subhalos not in the tree get the range (-1, -1) and row -1.
+    Returns (tree_subhalo_ids, tree_last_progenitor_ids, tree_row_numbers)
+    """
+    tree_subhalo_ids = np.full(len(subfind_ids), -1, dtype=np.int64)
+    tree_last_progenitor_ids = np.full(len(subfind_ids), -1, dtype=np.int64)
+    tree_row_numbers = np.full(len(subfind_ids), -1, dtype=np.int64)
+
+    for i, (snapshot, subfind_id) in enumerate(zip(snapshots, subfind_ids)):
+        row_number, last_progenitor_id, subhalo_id = il.sublink.treeOffsets(simulation_basepath, int(snapshot), int(subfind_id), "SubLink")
+        if row_number == -1:
+            continue
+        tree_subhalo_ids[i] = subhalo_id
+        tree_last_progenitor_ids[i] = last_progenitor_id
+        tree_row_numbers[i] = row_number
+
+    return tree_subhalo_ids, tree_last_progenitor_ids, tree_row_numbers
+
+def iter_trees(simulation_basepath, tree_subhalo_ids, tree_last_progenitor_ids, tree_row_numbers, fields=mergertree_fields, max_window_rows=2**20):
+    """ Yield (index, tree) for the trees found by get_tree_ranges (which must all be in the tree),
+    with tree as returned by load_tree. Trees are yielded in the order of their rows in the SubLink files.
+    load_tree opens the SubLink files for each tree. Instead, the trees of a SubLink file are grouped
+    into windows of contiguous rows, and the fields of each window are read at once and sliced into
+    its trees. Windows span at most max_window_rows rows (or one tree, for larger trees), which
+    bounds the memory used.
+    """
+    if len(tree_row_numbers) == 0:
+        return
+    offsets = il.sublink.subLinkOffsets(simulation_basepath, "SubLink")
+
+    row_starts = np.asarray(tree_row_numbers, dtype=np.int64)
+    row_stops = row_starts + (np.asarray(tree_last_progenitor_ids) - np.asarray(tree_subhalo_ids)) + 1
+    # SubLink file of each tree. A tree is never split across files.
+    file_numbers = np.searchsorted(offsets, row_starts, side="right") - 1
+
+    order = np.lexsort((row_starts, file_numbers))
+    for indices in _get_tree_windows(order, file_numbers, row_starts, row_stops, max_window_rows):
+        file_number = file_numbers[indices[0]]
+        # Rows of the file covering all the trees of the window
+        start = row_starts[indices[0]] - offsets[file_number]
+        stop = row_stops[indices].max() - offsets[file_number]
+        with h5py.File(il.sublink.treePath(simulation_basepath, "SubLink", file_number), "r") as f:
+            window_fields = {field : f[field][start:stop] for field in fields}
+
+        for i in indices:
+            tree_start = row_starts[i] - offsets[file_number] - start
+            tree_stop = row_stops[i] - offsets[file_number] - start
+            tree = {field : values[tree_start:tree_stop] for field, values in window_fields.items()}
+            tree["count"] = int(tree_stop - tree_start)
+            yield i, tree
+
+def _get_tree_windows(order, file_numbers, row_starts, row_stops, max_window_rows):
+    # Split the trees, sorted by (file, first row), into windows of the same file spanning at most max_window_rows rows
+    windows = []
+    window = [order[0]]
+    window_stop = row_stops[order[0]]
+    for i in order[1:]:
+        if file_numbers[i] != file_numbers[window[0]] or max(window_stop, row_stops[i]) - row_starts[window[0]] > max_window_rows:
+            windows.append(window)
+            window, window_stop = [], row_stops[i]
+        window.append(i)
+        window_stop = max(window_stop, row_stops[i])
+    windows.append(window)
+    return [np.array(w) for w in windows]
+
+def get_root_trees(tree_subhalo_ids, tree_last_progenitor_ids):
+    """ Indices of the trees that are not contained in the depth-first ID range of another tree
+    Depth-first ranges are either nested or disjoint, so after sorting by SubhaloID
+    (and the largest range first), a tree is contained in another tree if it starts
+    before the end of any of the previous ranges.
+    """
+    tree_subhalo_ids = np.asarray(tree_subhalo_ids)
+    tree_last_progenitor_ids = np.asarray(tree_last_progenitor_ids)
+
+    valid = np.flatnonzero(tree_subhalo_ids >= 0)
+    order = valid[np.lexsort((-tree_last_progenitor_ids[valid], tree_subhalo_ids[valid]))]
+
+    range_ends = np.maximum.accumulate(tree_last_progenitor_ids[order])
+    is_root = np.ones(len(order), dtype=bool)
+    is_root[1:] = tree_subhalo_ids[order][1:] > range_ends[:-1]
+
+    return order[is_root]
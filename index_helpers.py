@@ -0,0 +1,137 @@
+# Secondary indexes for the access patterns of filter_data_helpers.py
+# The UNIQUE constraints of create_empty_database.py only cover lookups by full key.
+# The indexes below cover the filters used by the query helpers, so that they do not
+# need to scan whole tables.
+#
+# For bulk loads, create the database with --defer_indexes (or drop the indexes),
+# load the data, and build the indexes once at the end:
+#   python index_helpers.py -f sample.db --build
+# To see which indexes each helper query uses:
+#   python index_helpers.py -f sample.db --report
+import argparse
+
+from database_helpers import set_database_filename, execute_query, get_database
+
+# index name : (table name, list of columns)
+# Indexes with trailing non-filtered columns are covering indexes for the common projections,
+# i.e. the query can be answered from the index without reading the table rows.
+SECONDARY_INDEXES = {
+    ### halos
+    # Mass cuts, e.g. get_halos_based_on_filters([("M_Crit200", low, high)], ...)
+    # Covers the common projection (ID, M_Crit200, simulation_unique_id, snapshot)
+    "idx_halos_M_Crit200" : ("halos", ["M_Crit200", "simulation_unique_id", "snapshot", "ID"]),
+    # Selections by simulation, optionally with a mass cut
+    "idx_halos_simulation_M_Crit200" : ("halos", ["simulation_unique_id", "snapshot", "M_Crit200"]),
+
+    ### profiles
+    # property_key IN (...) AND ID IN (...)
+    # Not covering: including radius and property_value would store the profiles table a second time
+    "idx_profiles_property_ID" : ("profiles", ["property_key", "ID", "simulation_unique_id", "snapshot"]),
+    # Selections by simulation and snapshot
+    "idx_profiles_simulation_snapshot" : ("profiles", ["simulation_unique_id", "snapshot", "ID"]),
+
+    ### subhalos
+    # Subhalos of given FoF halos
+    "idx_subhalos_simulation_haloID" : ("subhalos", ["simulation_unique_id", "snapshot", "haloID"]),
+    "idx_subhalos_SubhaloMass" : ("subhalos", ["SubhaloMass"]),
+
+    ### mergertree
+    # Start of a tree: (subfindID, snapshot, simulation_unique_id), covering for (subhaloID, MainLeafProgenitorID)
+    "idx_mergertree_subfindID" : ("mergertree", ["simulation_unique_id", "snapshot", "subfindID", "subhaloID", "MainLeafProgenitorID"]),
+    # Depth-first range of a tree: subhaloID BETWEEN ... AND simulation_unique_id = ...
+    "idx_mergertree_simulation_subhaloID" : ("mergertree", ["simulation_unique_id", "subhaloID"]),
+}
+
+
+def get_existing_tables(database=None):
+    data = execute_query("SELECT name FROM sqlite_master WHERE type = 'table'", database=database)
+    return {row["name"] for row in data}
+
+def get_existing_indexes(database=None):
+    """ Return {index name : CREATE INDEX statement} of the explicitly created indexes """
+    data = execute_query("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL", database=database)
+    return {row["name"] : row["sql"] for row in data}
+
+def create_indexes(database=None, analyze=True):
+    """ Build all secondary indexes (for the tables that exist in the database) """
+    existing_tables = get_existing_tables(database=database)
+    existing_indexes = get_existing_indexes(database=database)
+
+    for index_name, (table_name, columns) in SECONDARY_INDEXES.items():
+        if table_name not in existing_tables:
+            continue
+        sql = f"CREATE INDEX {index_name} ON {table_name} ({', '.join(columns)})"
+        if index_name in existing_indexes:
+            if existing_indexes[index_name] == sql:
+                continue
+            # Built by a previous version with other columns
+            print(f"Rebuilding index {index_name}")
+            execute_query(f"DROP INDEX {index_name}", database=database)
+        else:
+            print(f"Building index {index_name}")
+        execute_query(sql, database=database)
+
+    # Collect statistics for the query planner
+    if analyze:
+        execute_query("ANALYZE", database=database)
+
+def drop_indexes(database=None):
+    """ Drop all secondary indexes, e.g. before a bulk load. UNIQUE constraints are kept """
+    for index_name in SECONDARY_INDEXES:
+        execute_query(f"DROP INDEX IF EXISTS {index_name}", database=database)
+
+
+def get_helper_queries():
+    """ Representative queries of the filter_data_helpers functions, as (description, tables read by the query, query_helpers.Query) """
+    # Imported here, since filter_data_helpers sets the default database filename on import
+    from filter_data_helpers import _build_halos_query, _build_profiles_query, _build_packed_profiles_query, _build_subhalos_query, _build_mergertree_start_query, _build_mergertree_query, _build_halo_profiles_query
+
+    return [
+        ("get_halos_based_on_filters (mass cut)", ["halos"], _build_halos_query([("M_Crit200", 30, 200)], [])),
+        ("get_halos_based_on_filters (mass cut + simulation)", ["halos"], _build_halos_query([("M_Crit200", 30, 200)], [("simulation_unique_id", ["IllustrisTNG_1P_22"])])),
+        ("get_profiles (halos + property)", ["profiles"], _build_profiles_query([0, 1], [], [], ["gas_density"])),
+        ("get_profiles (many halos + property)", ["profiles"], _build_profiles_query(list(range(5000)), [], [], ["gas_density"])),
+        ("get_profiles (halos + simulation + snapshot + property)", ["profiles"], _build_profiles_query([0, 1], ["IllustrisTNG_1P_22"], [33], ["gas_density"])),
+        ("get_profiles (simulation + snapshot)", ["profiles"], _build_profiles_query([], ["IllustrisTNG_1P_22"], [33], [])),
+        ("get_profiles (packed)", ["profiles_packed"], _build_packed_profiles_query([0, 1], ["IllustrisTNG_1P_22"], [33])),
+        ("get_halo_profiles (mass cut + simulation + property)", ["halos", "profiles"], _build_halo_profiles_query([("M_Crit200", 30, 200)], [("simulation_unique_id", ["IllustrisTNG_1P_22"])], ["gas_density"], ["ID", "simulation_unique_id", "snapshot", "M_Crit200"])),
+        ("get_halo_profiles (packed)", ["halos", "profiles_packed"], _build_halo_profiles_query([("M_Crit200", 30, 200)], [("simulation_unique_id", ["IllustrisTNG_1P_22"])], [], ["ID", "simulation_unique_id", "snapshot", "M_Crit200"], packed=True)),
+        ("get_subhalos (halos + simulation + snapshot)", ["subhalos"], _build_subhalos_query([], [0, 1], ["IllustrisTNG_1P_22"], [33], [], [])),
+        ("get_subhalos (mass cut)", ["subhalos"], _build_subhalos_query([], [], [], [], [("SubhaloMass", 1, None)], [])),
+        ("get_mergertree (start of tree)", ["mergertree"], _build_mergertree_start_query(0, 33, "IllustrisTNG_LH_0")),
+        ("get_mergertree (tree)", ["mergertree"], _build_mergertree_query(0, 100, "IllustrisTNG_LH_0")),
+    ]
+
+def report_index_usage(database=None):
+    """ Print the query plan of each helper query, flagging full table scans.
+    Queries of tables that are not in the database (e.g. profiles_packed with the rows layout) are skipped.
+    """
+    existing_tables = get_existing_tables(database=database)
+
+    for description, table_names, query in get_helper_queries():
+        print(description)
+        missing_tables = [t for t in table_names if t not in existing_tables]
+        if len(missing_tables) != 0:
+            print(f"    (no {', '.join(missing_tables)} table)")
+            continue
+        for detail in query.explain(database=database):
+            flag = "  <-- full table scan" if detail.startswith("SCAN") and "INDEX" not in detail else ""
+            print(f"    {detail}{flag}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--database_filename", help="Database filename", default="sample.db", type=str)
+    parser.add_argument("--build", help="Build the secondary indexes", action="store_true")
+    parser.add_argument("--drop", help="Drop the secondary indexes", action="store_true")
+    parser.add_argument("--report", help="Report the indexes used by each filter_data_helpers query", action="store_true")
+    args = parser.parse_args()
+
+    set_database_filename(args.database_filename)
+    database = get_database()
+
+    if args.drop:
+        drop_indexes(database=database)
+    if args.build:
+        create_indexes(database=database)
+    if args.report:
+        report_index_usage(database=database)
@@ -0,0 +1,87 @@
+# Ingestion manifest: one row per source ingested by the bulk loaders, so that later runs only
+# process new or changed sources.
+# - For files (bulk_populate_profiles.py), a file whose size and modification time are unchanged is
+#   skipped. If they changed, its content hash decides whether it needs to be ingested again.
+# - For other sources (bulk_populate_subhalos.py), content_hash is a hash of the inputs of the loader.
+# The rows of a changed source are deleted and inserted again in the same transaction as its manifest entry,
+# so that readers never see a partially replaced source.
+import hashlib
+import json
+import os
+import time
+
+from database_helpers import create_table, execute_query, get_database
+
+MANIFEST_TABLE = "ingest_manifest"
+
+manifest_columns = {
+    "loader" : "TEXT NOT NULL", # e.g. "profiles", "subhalos"
+    "source_path" : "TEXT NOT NULL", # Absolute path of the source file
+    "size" : "INTEGER", # Size and modification time of the file (NULL for sources that are not files)
+    "mtime_ns" : "INTEGER",
+    "content_hash" : "TEXT NOT NULL", # sha256 of the file, or of the inputs of the loader
+    "simulation_unique_id" : "TEXT",
+    "snapshot" : "INTEGER",
+    "row_counts" : "TEXT NOT NULL", # JSON {table name : number of rows}
+    "ingest_time" : "REAL NOT NULL", # Unix time
+}
+
+def create_manifest_table(database=None):
+    """ Create the manifest table, if it does not exist (e.g. in databases created before the manifest) """
+    create_table(MANIFEST_TABLE, manifest_columns, primary_key=("loader", "source_path"), database=database)
+
+def get_content_hash(filename, chunk_size=2**20):
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def get_file_stat(filename):
+    """ (absolute path, size, modification time in ns) """
+    stat = os.stat(filename)
+    return os.path.abspath(filename), stat.st_size, stat.st_mtime_ns
+
+def get_manifest_entries(loader, database=None):
+    """ {source_path : manifest row} of a loader """
+    data = execute_query(f"SELECT * FROM {MANIFEST_TABLE} WHERE loader = ?", (loader,), database=database)
+    return {row["source_path"] : row for row in data}
+
+def get_changed_files(loader, filenames, database=None):
+    """ Subset of the files that are new or changed since they were last ingested by the loader
+    Files whose modification time changed but whose content did not are skipped, and their manifest entry is updated.
+    """
+    database = database or get_database()
+    entries = get_manifest_entries(loader, database=database)
+
+    changed_filenames = []
+    with database.transaction():
+        for filename in filenames:
+            source_path, size, mtime_ns = get_file_stat(filename)
+            entry = entries.get(source_path)
+            if entry is None:
+                changed_filenames.append(filename)
+            elif entry["size"] == size and entry["mtime_ns"] == mtime_ns:
+                continue
+            elif entry["size"] == size and entry["content_hash"] == get_content_hash(filename):
+                execute_query(f"UPDATE {MANIFEST_TABLE} SET mtime_ns = ? WHERE loader = ? AND source_path = ?", (mtime_ns, loader, source_path), database=database)
+            else:
+                changed_filenames.append(filename)
+
+    return changed_filenames
+
+def is_unchanged_source(loader, source_path, content_hash, database=None):
+    """ Whether a (non-file) source was already ingested with the same content hash """
+    data = execute_query(f"SELECT content_hash FROM {MANIFEST_TABLE} WHERE loader = ? AND source_path = ?", (loader, source_path), database=database)
+    return len(data) != 0 and data[0]["content_hash"] == content_hash
+
+def record_ingest(loader, source_path, content_hash, row_counts, simulation_unique_id=None, snapshot=None, size=None, mtime_ns=None, database=None):
+    """ Add or replace the manifest entry of a source. Should be called in the transaction that inserted its rows """
+    execute_query(
+        f"INSERT OR REPLACE INTO {MANIFEST_TABLE} (loader, source_path, size, mtime_ns, content_hash, simulation_unique_id, snapshot, row_counts, ingest_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (loader, source_path, size, mtime_ns, content_hash, simulation_unique_id, snapshot, json.dumps(row_counts), time.time()),
+        database=database,
+    )
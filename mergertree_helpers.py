@@ -0,0 +1,142 @@
+# In-memory merger-tree engine
+# Loads all mergertree rows of one simulation once into NumPy arrays sorted by subhaloID,
+# and answers tree queries for many starting subhalos in one vectorized call,
+# instead of running two queries per subhalo (see get_mergertree in filter_data_helpers.py).
+#
+# In SubLink trees, subhaloIDs are assigned depth-first, so that:
+# - the main progenitor branch of a subhalo is the ID range [subhaloID, MainLeafProgenitorID]
+# - the full tree of progenitors of a subhalo is the ID range [subhaloID, LastProgenitorID]
+import numpy as np
+import pandas as pd
+
+from database_helpers import iter_query
+
+MERGERTREE_COLUMNS = ["subhaloID", "subfindID", "snapshot", "LastProgenitorID", "MainLeafProgenitorID", "RootDescendantID", "TreeID", "FirstProgenitorID", "NextProgenitorID", "DescendantID", "FirstSubhaloInFOFGroupID", "NextSubhaloInFOFGroupID", "NumParticles", "Mass", "MassHistory"]
+
+class MergerTree:
+    """ All mergertree rows of one simulation
+    Example:
+        tree = MergerTree("IllustrisTNG_LH_0")
+        branches = tree.get_main_progenitor_branches(subfind_ids, snapshots)
+    All query methods take arrays of starting (subfindID, snapshot) pairs, and return a DataFrame
+    with the mergertree rows of all starting subhalos, with a "target" column giving the index
+    of the starting pair each row belongs to. Starting pairs not present in the tree are skipped.
+    """
+
+    def __init__(self, simulation_unique_id, database=None, chunk_size=1000000):
+        self.simulation_unique_id = simulation_unique_id
+
+        query = f"""
+        SELECT
+        {', '.join(MERGERTREE_COLUMNS)}
+        FROM mergertree
+        WHERE simulation_unique_id = ?
+        ORDER BY subhaloID
+        """
+
+        chunks = [
+            list(zip(*rows))
+            for _, rows in iter_query(query, (simulation_unique_id,), chunk_size=chunk_size, database=database)
+        ]
+        self.data = {
+            c : np.concatenate([np.asarray(chunk[i]) for chunk in chunks]) if len(chunks) != 0 else np.empty(0, dtype=np.int64)
+            for i, c in enumerate(MERGERTREE_COLUMNS)
+        }
+        self.data["Mass"] = self.data["Mass"].astype(np.float64)
+
+        # Sorted by subhaloID (ORDER BY above)
+        self.subhalo_ids = self.data["subhaloID"].astype(np.int64)
+
+        # Lookup of rows by (snapshot, subfindID)
+        self._subfind_keys = self._get_subfind_keys(self.data["subfindID"], self.data["snapshot"])
+        self._subfind_order = np.argsort(self._subfind_keys, kind="stable")
+        self._sorted_subfind_keys = self._subfind_keys[self._subfind_order]
+
+    def __len__(self):
+        return len(self.subhalo_ids)
+
+    @staticmethod
+    def _get_subfind_keys(subfind_ids, snapshots):
+        return (np.asarray(snapshots, dtype=np.int64) << 32) + np.asarray(subfind_ids, dtype=np.int64)
+
+    def find_rows(self, subfind_ids, snapshots):
+        """ Return the row index of each (subfindID, snapshot) pair, or -1 if not in the tree """
+        keys = self._get_subfind_keys(subfind_ids, snapshots)
+        if len(self._sorted_subfind_keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._sorted_subfind_keys, keys), len(self._sorted_subfind_keys) - 1)
+        found = self._sorted_subfind_keys[positions] == keys
+        return np.where(found, self._subfind_order[positions], -1)
+
+    def find_rows_by_subhalo_id(self, subhalo_ids):
+        """ Return the row index of each (mergertree) subhaloID, or -1 if not in the tree """
+        subhalo_ids = np.asarray(subhalo_ids, dtype=np.int64)
+        if len(self.subhalo_ids) == 0:
+            return np.full(len(subhalo_ids), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.subhalo_ids, subhalo_ids), len(self.subhalo_ids) - 1)
+        return np.where(self.subhalo_ids[positions] == subhalo_ids, positions, -1)
+
+    def _get_ranges(self, subfind_ids, snapshots, last_id_column):
+        rows = self.find_rows(subfind_ids, snapshots)
+        targets = np.flatnonzero(rows >= 0)
+        rows = rows[targets]
+
+        starts = np.searchsorted(self.subhalo_ids, self.subhalo_ids[rows], side="left")
+        stops = np.searchsorted(self.subhalo_ids, self.data[last_id_column][rows], side="right")
+
+        return targets, starts, stops
+
+    def _get_rows_dataframe(self, targets, rows):
+        # Order the rows of each target by decreasing snapshot, as get_mergertree does
+        order = np.lexsort((-self.data["snapshot"][rows], targets))
+        targets = targets[order]
+        rows = rows[order]
+
+        df = pd.DataFrame({c : v[rows] for c, v in self.data.items()})
+        df.insert(0, "target", targets)
+        df.insert(1, "simulation_unique_id", self.simulation_unique_id)
+        return df
+
+    def _get_ranges_dataframe(self, targets, starts, stops):
+        lengths = stops - starts
+        # Concatenation of np.arange(start, stop) for all ranges
+        rows = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return self._get_rows_dataframe(np.repeat(targets, lengths), rows)
+
+    def get_main_progenitor_branches(self, subfind_ids, snapshots):
+        """ Main progenitor branch of each starting subhalo, i.e. the rows between subhaloID and MainLeafProgenitorID
+        This is the batched equivalent of filter_data_helpers.get_mergertree
+        """
+        return self._get_ranges_dataframe(*self._get_ranges(subfind_ids, snapshots, "MainLeafProgenitorID"))
+
+    def get_progenitor_trees(self, subfind_ids, snapshots):
+        """ Full (depth-first) tree of progenitors of each starting subhalo, i.e. the rows between subhaloID and LastProgenitorID """
+        return self._get_ranges_dataframe(*self._get_ranges(subfind_ids, snapshots, "LastProgenitorID"))
+
+    def get_descendants(self, subfind_ids, snapshots):
+        """ Descendants of each starting subhalo (including itself), following DescendantID
+        All starting subhalos are followed together, one snapshot step per iteration.
+        """
+        rows = self.find_rows(subfind_ids, snapshots)
+        targets = np.flatnonzero(rows >= 0)
+        rows = rows[targets]
+
+        all_targets = []
+        all_rows = []
+        while len(rows) != 0:
+            all_targets.append(targets)
+            all_rows.append(rows)
+
+            rows = self.find_rows_by_subhalo_id(self.data["DescendantID"][rows])
+            targets = targets[rows >= 0]
+            rows = rows[rows >= 0]
+
+        if len(all_rows) == 0:
+            return self._get_rows_dataframe(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+
+        return self._get_rows_dataframe(np.concatenate(all_targets), np.concatenate(all_rows))
+
+
+def get_mergertrees(list_of_subfind_ids, list_of_snapshots, simulation_unique_id, database=None):
+    """ Batched get_mergertree: main progenitor branches of many subhalos of one simulation """
+    return MergerTree(simulation_unique_id, database=database).get_main_progenitor_branches(list_of_subfind_ids, list_of_snapshots)
@@ -0,0 +1,79 @@
+# Rewrite the ARRAY columns of an existing database with the current array format
+# (see adapt_array in database_helpers.py).
+# Blobs written with np.save by previous versions are still readable, but are slower to decode.
+# Blobs already in the current format are left untouched, so the migration can be interrupted and re-run.
+import argparse
+
+from database_helpers import set_database_filename, get_database, execute_query, adapt_array, convert_array, ARRAY_MAGIC
+
+def get_array_columns(database=None):
+    """ Return {table name : list of columns declared as ARRAY} """
+    tables = execute_query("SELECT name FROM sqlite_master WHERE type = 'table'", database=database)
+
+    array_columns = {}
+    for table in tables:
+        table_name = table["name"]
+        columns = execute_query(f"PRAGMA table_info({table_name})", database=database)
+        columns = [c["name"] for c in columns if c["type"].upper() == "ARRAY"]
+        if len(columns) != 0:
+            array_columns[table_name] = columns
+
+    return array_columns
+
+def migrate_table(table_name, columns, batch_size=10000, database=None):
+    database = database or get_database()
+
+    # Select the raw blobs: the expression "+column" has no declared type, so the ARRAY converter is not applied
+    select_query = f"""
+    SELECT rowid, {', '.join(f'+{c}' for c in columns)}
+    FROM {table_name}
+    WHERE rowid > ?
+    ORDER BY rowid
+    LIMIT {batch_size}
+    """
+    update_query = f"""
+    UPDATE {table_name}
+    SET {', '.join(f'{c} = ?' for c in columns)}
+    WHERE rowid = ?
+    """
+
+    # Migrate batch_size rows per transaction, walking the table by rowid
+    number_rows = 0
+    last_rowid = -1
+    while True:
+        rows = [tuple(row.values()) for row in execute_query(select_query, (last_rowid,), database=database)]
+        if len(rows) == 0:
+            break
+        last_rowid = rows[-1][0]
+
+        updates = []
+        for row in rows:
+            blobs = row[1:]
+            if all(b is None or b[:4] == ARRAY_MAGIC for b in blobs):
+                continue
+            updates.append((
+                *[b if b is None else adapt_array(convert_array(b)) for b in blobs],
+                row[0],
+            ))
+
+        database.executemany(update_query, updates)
+        number_rows += len(updates)
+
+    return number_rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--database_filename", help="Database filename to be migrated", default="sample.db", type=str)
+    parser.add_argument("--vacuum", help="Run VACUUM after the migration, to reclaim the space freed by the smaller blobs", action="store_true")
+    args = parser.parse_args()
+
+    set_database_filename(args.database_filename)
+    database = get_database()
+
+    for table_name, columns in get_array_columns(database=database).items():
+        number_rows = migrate_table(table_name, columns, database=database)
+        print(f"{table_name}: migrated {number_rows} rows ({len(columns)} ARRAY columns)")
+
+    if args.vacuum:
+        execute_query("VACUUM", database=database)
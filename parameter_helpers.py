@@ -0,0 +1,127 @@
+# Parameter-space search over the simulations: the simulations inside a box of the six CAMELS
+# parameters, or the k simulations nearest to a parameter point (e.g. for emulator validation loops).
+# The simulations table is small (a few thousand rows), so it is loaded once into a normalized parameter
+# matrix, which answers each search in memory with numpy. The matrix is loaded again when the database changes.
+# The results have the simulation_unique_id column, to select the halos and profiles of the simulations:
+#   simulations = get_nearest_simulations({"Omega_m" : 0.3, "sigma_8" : 0.8, "A_SN1" : 1, "A_AGN1" : 1, "A_SN2" : 1, "A_AGN2" : 1}, k=5)
+#   halos = get_halos_based_on_filters([("M_Crit200", 30, 200)], [("simulation_unique_id", simulations["simulation_unique_id"])])
+#   halos = join_simulation_parameters(halos)
+import numpy as np
+import pandas as pd
+
+from database_helpers import execute_query, get_database
+
+PARAMETERS = ["Omega_m", "sigma_8", "A_SN1", "A_AGN1", "A_SN2", "A_AGN2"]
+
+# Ranges of the parameters in the CAMELS LH sets, used to normalize them to [0, 1] for the distances
+# The feedback parameters are sampled logarithmically, so they are normalized in log space.
+# parameter : (minimum, maximum, log scale)
+PARAMETER_RANGES = {
+    "Omega_m" : (0.1, 0.5, False),
+    "sigma_8" : (0.6, 1.0, False),
+    "A_SN1" : (0.25, 4.0, True),
+    "A_AGN1" : (0.25, 4.0, True),
+    "A_SN2" : (0.5, 2.0, True),
+    "A_AGN2" : (0.5, 2.0, True),
+}
+
+def normalize_parameters(values, parameters=PARAMETERS):
+    """ Normalize parameter values (array with the parameters along the last axis) to [0, 1] over the CAMELS LH ranges """
+    values = np.asarray(values, dtype=np.float64)
+    normalized = np.empty_like(values)
+    for i, parameter in enumerate(parameters):
+        minimum, maximum, log_scale = PARAMETER_RANGES[parameter]
+        if log_scale:
+            # Feedback turned off (0, e.g. in EX_3) is placed at a finite distance, below the range
+            normalized[..., i] = np.log(np.maximum(values[..., i], minimum / 100) / minimum) / np.log(maximum / minimum)
+        else:
+            normalized[..., i] = (values[..., i] - minimum) / (maximum - minimum)
+    return normalized
+
+
+class ParameterIndex:
+    """ Parameters of all simulations, as a (simulations, parameters) matrix """
+
+    def __init__(self, simulations):
+        self.simulations = simulations.reset_index(drop=True)
+        self.values = self.simulations[PARAMETERS].to_numpy(dtype=np.float64)
+        self.normalized = normalize_parameters(self.values)
+        self.suites = self.simulations["simulation_suite"].to_numpy()
+        self._rows = {simulation_unique_id : i for i, simulation_unique_id in enumerate(self.simulations["simulation_unique_id"])}
+
+    def _get_suite_mask(self, simulation_suites):
+        if simulation_suites is None:
+            return np.ones(len(self.simulations), dtype=bool)
+        return np.isin(self.suites, list(simulation_suites))
+
+    def get_rows_in_box(self, lower, upper, simulation_suites=None):
+        """ Rows of the simulations with lower[p] <= p <= upper[p] for each parameter p of lower and upper """
+        mask = self._get_suite_mask(simulation_suites)
+        for bounds, compare in [(lower, np.greater_equal), (upper, np.less_equal)]:
+            for parameter, value in (bounds or {}).items():
+                if value is not None:
+                    mask &= compare(self.values[:, PARAMETERS.index(parameter)], value)
+        return np.flatnonzero(mask)
+
+    def get_nearest_rows(self, point, k, parameters=PARAMETERS, simulation_suites=None):
+        """ (rows, distances) of the k simulations nearest to the point, in normalized parameter space """
+        columns = [PARAMETERS.index(p) for p in parameters]
+        point = normalize_parameters([point[p] for p in parameters], parameters)
+        candidates = np.flatnonzero(self._get_suite_mask(simulation_suites))
+
+        distances = np.sqrt(np.sum((self.normalized[np.ix_(candidates, columns)] - point) ** 2, axis=1))
+        k = min(k, len(candidates))
+        nearest = np.argpartition(distances, k - 1)[:k] if 0 < k < len(candidates) else np.arange(len(candidates))
+        nearest = nearest[np.argsort(distances[nearest], kind="stable")][:k]
+        return candidates[nearest], distances[nearest]
+
+    def get_rows(self, simulation_unique_ids):
+        """ Rows of the given simulations (-1 for unknown simulations) """
+        return np.array([self._rows.get(s, -1) for s in simulation_unique_ids], dtype=np.int64)
+
+
+# Parameter index of each database: filename : (data version, ParameterIndex)
+_parameter_indexes = {}
+
+def get_parameter_index(database=None):
+    """ Parameter index of the database, loaded again if the database changed """
+    database = database or get_database()
+    data_version = database.get_data_version()
+    entry = _parameter_indexes.get(database.filename)
+    if entry is None or entry[0] != data_version:
+        simulations = pd.DataFrame(execute_query("SELECT * FROM simulations ORDER BY simulation_unique_id", database=database))
+        if len(simulations) == 0:
+            simulations = pd.DataFrame(columns=["simulation_unique_id", "simulation_suite", "simulation_name"] + PARAMETERS + ["seed"])
+        entry = (data_version, ParameterIndex(simulations))
+        _parameter_indexes[database.filename] = entry
+    return entry[1]
+
+def get_simulations_in_parameter_box(lower=None, upper=None, simulation_suites=None, database=None):
+    """ Simulations inside a box of the parameter space
+    lower, upper: {parameter : bound}, e.g. lower={"Omega_m" : 0.2}, upper={"Omega_m" : 0.4, "A_SN1" : 1}
+    (parameters without bounds are not restricted). simulation_suites: e.g. ["IllustrisTNG"] (default: all).
+    """
+    index = get_parameter_index(database=database)
+    rows = index.get_rows_in_box(lower, upper, simulation_suites)
+    return index.simulations.iloc[rows].reset_index(drop=True)
+
+def get_nearest_simulations(point, k, parameters=None, simulation_suites=None, database=None):
+    """ The k simulations nearest to a parameter point {parameter : value}, sorted by distance
+    Distances are Euclidean in the normalized parameter space (see normalize_parameters), over the given
+    parameters (default: the parameters of the point), and returned in the distance column.
+    """
+    index = get_parameter_index(database=database)
+    rows, distances = index.get_nearest_rows(point, k, parameters or [p for p in PARAMETERS if p in point], simulation_suites)
+    simulations = index.simulations.iloc[rows].reset_index(drop=True)
+    simulations["distance"] = distances
+    return simulations
+
+def join_simulation_parameters(df, parameters=PARAMETERS, database=None):
+    """ Add the parameters of the simulations to a DataFrame with a simulation_unique_id column (e.g. halos or profiles) """
+    index = get_parameter_index(database=database)
+    rows = index.get_rows(df["simulation_unique_id"])
+    df = df.copy()
+    for parameter in parameters:
+        # Unknown simulations (row -1) get the appended NaN
+        df[parameter] = np.append(index.values[:, PARAMETERS.index(parameter)], np.nan)[rows]
+    return df
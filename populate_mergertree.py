@@ -1,12 +1,9 @@
 # populate_mergertree should be executed in an environment with the following files available:
 # offsets and postprocessing folders
 import argparse
-import numpy as np
-import sys
-sys.path.append("/home/jovyan")
-import illustris_python as il
 
 from database_helpers import set_database_filename, populate_table
+from illustris_helpers import mergertree_columns, get_simulation_basepath, load_tree, get_mergertree_rows
 
 # Accept optional name of database file
 parser = argparse.ArgumentParser()
@@ -24,36 +21,22 @@ snapshot = int(args.snapshot)
 subhalo_id = int(args.subhalo_id)
 simulation_suite = args.simulation_suite # e.g. IllustrisTNG
 simulation_name = args.simulation_name # e.g. LH_0
-basepath = f"{args.basepath}/{args.simulation_suite}/{args.simulation_name}/" # e.g. /home/jovyan/Simulations/IllustrisTNG/LH_0/
+basepath = get_simulation_basepath(args.basepath, simulation_suite, simulation_name) # e.g. /home/jovyan/Simulations/IllustrisTNG/LH_0/
 
 simulation_unique_id = f"{simulation_suite}_{simulation_name}"
 
 # Set database filename
 set_database_filename(db_filename)
 
-# Use illustris_python to load subhalos in the given snapshot and simulation
-mergertree_additional_fields = ["LastProgenitorID", "MainLeafProgenitorID", "RootDescendantID", "TreeID", "FirstProgenitorID", "NextProgenitorID", "DescendantID", "FirstSubhaloInFOFGroupID", "NextSubhaloInFOFGroupID", "NumParticles", "Mass", "MassHistory"]
-mergertree_fields = ["SubhaloID", "SubfindID", "SnapNum"] + mergertree_additional_fields
-mergertree = il.sublink.loadTree(basepath, snapshot, subhalo_id, fields=mergertree_fields, onlyMPB=False)
+# Use illustris_python to load the tree of the given subhalo
+mergertree = load_tree(basepath, snapshot, subhalo_id)
 
 if mergertree is None:
     # Subhalo is not in tree
     exit()
 
 # Set up dataset for database
-mergertree_data = list(
-    zip(
-        [simulation_unique_id] * mergertree["count"],
-        list(mergertree["SnapNum"]),
-        list(mergertree["SubhaloID"]),
-        list(mergertree["SubfindID"]),
-        *[list(mergertree[field]) for field in mergertree_additional_fields],
-    )
-)
-
-# Setup list of columns
-mergertree_columns = ["simulation_unique_id", "snapshot", "subhaloID", "subfindID"]
-mergertree_columns.extend(mergertree_additional_fields)
+mergertree_data = get_mergertree_rows(mergertree, simulation_unique_id)
 
 populate_table(
     "mergertree",
@@ -2,11 +2,10 @@
 # offsets and postprocessing folders
 import argparse
 import numpy as np
-import sys
-sys.path.append("/home/jovyan")
-import illustris_python as il
 
 from database_helpers import set_database_filename, populate_table
+from illustris_helpers import subhalo_fields, subhalos_columns, get_simulation_basepath, load_subhalos, load_redshift, get_subhalo_rows
+from units_helpers import create_snapshots_table, store_snapshot_redshift
 
 # Accept optional name of database file
 parser = argparse.ArgumentParser()
@@ -24,7 +23,7 @@ snapshot = int(args.snapshot)
 halo_id = int(args.halo_id)
 simulation_suite = args.simulation_suite # e.g. IllustrisTNG
 simulation_name = args.simulation_name # e.g. LH_0
-basepath = f"{args.basepath}/{args.simulation_suite}/{args.simulation_name}/" # e.g. /home/jovyan/Simulations/IllustrisTNG/LH_0/
+basepath = get_simulation_basepath(args.basepath, simulation_suite, simulation_name) # e.g. /home/jovyan/Simulations/IllustrisTNG/LH_0/
 
 simulation_unique_id = f"{simulation_suite}_{simulation_name}"
 
@@ -32,33 +31,23 @@ simulation_unique_id = f"{simulation_suite}_{simulation_name}"
 set_database_filename(db_filename)
 
 # Use illustris_python to load subhalos in the given snapshot and simulation
-subhalo_fields = ["SubhaloBHMass", "SubhaloBHMdot", "SubhaloBfldDisk", "SubhaloBfldHalo", "SubhaloCM", "SubhaloGasMetalFractions", "SubhaloGasMetalFractionsHalfRad", "SubhaloGasMetalFractionsMaxRad", "SubhaloGasMetalFractionsSfr", "SubhaloGasMetalFractionsSfrWeighted", "SubhaloGasMetallicity", "SubhaloGasMetallicityHalfRad", "SubhaloGasMetallicityMaxRad", "SubhaloGasMetallicitySfr", "SubhaloGasMetallicitySfrWeighted", "SubhaloGrNr", "SubhaloHalfmassRad", "SubhaloHalfmassRadType", "SubhaloIDMostbound", "SubhaloLen", "SubhaloLenType", "SubhaloMass", "SubhaloMassInHalfRad", "SubhaloMassInHalfRadType", "SubhaloMassInMaxRad", "SubhaloMassInMaxRadType", "SubhaloMassInRad", "SubhaloMassInRadType", "SubhaloMassType", "SubhaloParent", "SubhaloPos", "SubhaloSFR", "SubhaloSFRinHalfRad", "SubhaloSFRinMaxRad", "SubhaloSFRinRad", "SubhaloSpin", "SubhaloStarMetalFractions", "SubhaloStarMetalFractionsHalfRad", "SubhaloStarMetalFractionsMaxRad", "SubhaloStarMetallicity", "SubhaloStarMetallicityHalfRad", "SubhaloStarMetallicityMaxRad", "SubhaloStellarPhotometrics", "SubhaloStellarPhotometricsMassInRad", "SubhaloStellarPhotometricsRad", "SubhaloVel", "SubhaloVelDisp", "SubhaloVmax", "SubhaloVmaxRad", "SubhaloWindMass"]
-subhalos = il.groupcat.loadSubhalos(basepath, snapshot, fields=subhalo_fields)
-subhalo_fields.remove("SubhaloGrNr") # Do not include it as part of the insert query below, since it's already included as "haloID"
+subhalos = load_subhalos(basepath, snapshot, fields=subhalo_fields)
 
 # Filter subhalos based on FoF halo ID (i.e. "SubhaloGrNr")
 mask = np.where((subhalos["SubhaloGrNr"] == halo_id))[0]
 
 # Set up dataset for database
-subhalos_data= list(
-    zip(
-        list(mask), # subhaloID
-        list(subhalos["SubhaloGrNr"][mask]), # haloID
-        [simulation_unique_id] * len(mask), # simulation_unique_id
-        [snapshot] * len(mask), # Snapshot Number
-        *[list(subhalos[field][mask]) for field in subhalo_fields],
-    )
-)
+subhalos_data = get_subhalo_rows(subhalos, mask, simulation_unique_id, snapshot)
 
 print(subhalos["SubhaloBHMass"][mask])
 print(type(subhalos["SubhaloBHMass"][mask][0]))
 
-# Setup list of columns
-subhalos_columns_list = ["subhaloID", "haloID", "simulation_unique_id", "snapshot"]
-subhalos_columns_list.extend(subhalo_fields)
-
 populate_table(
     "subhalos",
-    subhalos_columns_list,
+    subhalos_columns,
     subhalos_data
 )
+
+# Redshift of the snapshot, for the conversions to physical units
+create_snapshots_table()
+store_snapshot_redshift(simulation_unique_id, snapshot, load_redshift(basepath, snapshot))
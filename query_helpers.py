@@ -0,0 +1,180 @@
+# Parameterized SELECT query builder
+# All values are bound as parameters (never interpolated into the SQL), so that:
+# - integers are compared as integers, and can use the indexes
+# - the same query shape always produces the same SQL text, so that the prepared
+#   statement is reused from the connection's statement cache instead of being re-parsed.
+#   For this, IN lists are padded (by repeating their last value) to a power of 2 length.
+# Long IN lists (e.g. thousands of halo IDs) are loaded into an indexed temporary table,
+# which is joined with the queried table.
+from contextlib import contextmanager
+from itertools import count
+import re
+
+from database_helpers import get_database
+
+# IN lists longer than this are loaded into a temporary table
+TEMP_TABLE_THRESHOLD = 256
+# Smallest padded length of IN lists
+MIN_IN_LIST_LENGTH = 4
+
+_identifier_pattern = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+_temp_table_counter = count()
+
+def check_identifier(name):
+    """ Column and table names cannot be bound as parameters, so only accept plain identifiers """
+    if not isinstance(name, str) or _identifier_pattern.match(name) is None:
+        raise ValueError(f"Invalid column or table name: {name!r}")
+    return name
+
+def _to_python_values(values):
+    # Accepts lists, numpy arrays and pandas Series
+    if hasattr(values, "tolist"):
+        return values.tolist()
+    return [v.item() if hasattr(v, "item") else v for v in values]
+
+def _get_padded_length(length):
+    padded_length = MIN_IN_LIST_LENGTH
+    while padded_length < length:
+        padded_length *= 2
+    return padded_length
+
+
+class Query:
+    """ SELECT query on one table, with bound parameters
+    Example:
+        query = Query("halos", columns=["ID", "M_Crit200"])
+        query.where_range("M_Crit200", 1, 100)
+        query.where_in("simulation_unique_id", ["IllustrisTNG_1P_22"])
+        rows = query.execute()
+    """
+
+    def __init__(self, table_name, columns=None, lazy_array_columns=()):
+        """ columns: list of columns to select (default: all).
+        lazy_array_columns: ARRAY columns to be selected as raw bytes, without decoding.
+        """
+        self.table_name = check_identifier(table_name)
+        if columns is None:
+            self.select_list = f"{self.table_name}.*"
+        else:
+            # The expression "+column" has no declared type, so the ARRAY converter is not applied to it
+            self.select_list = ", ".join([
+                f"+{self.table_name}.{check_identifier(c)} AS {c}" if c in lazy_array_columns else f"{self.table_name}.{check_identifier(c)} AS {c}"
+                for c in columns
+            ])
+
+        self.joins = []
+        self.where_clauses = []
+        self.params = []
+        self.order_by = None
+        self.temp_tables = {} # temporary table name : list of values
+
+    def where(self, clause, *params):
+        """ Add a raw WHERE clause, with its parameters """
+        self.where_clauses.append(clause)
+        self.params.extend(params)
+        return self
+
+    def where_equal(self, column_name, value, table_name=None):
+        """ table_name: table of the column, for columns of joined tables (default: the queried table) """
+        table_name = check_identifier(table_name or self.table_name)
+        return self.where(f"{table_name}.{check_identifier(column_name)} = ?", value)
+
+    def where_range(self, column_name, lower_limit=None, upper_limit=None, table_name=None):
+        table_name = check_identifier(table_name or self.table_name)
+        check_identifier(column_name)
+        if lower_limit is not None:
+            self.where(f"{table_name}.{column_name} >= ?", lower_limit)
+        if upper_limit is not None:
+            self.where(f"{table_name}.{column_name} <= ?", upper_limit)
+        return self
+
+    def where_in(self, column_name, values, table_name=None):
+        table_name = check_identifier(table_name or self.table_name)
+        check_identifier(column_name)
+        values = _to_python_values(values)
+        if len(values) == 0:
+            return self
+
+        if len(values) > TEMP_TABLE_THRESHOLD:
+            temp_table_name = f"_query_values_{next(_temp_table_counter)}"
+            self.temp_tables[temp_table_name] = values
+            self.joins.append(f"JOIN temp.{temp_table_name} ON {table_name}.{column_name} = temp.{temp_table_name}._value")
+            return self
+
+        padded_values = values + [values[-1]] * (_get_padded_length(len(values)) - len(values))
+        return self.where(f"{table_name}.{column_name} IN ({','.join(['?' for _ in padded_values])})", *padded_values)
+
+    def join(self, table_name, on_columns, columns=(), cross=False):
+        """ Inner join with another table, on equal values of the on_columns of both tables
+        columns: columns of the joined table to be added to the selected columns
+        cross: write the join as a CROSS JOIN, which SQLite never reorders: the tables before it
+        are always outer loops, i.e. all rows joined with one of their rows are returned together.
+        """
+        check_identifier(table_name)
+        self.joins.append(f"{'CROSS JOIN' if cross else 'JOIN'} {table_name} ON " + " AND ".join([
+            f"{self.table_name}.{check_identifier(c)} = {table_name}.{c}" for c in on_columns
+        ]))
+        if len(columns) != 0:
+            self.select_list += ", " + ", ".join([f"{table_name}.{check_identifier(c)} AS {c}" for c in columns])
+        return self
+
+    def set_order_by(self, *column_names, table_name=None):
+        table_name = check_identifier(table_name or self.table_name)
+        self.order_by = ", ".join([f"{table_name}.{check_identifier(c)}" for c in column_names])
+        return self
+
+    @property
+    def sql(self):
+        query = f"""
+    SELECT
+    {self.select_list}
+    FROM {self.table_name}
+    """
+        if len(self.joins) != 0:
+            query += " " + " ".join(self.joins)
+        if len(self.where_clauses) != 0:
+            query += " WHERE " + " AND ".join(self.where_clauses)
+        if self.order_by is not None:
+            query += f" ORDER BY {self.order_by}"
+        return query
+
+    @property
+    def cache_key(self):
+        """ Hashable key identifying the query and its parameters (see cache_helpers.py)
+        Temporary table names are unique per query, so they are replaced by their position.
+        """
+        sql = " ".join(self.sql.split())
+        for i, temp_table_name in enumerate(self.temp_tables):
+            sql = re.sub(rf"\b{temp_table_name}\b", f"_query_values_${i}", sql)
+        return (sql, tuple(self.params), tuple(tuple(values) for values in self.temp_tables.values()))
+
+    @contextmanager
+    def _temp_tables(self, database):
+        # Temporary tables are private to the connection (i.e. to the calling thread)
+        try:
+            for temp_table_name, values in self.temp_tables.items():
+                database.execute(f"CREATE TEMP TABLE {temp_table_name} (_value PRIMARY KEY) WITHOUT ROWID")
+                database.executemany(f"INSERT OR IGNORE INTO temp.{temp_table_name} VALUES (?)", [(v,) for v in values])
+            yield
+        finally:
+            for temp_table_name in self.temp_tables:
+                database.execute(f"DROP TABLE IF EXISTS temp.{temp_table_name}")
+
+    def execute(self, database=None):
+        """ Run the query, returning a list of dicts (see database_helpers.execute_query) """
+        database = database or get_database()
+        with self._temp_tables(database):
+            return database.execute(self.sql, tuple(self.params))
+
+    def iter_execute(self, chunk_size=10000, database=None):
+        """ Run the query, yielding (columns, rows) chunks (see database_helpers.iter_query) """
+        database = database or get_database()
+        with self._temp_tables(database):
+            yield from database.iter_execute(self.sql, tuple(self.params), chunk_size=chunk_size)
+
+    def explain(self, database=None):
+        """ Query plan, as a list of strings """
+        database = database or get_database()
+        with self._temp_tables(database):
+            data = database.execute(f"EXPLAIN QUERY PLAN {self.sql}", tuple(self.params))
+        return [row["detail"] for row in data]
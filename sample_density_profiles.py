@@ -1,12 +1,10 @@
 import populate_profile_data # Executes generation of database
-from database_helpers import execute_query
+from profile_stats import get_binned_profile_stats
 
-from collections import defaultdict
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 
-HUBBLE = 0.6711
+from units_helpers import HUBBLE
 
 low_mass_cut = 1.0
 high_mass_cut = 1e5
@@ -14,81 +12,24 @@ high_mass_cut = 1e5
 low_mass_cut /= HUBBLE
 high_mass_cut /= HUBBLE
 
-query = f"""
-SELECT 
-ID, M_Crit200
-FROM halos
-WHERE
-M_Crit200 <= {high_mass_cut}
-AND
-M_Crit200 > {low_mass_cut}
-LIMIT 2000
-"""
-
-data = execute_query(query)
-#print(data)
-
-halo_ids = [row["ID"] for row in data]
-
-
 property_key = "gas_density"
 
-query = f"""
-SELECT 
-ID, radius, property_value
-FROM profiles
-WHERE
-property_key = ?
-AND
-ID IN ({','.join(['?' for _ in halo_ids])})
-ORDER BY ID, radius
-"""
-
-params = (property_key, *halo_ids)
-
-data = execute_query(query, params)
-#print(data)
-
-profiles = defaultdict(dict)
-for row in data:
-    halo_id = row["ID"]
-    if "radius" not in profiles[halo_id]:
-        profiles[halo_id]["radius"] = []
-        profiles[halo_id]["property"] = []
-
-    profiles[halo_id]["radius"].append(row["radius"] / (HUBBLE * 1000)) # Dividing by 1000 to convert into Mpc
-
-    profiles[halo_id]["property"].append(row["property_value"] * 1e10 * HUBBLE * HUBBLE)
-
-print(profiles)
-
-# Make DataFrame with profile data
-profiles_df = pd.DataFrame.from_dict(profiles, orient="index")
-print(profiles_df)
-
-# Make mean, 16 %, 84 %
-
-radii = np.percentile(
-    list(profiles_df["radius"]),
-    q=50,
-    axis=0
-)
-median = np.percentile(
-    list(profiles_df["property"]),
-    q=50,
-    axis=0
+# Percentiles per radial bin, for all halos in the mass range, streamed from the database
+stats = get_binned_profile_stats(
+    list_of_inequality_filters=[],
+    list_of_equality_filters=[],
+    list_of_properties=[property_key],
+    mass_bins=[1e10 * low_mass_cut / HUBBLE, 1e10 * high_mass_cut / HUBBLE], # Msun
+    quantiles=(0.16, 0.5, 0.84),
+    physical_units=True,
 )
+print(stats)
 
-per_16 = np.percentile(
-    list(profiles_df["property"]),
-    q=16,
-    axis=0
-)
-per_84 = np.percentile(
-    list(profiles_df["property"]),
-    q=84,
-    axis=0
-)
+# Radii in kpc, and values in physical units (Msun * kpc^-3)
+radii = stats["radius"].to_numpy() / 1000 # Dividing by 1000 to convert into Mpc
+median = stats["quantile_0.5"].to_numpy()
+per_16 = stats["quantile_0.16"].to_numpy()
+per_84 = stats["quantile_0.84"].to_numpy()
 
 print(median)
 
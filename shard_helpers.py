@@ -0,0 +1,307 @@
+# Sharded layout: one database file per simulation (or per simulation suite), with a catalog
+# mapping each simulation_unique_id to its shard. Each shard is a database with the usual
+# schema (see create_empty_database.py), so that writers can fill the shards independently,
+# in parallel, without waiting for each other's write lock.
+#
+# Layout of a shard directory:
+# - catalog.db: table "shards" (simulation_unique_id, shard_filename), with filenames relative to the directory
+# - <shard name>.db: e.g. IllustrisTNG_LH_0.db (per simulation) or IllustrisTNG.db (per suite)
+#
+# Ingest (the shards are loaded in parallel, -j shards at a time):
+#   python shard_helpers.py -d shards --shard_by simulation -j 8 --profile_layout both profiles/
+# Queries (same interface as filter_data_helpers.py), fanned out to the shards in a thread pool:
+#   sharded = ShardedDatabase("shards")
+#   halos = sharded.get_halos_based_on_filters([("M_Crit200", 30, 200)], [("simulation_unique_id", ["IllustrisTNG_LH_0"])])
+# Queries filtering on simulation_unique_id only read the shards of these simulations.
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+import os
+import subprocess
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+
+from database_helpers import Database, create_table
+from illstack_helpers import get_simulation_details_from_profile_filename
+import filter_data_helpers
+
+CATALOG_FILENAME = "catalog.db"
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+####################
+# Catalog
+
+def get_shard_name(simulation_unique_id, shard_by="simulation"):
+    """ Shard of a simulation: shard_by is "simulation" (one shard per simulation) or "suite" (one shard per simulation suite) """
+    if shard_by == "suite":
+        return simulation_unique_id.split("_")[0]
+    return simulation_unique_id
+
+def get_catalog(directory):
+    """ Database of the catalog of a shard directory (created if needed) """
+    catalog = Database(os.path.join(directory, CATALOG_FILENAME))
+    create_table(
+        "shards",
+        {
+            "simulation_unique_id" : "TEXT PRIMARY KEY",
+            "shard_filename" : "TEXT NOT NULL", # Relative to the shard directory
+        },
+        database=catalog,
+    )
+    return catalog
+
+def register_shard(catalog, shard_filename):
+    """ Add the simulations stored in a shard (i.e. with halos) to the catalog """
+    shard = Database(os.path.join(os.path.dirname(catalog.filename), shard_filename))
+    with shard:
+        simulation_ids = [row["simulation_unique_id"] for row in shard.execute("SELECT DISTINCT simulation_unique_id FROM halos")]
+
+    with catalog.transaction():
+        catalog.executemany(
+            "INSERT OR REPLACE INTO shards (simulation_unique_id, shard_filename) VALUES (?, ?)",
+            [(simulation_unique_id, shard_filename) for simulation_unique_id in simulation_ids],
+        )
+    return simulation_ids
+
+
+####################
+# Ingest
+
+def _run_script(arguments):
+    # The scripts read some files relative to the repository (e.g. CAMELS_parameters)
+    subprocess.run([sys.executable] + arguments, cwd=SCRIPTS_DIRECTORY, check=True, stdout=subprocess.DEVNULL)
+
+def populate_shard(directory, shard_name, profile_filenames, profile_layout="rows", workers=1, basepath=None, populate_simulations=False):
+    """ Create (if needed) and populate one shard from its .npz files, then its subhalos and merger trees if basepath is given
+    Each step runs one of the usual scripts in its own process, on the shard database.
+    """
+    # The scripts run in SCRIPTS_DIRECTORY, so the paths given relative to the current directory are made absolute
+    directory = os.path.abspath(directory)
+    profile_filenames = [os.path.abspath(f) for f in profile_filenames]
+    basepath = os.path.abspath(basepath) if basepath is not None else None
+
+    shard_filename = os.path.join(directory, f"{shard_name}.db")
+    if not os.path.exists(shard_filename):
+        _run_script(["create_empty_database.py", "-f", shard_filename, "--profile_filename", profile_filenames[0], "--profile_layout", profile_layout, "--defer_indexes"])
+        if populate_simulations:
+            _run_script(["populate_simulations_table.py", "-f", shard_filename])
+
+    _run_script(["bulk_populate_profiles.py", "-f", shard_filename, "--profile_layout", profile_layout, "-j", str(workers), "--defer_indexes"] + profile_filenames)
+
+    if basepath is not None:
+        _run_script(["bulk_populate_subhalos.py", "-f", shard_filename, "--basepath", basepath])
+        _run_script(["bulk_populate_mergertree.py", "-f", shard_filename, "--basepath", basepath])
+
+    return f"{shard_name}.db"
+
+def populate_shards(directory, profile_filenames, shard_by="simulation", shards_in_parallel=1, workers_per_shard=1, profile_layout="rows", basepath=None, populate_simulations=False):
+    """ Populate the shards of a shard directory from .npz files, shards_in_parallel shards at a time, and register them in the catalog """
+    directory = os.path.abspath(directory)
+    profile_filenames = [os.path.abspath(f) for f in profile_filenames]
+    basepath = os.path.abspath(basepath) if basepath is not None else None
+    os.makedirs(directory, exist_ok=True)
+    catalog = get_catalog(directory)
+
+    filenames_by_shard = {}
+    for profile_filename in profile_filenames:
+        simulation_unique_id = get_simulation_details_from_profile_filename(profile_filename)[3]
+        filenames_by_shard.setdefault(get_shard_name(simulation_unique_id, shard_by), []).append(profile_filename)
+
+    with ThreadPoolExecutor(max_workers=shards_in_parallel) as executor:
+        futures = [
+            executor.submit(populate_shard, directory, shard_name, filenames, profile_layout, workers_per_shard, basepath, populate_simulations)
+            for shard_name, filenames in filenames_by_shard.items()
+        ]
+        for future in futures:
+            shard_filename = future.result()
+            simulation_ids = register_shard(catalog, shard_filename)
+            print(f"{shard_filename}: {len(simulation_ids)} simulations")
+
+    catalog.close()
+
+
+####################
+# Federated queries
+
+def _get_simulation_ids(list_of_equality_filters, list_of_simulation_ids=()):
+    """ Simulations selected by the arguments of a query, or None if all simulations may match """
+    simulation_ids = set(list_of_simulation_ids) if len(list_of_simulation_ids) != 0 else None
+    for (column_name, values) in list_of_equality_filters:
+        if column_name == "simulation_unique_id" and len(values) != 0:
+            simulation_ids = set(values) if simulation_ids is None else simulation_ids & set(values)
+    return simulation_ids
+
+def _concat_padded(arrays):
+    # Concatenate along the first axis, padding the last axis (radial bins) with NaN
+    number_bins = max(a.shape[-1] for a in arrays)
+    return np.concatenate([
+        np.pad(a.astype(float), [(0, 0)] * (a.ndim - 1) + [(0, number_bins - a.shape[-1])], constant_values=np.nan) if a.shape[-1] != number_bins else a
+        for a in arrays
+    ])
+
+def _concat_dataframes(dataframes):
+    dataframes = [df for df in dataframes if len(df) != 0] or dataframes[:1]
+    if len(dataframes) == 0:
+        return pd.DataFrame()
+    return pd.concat(dataframes, ignore_index=True)
+
+def _concat_profiles(results):
+    # (halos, radii, profiles) tuples of get_profiles(packed=True) or get_halo_profiles
+    non_empty = [r for r in results if len(r[0]) != 0] or results[:1]
+    if len(non_empty) <= 1:
+        return non_empty[0] if len(non_empty) != 0 else (pd.DataFrame(), np.empty((0, 0)), {})
+
+    halos = pd.concat([r[0] for r in non_empty], ignore_index=True)
+    radii = _concat_padded([r[1] for r in non_empty])
+    if isinstance(non_empty[0][2], dict):
+        profiles = {k : _concat_padded([r[2][k] for r in non_empty]) for k in non_empty[0][2]}
+    else:
+        profiles = _concat_padded([r[2] for r in non_empty])
+    return halos, radii, profiles
+
+
+class ShardedDatabase:
+    """ Queries on a shard directory, with the same interface as filter_data_helpers.py
+    Each query runs on the relevant shards in a thread pool (with one connection per shard and thread),
+    and the results are concatenated in the order of the shard filenames. The iter_* functions read
+    the shards one after the other.
+    """
+
+    def __init__(self, directory, workers=None):
+        self.directory = directory
+        self.catalog = get_catalog(directory)
+        self._shards = {}
+        self._shards_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers or min(32, os.cpu_count() + 4))
+
+    def get_shard_filenames(self, simulation_ids=None):
+        """ Shards storing the given simulations (default: all shards), sorted by filename """
+        rows = self.catalog.execute("SELECT simulation_unique_id, shard_filename FROM shards")
+        return sorted({
+            row["shard_filename"]
+            for row in rows
+            if simulation_ids is None or row["simulation_unique_id"] in simulation_ids
+        })
+
+    def get_shard(self, shard_filename):
+        with self._shards_lock:
+            if shard_filename not in self._shards:
+                self._shards[shard_filename] = Database(os.path.join(self.directory, shard_filename))
+            return self._shards[shard_filename]
+
+    def _map(self, function, simulation_ids=None):
+        """ [function(shard database)] for the shards of the given simulations, run in the thread pool """
+        shards = [self.get_shard(f) for f in self.get_shard_filenames(simulation_ids)]
+        return list(self._executor.map(function, shards))
+
+    def _chain(self, function, simulation_ids=None):
+        shards = [self.get_shard(f) for f in self.get_shard_filenames(simulation_ids)]
+        return chain.from_iterable(function(shard) for shard in shards)
+
+    def get_all_simulation_details(self):
+        # Each shard may store the details of all simulations
+        simulations = _concat_dataframes(self._map(lambda shard: filter_data_helpers.get_all_simulation_details(database=shard)))
+        if "simulation_unique_id" in simulations:
+            simulations = simulations.drop_duplicates("simulation_unique_id", ignore_index=True)
+        return simulations
+
+    def get_halos_based_on_filters(self, list_of_inequality_filters, list_of_equality_filters, columns=None, physical_units=False):
+        return _concat_dataframes(self._map(
+            lambda shard: filter_data_helpers.get_halos_based_on_filters(list_of_inequality_filters, list_of_equality_filters, columns, physical_units=physical_units, database=shard),
+            _get_simulation_ids(list_of_equality_filters),
+        ))
+
+    def iter_halos_based_on_filters(self, list_of_inequality_filters, list_of_equality_filters, chunk_size=100000, columns=None, physical_units=False):
+        return self._chain(
+            lambda shard: filter_data_helpers.iter_halos_based_on_filters(list_of_inequality_filters, list_of_equality_filters, chunk_size, columns, physical_units=physical_units, database=shard),
+            _get_simulation_ids(list_of_equality_filters),
+        )
+
+    def get_profiles(self, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_properties, packed=False, columns=None, physical_units=False):
+        results = self._map(
+            lambda shard: filter_data_helpers.get_profiles(list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_properties, packed, columns, physical_units=physical_units, database=shard),
+            _get_simulation_ids([], list_of_simulation_ids),
+        )
+        if packed:
+            return _concat_profiles(results)
+        return _concat_dataframes(results)
+
+    def iter_profiles(self, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_properties, packed=False, chunk_size=100000, columns=None, physical_units=False):
+        return self._chain(
+            lambda shard: filter_data_helpers.iter_profiles(list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_properties, packed, chunk_size, columns, physical_units=physical_units, database=shard),
+            _get_simulation_ids([], list_of_simulation_ids),
+        )
+
+    def get_halo_profiles(self, list_of_inequality_filters, list_of_equality_filters, list_of_properties, halo_columns=None, packed=False, physical_units=False):
+        return _concat_profiles(self._map(
+            lambda shard: filter_data_helpers.get_halo_profiles(list_of_inequality_filters, list_of_equality_filters, list_of_properties, halo_columns, packed, physical_units=physical_units, database=shard),
+            _get_simulation_ids(list_of_equality_filters),
+        ))
+
+    def iter_halo_profiles(self, list_of_inequality_filters, list_of_equality_filters, list_of_properties, halo_columns=None, packed=False, chunk_size=10000, physical_units=False):
+        return self._chain(
+            lambda shard: filter_data_helpers.iter_halo_profiles(list_of_inequality_filters, list_of_equality_filters, list_of_properties, halo_columns, packed, chunk_size, physical_units=physical_units, database=shard),
+            _get_simulation_ids(list_of_equality_filters),
+        )
+
+    def get_subhalos(self, list_of_subhalo_ids, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_inequality_filters, list_of_equality_filters, columns=None, lazy_arrays=False, physical_units=False):
+        return _concat_dataframes(self._map(
+            lambda shard: filter_data_helpers.get_subhalos(list_of_subhalo_ids, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_inequality_filters, list_of_equality_filters, columns, lazy_arrays, physical_units=physical_units, database=shard),
+            _get_simulation_ids(list_of_equality_filters, list_of_simulation_ids),
+        ))
+
+    def iter_subhalos(self, list_of_subhalo_ids, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_inequality_filters, list_of_equality_filters, chunk_size=10000, columns=None, lazy_arrays=False, physical_units=False):
+        return self._chain(
+            lambda shard: filter_data_helpers.iter_subhalos(list_of_subhalo_ids, list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_inequality_filters, list_of_equality_filters, chunk_size, columns, lazy_arrays, physical_units=physical_units, database=shard),
+            _get_simulation_ids(list_of_equality_filters, list_of_simulation_ids),
+        )
+
+    def get_mergertree(self, starting_subfind_id, starting_snapshot, simulation_unique_id):
+        # A tree belongs to a single simulation, i.e. to a single shard
+        shard_filenames = self.get_shard_filenames({simulation_unique_id})
+        if len(shard_filenames) == 0:
+            raise KeyError(f"No shard stores {simulation_unique_id}")
+        return filter_data_helpers.get_mergertree(starting_subfind_id, starting_snapshot, simulation_unique_id, database=self.get_shard(shard_filenames[0]))
+
+    def close(self):
+        self._executor.shutdown()
+        for shard in self._shards.values():
+            shard.close()
+        self._shards = {}
+        self.catalog.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == "__main__":
+    from bulk_populate_profiles import find_profile_files
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", help=".npz files, directories containing .npz files, or glob patterns (see bulk_populate_profiles.py)", nargs="*", default=[])
+    parser.add_argument("-d", "--directory", help="Shard directory", default="shards", type=str)
+    parser.add_argument("--shard_by", help="One shard per 'simulation' or per simulation 'suite'", default="simulation", choices=["simulation", "suite"], type=str)
+    parser.add_argument("-j", "--shards_in_parallel", help="Number of shards populated at the same time", default=os.cpu_count(), type=int)
+    parser.add_argument("--workers_per_shard", help="Number of worker processes parsing .npz files for each shard", default=1, type=int)
+    parser.add_argument("--profile_layout", help="Storage layout of the radial profiles, see create_empty_database.py", default="rows", choices=["rows", "packed", "both"], type=str)
+    parser.add_argument("--basepath", help="Optional basepath to the CAMELS output files: if given, the subhalos and merger trees of each shard are also populated", default=None, type=str)
+    parser.add_argument("--populate_simulations", help="Populate the simulations table of new shards (see populate_simulations_table.py)", action="store_true")
+    parser.add_argument("--register", help="Register all shard files of the directory in the catalog, e.g. after populating shards with the usual scripts", action="store_true")
+    args = parser.parse_args()
+
+    if len(args.paths) != 0:
+        populate_shards(args.directory, find_profile_files(args.paths), args.shard_by, args.shards_in_parallel, args.workers_per_shard, args.profile_layout, args.basepath, args.populate_simulations)
+
+    if args.register:
+        catalog = get_catalog(args.directory)
+        for shard_filename in sorted(os.listdir(args.directory)):
+            if shard_filename.endswith(".db") and shard_filename != CATALOG_FILENAME:
+                print(f"{shard_filename}: {len(register_shard(catalog, shard_filename))} simulations")
+        catalog.close()
@@ -0,0 +1,220 @@
+# Spatial index on the subhalo positions (SubhaloPos), for box, sphere and nearest neighbour queries
+# The positions are stored as numbers in an R*Tree (SQLite's rtree module), with one partition per
+# (simulation, snapshot), so that spatial queries are index lookups instead of decoding every SubhaloPos blob.
+# Queries wrap around the periodic boundaries of the simulation box (BOX_SIZE, in ckpc/h).
+#
+# The index is built from the subhalos table (and updated by bulk_populate_subhalos.py):
+#   python spatial_helpers.py -f sample.db --build
+# Example:
+#   center = get_halo_position(10, "IllustrisTNG_LH_0", 33)
+#   satellites = get_subhalos_in_sphere("IllustrisTNG_LH_0", 33, center, 500, columns=["SubhaloMass"])
+#   neighbours = get_nearest_subhalos("IllustrisTNG_LH_0", 33, center, 10)
+import argparse
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+from database_helpers import set_database_filename, create_table, execute_query, get_database
+from index_helpers import get_existing_tables
+from query_helpers import check_identifier
+
+# Comoving side of the CAMELS boxes, in ckpc/h
+BOX_SIZE = 25000.0
+
+SPATIAL_INDEX_TABLE = "subhalos_rtree"
+SPATIAL_PARTITIONS_TABLE = "subhalos_rtree_partitions"
+
+# Columns of the results of the spatial queries, before the joined subhalos columns
+spatial_columns = ["subhaloID", "haloID", "x", "y", "z"]
+
+def create_spatial_index_tables(database=None):
+    # Each (simulation, snapshot) is a partition, stored as a fourth dimension of the R*Tree
+    create_table(
+        SPATIAL_PARTITIONS_TABLE,
+        {
+            "partition_id" : "INTEGER PRIMARY KEY",
+            "simulation_unique_id" : "TEXT NOT NULL",
+            "snapshot" : "INTEGER NOT NULL",
+            "number_subhalos" : "INTEGER NOT NULL",
+        },
+        unique=("simulation_unique_id", "snapshot"),
+        database=database,
+    )
+    # The bounds of the R*Tree are 32-bit floats, so the exact positions are stored in auxiliary columns
+    execute_query(f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {SPATIAL_INDEX_TABLE} USING rtree(
+        id, min_partition, max_partition, min_x, max_x, min_y, max_y, min_z, max_z,
+        +subhaloID INTEGER, +haloID INTEGER, +x REAL, +y REAL, +z REAL
+    )
+    """, database=database)
+
+def has_spatial_index(database=None):
+    return SPATIAL_INDEX_TABLE in get_existing_tables(database=database)
+
+def _get_partition(simulation_unique_id, snapshot, database=None):
+    """ (partition_id, number_subhalos) of a (simulation, snapshot), or None if it is not indexed """
+    data = execute_query(f"SELECT partition_id, number_subhalos FROM {SPATIAL_PARTITIONS_TABLE} WHERE simulation_unique_id = ? AND snapshot = ?", (simulation_unique_id, int(snapshot)), database=database)
+    if len(data) == 0:
+        return None
+    return data[0]["partition_id"], data[0]["number_subhalos"]
+
+def update_spatial_index(simulation_unique_id, snapshot, database=None):
+    """ (Re)index the subhalos of a (simulation, snapshot), e.g. after they were loaded again """
+    database = database or get_database()
+    snapshot = int(snapshot)
+
+    with database.transaction():
+        partition = _get_partition(simulation_unique_id, snapshot, database=database)
+        if partition is not None:
+            execute_query(f"DELETE FROM {SPATIAL_INDEX_TABLE} WHERE min_partition >= ? AND max_partition <= ?", (partition[0], partition[0]), database=database)
+            execute_query(f"DELETE FROM {SPATIAL_PARTITIONS_TABLE} WHERE partition_id = ?", (partition[0],), database=database)
+
+        rows = []
+        for _, chunk in database.iter_execute("SELECT subhaloID, haloID, SubhaloPos FROM subhalos WHERE simulation_unique_id = ? AND snapshot = ?", (simulation_unique_id, snapshot)):
+            rows.extend(chunk)
+
+        execute_query(f"INSERT INTO {SPATIAL_PARTITIONS_TABLE} (simulation_unique_id, snapshot, number_subhalos) VALUES (?, ?, ?)", (simulation_unique_id, snapshot, len(rows)), database=database)
+        partition_id = _get_partition(simulation_unique_id, snapshot, database=database)[0]
+
+        database.executemany(
+            f"INSERT INTO {SPATIAL_INDEX_TABLE} (min_partition, max_partition, min_x, max_x, min_y, max_y, min_z, max_z, subhaloID, haloID, x, y, z) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (partition_id, partition_id, x, x, y, y, z, z, subhalo_id, halo_id, x, y, z)
+                for subhalo_id, halo_id, position in rows
+                for x, y, z in [np.asarray(position, dtype=np.float64).tolist()]
+            ],
+        )
+
+    return len(rows)
+
+def build_spatial_index(rebuild=False, database=None):
+    """ Index the (simulation, snapshot) pairs of the subhalos table that are not indexed yet (or all of them, if rebuild) """
+    database = database or get_database()
+    if rebuild:
+        execute_query(f"DROP TABLE IF EXISTS {SPATIAL_INDEX_TABLE}", database=database)
+        execute_query(f"DROP TABLE IF EXISTS {SPATIAL_PARTITIONS_TABLE}", database=database)
+    create_spatial_index_tables(database=database)
+
+    data = execute_query(f"""
+    SELECT DISTINCT simulation_unique_id, snapshot FROM subhalos
+    EXCEPT
+    SELECT simulation_unique_id, snapshot FROM {SPATIAL_PARTITIONS_TABLE}
+    """, database=database)
+
+    for row in data:
+        number_subhalos = update_spatial_index(row["simulation_unique_id"], row["snapshot"], database=database)
+        print(f"{row['simulation_unique_id']} snapshot {row['snapshot']}: {number_subhalos} subhalos indexed")
+
+
+####################
+# Queries
+
+def _get_periodic_ranges(low, high, box_size):
+    """ Ranges within [0, box_size] covering [low, high] in a periodic box """
+    if box_size is None:
+        return [(low, high)]
+    if high - low >= box_size:
+        return [(0.0, box_size)]
+    low_wrapped = low % box_size
+    high_wrapped = low_wrapped + (high - low)
+    if high_wrapped <= box_size:
+        return [(low_wrapped, high_wrapped)]
+    return [(low_wrapped, box_size), (0.0, high_wrapped - box_size)]
+
+def _get_periodic_offsets(positions, center, box_size):
+    """ Offsets of the positions from the center, using the nearest periodic image """
+    offsets = positions - np.asarray(center, dtype=np.float64)
+    if box_size is not None:
+        offsets -= box_size * np.round(offsets / box_size)
+    return offsets
+
+def _query_boxes(partition_id, boxes, columns, database=None):
+    """ Subhalos of a partition within any of the (non-overlapping) boxes [(low, high) for x, y, z] """
+    select_list = ", ".join([f"r.{c} AS {c}" for c in spatial_columns] + [f"s.{check_identifier(c)} AS {c}" for c in columns])
+    join = ""
+    if len(columns) != 0:
+        # Uses the UNIQUE (subhaloID, haloID, simulation_unique_id, snapshot) index of the subhalos table
+        join = f"""
+        JOIN {SPATIAL_PARTITIONS_TABLE} p ON p.partition_id = r.min_partition
+        JOIN subhalos s ON s.subhaloID = r.subhaloID AND s.haloID = r.haloID AND s.simulation_unique_id = p.simulation_unique_id AND s.snapshot = p.snapshot
+        """
+    query = f"""
+    SELECT {select_list}
+    FROM {SPATIAL_INDEX_TABLE} r {join}
+    WHERE r.min_partition >= ? AND r.max_partition <= ?
+    AND r.max_x >= ? AND r.min_x <= ? AND r.max_y >= ? AND r.min_y <= ? AND r.max_z >= ? AND r.min_z <= ?
+    AND r.x BETWEEN ? AND ? AND r.y BETWEEN ? AND ? AND r.z BETWEEN ? AND ?
+    """
+
+    rows = []
+    for (x_low, x_high), (y_low, y_high), (z_low, z_high) in boxes:
+        bounds = (x_low, x_high, y_low, y_high, z_low, z_high)
+        rows.extend(execute_query(query, (partition_id, partition_id) + bounds + bounds, database=database))
+    return pd.DataFrame(rows, columns=spatial_columns + list(columns))
+
+def _get_partition_id(simulation_unique_id, snapshot, database=None):
+    partition = _get_partition(simulation_unique_id, snapshot, database=database)
+    if partition is None:
+        raise ValueError(f"{simulation_unique_id} snapshot {snapshot} is not in the spatial index (see build_spatial_index)")
+    return partition
+
+def get_subhalos_in_box(simulation_unique_id, snapshot, low, high, columns=(), box_size=BOX_SIZE, database=None):
+    """ Subhalos with positions in the box [low, high] (3D, in ckpc/h), wrapped around the periodic boundaries
+    Returns a DataFrame with subhaloID, haloID, the position (x, y, z), and the given columns of the subhalos table.
+    box_size: None for non-periodic queries.
+    """
+    partition_id, _ = _get_partition_id(simulation_unique_id, snapshot, database=database)
+    ranges = [_get_periodic_ranges(float(l), float(h), box_size) for l, h in zip(low, high)]
+    return _query_boxes(partition_id, list(product(*ranges)), columns, database=database)
+
+def get_subhalos_in_sphere(simulation_unique_id, snapshot, center, radius, columns=(), box_size=BOX_SIZE, database=None):
+    """ Subhalos within radius (ckpc/h) of the center, sorted by distance
+    Same columns as get_subhalos_in_box, with the distance to the center (using the nearest periodic image).
+    """
+    center = np.asarray(center, dtype=np.float64)
+    subhalos = get_subhalos_in_box(simulation_unique_id, snapshot, center - radius, center + radius, columns, box_size, database=database)
+
+    offsets = _get_periodic_offsets(subhalos[["x", "y", "z"]].to_numpy(dtype=np.float64), center, box_size)
+    subhalos["distance"] = np.sqrt(np.sum(offsets ** 2, axis=1))
+    subhalos = subhalos[subhalos["distance"] <= radius]
+    return subhalos.sort_values("distance", kind="stable").reset_index(drop=True)
+
+def get_nearest_subhalos(simulation_unique_id, snapshot, center, k, columns=(), box_size=BOX_SIZE, database=None):
+    """ The k subhalos nearest to the center, sorted by distance (same columns as get_subhalos_in_sphere)
+    Note that a subhalo at the center (e.g. the central subhalo of get_halo_position) is included.
+    """
+    partition_id, number_subhalos = _get_partition_id(simulation_unique_id, snapshot, database=database)
+    k = min(k, number_subhalos)
+    extent = BOX_SIZE if box_size is None else box_size
+
+    # Radius expected to contain about 2k subhalos for a uniform density, doubled until it contains k of them
+    radius = extent * (2 * max(k, 1) / max(number_subhalos, 1) * 3 / (4 * np.pi)) ** (1 / 3)
+    while True:
+        subhalos = get_subhalos_in_sphere(simulation_unique_id, snapshot, center, radius, columns, box_size, database=database)
+        if len(subhalos) >= k or (box_size is not None and radius >= np.sqrt(3) * box_size / 2):
+            return subhalos.head(k)
+        radius *= 2
+
+def get_halo_position(halo_id, simulation_unique_id, snapshot, database=None):
+    """ Position of a FoF halo, i.e. of its central (first) subhalo """
+    data = execute_query(
+        "SELECT SubhaloPos FROM subhalos WHERE simulation_unique_id = ? AND snapshot = ? AND haloID = ? ORDER BY subhaloID LIMIT 1",
+        (simulation_unique_id, int(snapshot), int(halo_id)),
+        database=database,
+    )
+    if len(data) == 0:
+        raise ValueError(f"Halo {halo_id} of {simulation_unique_id} snapshot {snapshot} has no subhalos")
+    return np.asarray(data[0]["SubhaloPos"], dtype=np.float64)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--database_filename", help="Database filename", default="sample.db", type=str)
+    parser.add_argument("--build", help="Index the subhalos of the (simulation, snapshot) pairs that are not indexed yet", action="store_true")
+    parser.add_argument("--rebuild", help="Index all subhalos again", action="store_true")
+    args = parser.parse_args()
+
+    set_database_filename(args.database_filename)
+    if args.build or args.rebuild:
+        build_spatial_index(rebuild=args.rebuild)
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_helpers import AsyncQueryPool, gather
+from database_helpers import Database, create_table, populate_table, execute_query
+import filter_data_helpers
+
+PROPERTIES = ["gas_density", "temperature"]
+RADII = [0.1, 1.0, 10.0]
+
+# Runs for minutes unless it is interrupted
+LONG_QUERY = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT COUNT(*) FROM n WHERE i < 0"
+
+
+@pytest.fixture(scope="module")
+def database_filename(tmp_path_factory):
+    database_filename = str(tmp_path_factory.mktemp("async_helpers") / "test.db")
+    database = Database(database_filename)
+
+    create_table("halos", {"snapshot" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "ID" : "INTEGER", "M_Crit200" : "REAL"}, unique=("snapshot", "simulation_unique_id", "ID"), database=database)
+    create_table("profiles", {"ID" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "snapshot" : "INTEGER NOT NULL", "radius" : "REAL NOT NULL", "property_key" : "TEXT NOT NULL", "property_value" : "REAL"}, unique=("ID", "simulation_unique_id", "snapshot", "radius", "property_key"), database=database)
+
+    halos = [(33, f"IllustrisTNG_LH_{s}", i, float(i)) for s in range(2) for i in range(30)]
+    profiles = [(i, s, snapshot, r, k, float(i * r)) for (snapshot, s, i, _) in halos for r in RADII for k in PROPERTIES]
+    with database.transaction():
+        populate_table("halos", ["snapshot", "simulation_unique_id", "ID", "M_Crit200"], halos, database=database)
+        populate_table("profiles", ["ID", "simulation_unique_id", "snapshot", "radius", "property_key", "property_value"], profiles, database=database)
+    database.close()
+    return database_filename
+
+
+def test_concurrent_queries(database_filename):
+    filters = [("M_Crit200", 5, 20)]
+
+    async def fetch():
+        async with AsyncQueryPool(database_filename, max_connections=3) as pool:
+            return await gather(
+                pool.get_halos_based_on_filters(filters, []),
+                pool.get_halo_profiles(filters, [("simulation_unique_id", ["IllustrisTNG_LH_1"])], ["gas_density"]),
+                pool.get_profiles([3], [], [], PROPERTIES),
+            )
+    halos, (profile_halos, radii, profiles), rows = asyncio.run(fetch())
+
+    with Database(database_filename, read_only=True) as database:
+        expected_halos = filter_data_helpers.get_halos_based_on_filters(filters, [], database=database)
+        expected_rows = filter_data_helpers.get_profiles([3], [], [], PROPERTIES, database=database)
+    assert halos.equals(expected_halos)
+    assert rows.equals(expected_rows)
+    assert len(profile_halos) == 16
+    np.testing.assert_allclose(profiles["gas_density"], profile_halos["ID"].to_numpy()[:, None] * np.array(RADII))
+
+def test_cancelled_query_is_interrupted(database_filename):
+    async def run():
+        async with AsyncQueryPool(database_filename, max_connections=1) as pool:
+            start = time.perf_counter()
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(pool._run(execute_query, LONG_QUERY), timeout=0.2)
+            # The only connection is free again
+            halos = await asyncio.wait_for(pool.get_halos_based_on_filters([], []), timeout=10)
+            return time.perf_counter() - start, halos
+    seconds, halos = asyncio.run(run())
+    assert seconds < 10
+    assert len(halos) == 60
+
+def test_gather_cancels_the_other_queries(database_filename):
+    async def run():
+        async with AsyncQueryPool(database_filename, max_connections=2) as pool:
+            start = time.perf_counter()
+            with pytest.raises(ValueError):
+                await gather(
+                    pool._run(execute_query, LONG_QUERY),
+                    pool.get_halos_based_on_filters([("not a column", 0, 1)], []),
+                )
+            return time.perf_counter() - start
+    assert asyncio.run(run()) < 10
+
+def test_connections_are_read_only(database_filename):
+    async def run():
+        async with AsyncQueryPool(database_filename) as pool:
+            await pool._run(execute_query, "DELETE FROM halos")
+    with pytest.raises(Exception, match="readonly"):
+        asyncio.run(run())
@@ -0,0 +1,71 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database_helpers import Database, create_table, populate_table
+from cache_helpers import ResultCache, copy_result, get_result_size
+import filter_data_helpers
+
+PROPERTIES = ["gas_density", "temperature"]
+RADII = [0.1, 1.0]
+
+
+@pytest.fixture(scope="module")
+def database(tmp_path_factory):
+    database = Database(str(tmp_path_factory.mktemp("cache_helpers") / "test.db"))
+
+    create_table("halos", {"snapshot" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "ID" : "INTEGER", "M_Crit200" : "REAL"}, unique=("snapshot", "simulation_unique_id", "ID"), database=database)
+    create_table("profiles", {"ID" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "snapshot" : "INTEGER NOT NULL", "radius" : "REAL NOT NULL", "property_key" : "TEXT NOT NULL", "property_value" : "REAL"}, unique=("ID", "simulation_unique_id", "snapshot", "radius", "property_key"), database=database)
+
+    halos = [(33, "IllustrisTNG_LH_0", i, float(i)) for i in range(20)]
+    profiles = [(i, s, snapshot, r, k, float(i + r)) for (snapshot, s, i, _) in halos for r in RADII for k in PROPERTIES]
+    with database.transaction():
+        populate_table("halos", ["snapshot", "simulation_unique_id", "ID", "M_Crit200"], halos, database=database)
+        populate_table("profiles", ["ID", "simulation_unique_id", "snapshot", "radius", "property_key", "property_value"], profiles, database=database)
+
+    yield database
+    database.close()
+
+@pytest.fixture
+def result_cache():
+    yield filter_data_helpers.enable_result_cache()
+    filter_data_helpers.disable_result_cache()
+
+
+def test_nested_results():
+    result = (pd.DataFrame({"ID" : [1, 2]}), np.zeros((2, 3)), {"gas_density" : np.ones((2, 3)), "temperature" : np.ones((2, 3))}, [np.ones(4)])
+    assert get_result_size(result) == get_result_size(result[0]) + 6 * 8 + 2 * 6 * 8 + 4 * 8
+
+    copied = copy_result(result)
+    copied[2]["gas_density"][0, 0] = 5
+    copied[2]["temperature"] = None
+    copied[3][0][0] = 5
+    assert result[2]["gas_density"][0, 0] == 1
+    assert result[2]["temperature"] is not None
+    assert result[3][0][0] == 1
+
+def test_modified_halo_profiles_do_not_change_the_cache(database, result_cache):
+    halos, radii, profiles = filter_data_helpers.get_halo_profiles([], [], PROPERTIES, database=database)
+    expected = {k : v.copy() for k, v in profiles.items()}
+
+    profiles["gas_density"] *= 2
+    profiles["temperature"][:] = np.nan
+    del profiles["gas_density"]
+    halos["ID"] = -1
+
+    cached_halos, _, cached_profiles = filter_data_helpers.get_halo_profiles([], [], PROPERTIES, database=database)
+    assert result_cache.hits == 1
+    assert (cached_halos["ID"] >= 0).all()
+    assert sorted(cached_profiles) == sorted(expected)
+    for k, v in expected.items():
+        np.testing.assert_array_equal(cached_profiles[k], v)
+
+def test_cached_profiles_are_counted(database):
+    cache = ResultCache()
+    halos, radii, profiles = cache.get_or_compute(database, "halo_profiles", lambda: filter_data_helpers.get_halo_profiles([], [], PROPERTIES, database=database))
+    assert cache._memory_bytes == get_result_size(halos) + radii.nbytes + sum(v.nbytes for v in profiles.values())
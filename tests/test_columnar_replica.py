@@ -0,0 +1,106 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database_helpers import Database, create_table, populate_table
+from index_helpers import get_existing_tables
+from columnar_replica import MANIFEST_FILENAME, ColumnarReplica, export_replica
+import filter_data_helpers
+
+PROPERTIES = ["gas_density", "temperature"]
+RADII = [0.1, 1.0, 10.0]
+SIMULATIONS = ["IllustrisTNG_LH_1", "IllustrisTNG_LH_0"]
+NUMBER_HALOS = 12
+
+
+@pytest.fixture(scope="module", params=["rows", "packed"])
+def replica(request, tmp_path_factory):
+    directory = tmp_path_factory.mktemp(f"columnar_replica_{request.param}")
+    database = Database(str(directory / "test.db"))
+
+    create_table("halos", {"snapshot" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "ID" : "INTEGER", "M_Crit200" : "REAL", "GroupNsubs" : "INTEGER"}, unique=("snapshot", "simulation_unique_id", "ID"), database=database)
+    create_table("subhalos", {"subhaloID" : "INTEGER NOT NULL", "haloID" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "snapshot" : "INTEGER NOT NULL", "SubhaloMass" : "REAL", "SubhaloPos" : "ARRAY", "SubhaloSpin" : "ARRAY"}, unique=("subhaloID", "haloID", "simulation_unique_id", "snapshot"), database=database)
+
+    # Simulations inserted out of order, and an INTEGER column with NULL values
+    halos = [(33, s, i, float(10 * j + i), None if i == 3 else i % 4) for j, s in enumerate(SIMULATIONS) for i in range(NUMBER_HALOS)]
+    # The last halo of each simulation has no profiles
+    profiles = [(i, s, snapshot, r, k, float(i + r) if k == "gas_density" else -float(i)) for (snapshot, s, i, _, _) in halos if i != NUMBER_HALOS - 1 for r in RADII for k in PROPERTIES]
+    # SubhaloSpin has values of different shapes, so it is not exported
+    subhalos = [(2 * i + n, i, s, 33, float(i), np.array([i, n, 1.0]), np.zeros(3 if i != 5 else 2)) for (_, s, i, _, _) in halos for n in range(2)]
+
+    with database.transaction():
+        populate_table("halos", ["snapshot", "simulation_unique_id", "ID", "M_Crit200", "GroupNsubs"], halos, database=database)
+        populate_table("subhalos", ["subhaloID", "haloID", "simulation_unique_id", "snapshot", "SubhaloMass", "SubhaloPos", "SubhaloSpin"], subhalos, database=database)
+        if request.param == "rows":
+            create_table("profiles", {"ID" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "snapshot" : "INTEGER NOT NULL", "radius" : "REAL NOT NULL", "property_key" : "TEXT NOT NULL", "property_value" : "REAL"}, unique=("ID", "simulation_unique_id", "snapshot", "radius", "property_key"), database=database)
+            populate_table("profiles", ["ID", "simulation_unique_id", "snapshot", "radius", "property_key", "property_value"], profiles, database=database)
+        else:
+            create_table("profiles_packed", {"ID" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "snapshot" : "INTEGER NOT NULL", "property_keys" : "TEXT NOT NULL", "radius" : "ARRAY NOT NULL", "property_values" : "ARRAY NOT NULL"}, unique=("ID", "simulation_unique_id", "snapshot"), database=database)
+            packed = [(i, s, snapshot, ",".join(PROPERTIES), np.array(RADII), np.array([[i + r for r in RADII], [-float(i)] * len(RADII)])) for (snapshot, s, i, _, _) in halos if i != NUMBER_HALOS - 1]
+            populate_table("profiles_packed", ["ID", "simulation_unique_id", "snapshot", "property_keys", "radius", "property_values"], packed, database=database)
+
+    export_replica(str(directory / "replica"), chunk_size=5, database=database)
+    yield database, ColumnarReplica(str(directory / "replica"))
+    database.close()
+
+
+def test_halos(replica):
+    database, replica = replica
+    for inequality_filters, equality_filters in [([], []), ([("M_Crit200", 5, 15)], []), ([], [("simulation_unique_id", ["IllustrisTNG_LH_1", "IllustrisTNG_LH_7"])]), ([], [("GroupNsubs", [1, 2])])]:
+        halos = replica.get_halos_based_on_filters(inequality_filters, equality_filters)
+        expected = filter_data_helpers.get_halos_based_on_filters(inequality_filters, equality_filters, database=database)
+        expected = expected.sort_values(["simulation_unique_id", "snapshot", "ID"], ignore_index=True)
+        assert list(halos.columns) == list(expected.columns)
+        assert list(halos["simulation_unique_id"]) == list(expected["simulation_unique_id"])
+        np.testing.assert_array_equal(halos["ID"], expected["ID"])
+        np.testing.assert_array_equal(halos["M_Crit200"], expected["M_Crit200"])
+        # NULL values are NaN
+        np.testing.assert_array_equal(halos["GroupNsubs"], expected["GroupNsubs"].astype(float))
+
+def test_halo_profiles(replica):
+    database, replica = replica
+    halos, radii, profiles = replica.get_halo_profiles([("M_Crit200", 8, 100)], [], PROPERTIES, halo_columns=["M_Crit200"])
+    packed = "profiles_packed" in get_existing_tables(database=database)
+    expected_halos, expected_radii, expected_profiles = filter_data_helpers.get_halo_profiles([("M_Crit200", 8, 100)], [], PROPERTIES, halo_columns=["M_Crit200"], packed=packed, database=database)
+
+    # Halos without profiles are not returned
+    assert len(halos) == len(expected_halos) == 2 * (NUMBER_HALOS - 1) - 8
+    order = np.lexsort((expected_halos["ID"], expected_halos["simulation_unique_id"]))
+    np.testing.assert_array_equal(halos["M_Crit200"], expected_halos["M_Crit200"].to_numpy()[order])
+    np.testing.assert_array_equal(radii, expected_radii[order])
+    for k in PROPERTIES:
+        np.testing.assert_array_equal(profiles[k], expected_profiles[k][order])
+
+def test_profiles(replica):
+    database, replica = replica
+    rows = replica.get_profiles([2, 4], ["IllustrisTNG_LH_1"], [], ["temperature"])
+    assert len(rows) == 2 * len(RADII)
+    assert list(rows["ID"]) == [2] * len(RADII) + [4] * len(RADII)
+    np.testing.assert_array_equal(rows["radius"], RADII * 2)
+    np.testing.assert_array_equal(rows["property_value"], -rows["ID"].astype(float))
+
+    halos, radii, values = replica.get_profiles([], ["IllustrisTNG_LH_0"], [], [], packed=True)
+    assert values.shape == (NUMBER_HALOS - 1, len(PROPERTIES), len(RADII))
+    np.testing.assert_array_equal(values[:, 0], halos["ID"].to_numpy()[:, None] + np.array(RADII))
+    if "profiles_packed" in get_existing_tables(database=database):
+        _, expected_radii, expected_values = filter_data_helpers.get_profiles([], ["IllustrisTNG_LH_0"], [], [], packed=True, database=database)
+        np.testing.assert_array_equal(radii, expected_radii)
+        np.testing.assert_array_equal(values, expected_values)
+
+def test_subhalos(replica):
+    database, replica = replica
+    subhalos = replica.get_subhalos([], [3], ["IllustrisTNG_LH_0"], [], [("SubhaloMass", 0, 10)], [])
+    assert "SubhaloSpin" not in subhalos
+    assert list(subhalos["subhaloID"]) == [6, 7]
+    np.testing.assert_array_equal(np.stack(subhalos["SubhaloPos"]), [[3, 0, 1], [3, 1, 1]])
+
+def test_incomplete_replica(replica, tmp_path):
+    # The manifest is written last
+    with pytest.raises(FileNotFoundError):
+        ColumnarReplica(str(tmp_path))
+    _, replica = replica
+    assert os.path.exists(os.path.join(replica.directory, MANIFEST_FILENAME))
@@ -0,0 +1,122 @@
+import os
+import sqlite3
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database_helpers import Database, create_table, populate_table, populate_table_in_batches, execute_query
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = Database(str(tmp_path / "test.db"))
+    create_table("halos", {"snapshot" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "ID" : "INTEGER", "M_Crit200" : "REAL"}, unique=("snapshot", "simulation_unique_id", "ID"), database=database)
+    yield database
+    database.close()
+
+def insert_halos(database, ids):
+    populate_table("halos", ["snapshot", "simulation_unique_id", "ID", "M_Crit200"], [(33, "IllustrisTNG_LH_0", i, float(i)) for i in ids], database=database)
+
+def count_halos(database):
+    return execute_query("SELECT COUNT(*) AS n FROM halos", database=database)[0]["n"]
+
+
+def test_pragmas(database):
+    assert database.execute("PRAGMA journal_mode")[0]["journal_mode"] == "wal"
+    assert database.execute("PRAGMA synchronous")[0]["synchronous"] == 1 # NORMAL
+    assert database.execute("PRAGMA temp_store")[0]["temp_store"] == 2 # MEMORY
+    assert database.execute("PRAGMA cache_size")[0]["cache_size"] == -64000
+
+def test_connection_is_kept(database):
+    connection = database.connection
+    insert_halos(database, range(3))
+    assert count_halos(database) == 3
+    assert database.connection is connection
+
+def test_transactions(database):
+    with database.transaction():
+        insert_halos(database, range(3))
+        # Nested transactions join the outermost one
+        with database.transaction():
+            insert_halos(database, range(3, 5))
+        assert database.in_transaction
+    assert not database.in_transaction
+    assert count_halos(database) == 5
+
+    # (populate_table ignores duplicate rows, but INSERT fails on them)
+    insert_query = "INSERT INTO halos (snapshot, simulation_unique_id, ID, M_Crit200) VALUES (?, ?, ?, ?)"
+    with pytest.raises(sqlite3.IntegrityError):
+        with database.transaction():
+            insert_halos(database, range(5, 10))
+            database.execute(insert_query, (33, "IllustrisTNG_LH_0", 0, 1.0))
+    assert count_halos(database) == 5
+
+    # A failed batch rolls back the previous batches
+    with pytest.raises(sqlite3.IntegrityError):
+        database.executemany_batches(insert_query, [[(33, "IllustrisTNG_LH_0", 10, 1.0)], [(33, "IllustrisTNG_LH_0", 0, 1.0)]])
+    assert count_halos(database) == 5
+    populate_table_in_batches("halos", ["snapshot", "simulation_unique_id", "ID", "M_Crit200"], [[(33, "IllustrisTNG_LH_0", 10, 1.0)], [(33, "IllustrisTNG_LH_0", 0, 1.0)]], database=database)
+    assert count_halos(database) == 6
+
+def test_thread_local_connections(database):
+    insert_halos(database, range(4))
+    connections = {}
+    counts = {}
+
+    def read(name):
+        connections[name] = database.connection
+        counts[name] = count_halos(database)
+
+    threads = [threading.Thread(target=read, args=(i,)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert counts == {0 : 4, 1 : 4, 2 : 4}
+    assert len({id(c) for c in connections.values()} | {id(database.connection)}) == 4
+
+def test_several_files(database, tmp_path):
+    with Database(str(tmp_path / "other.db")) as other:
+        create_table("halos", {"snapshot" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "ID" : "INTEGER", "M_Crit200" : "REAL"}, database=other)
+        insert_halos(database, range(2))
+        insert_halos(other, range(7))
+        assert count_halos(database) == 2
+        assert count_halos(other) == 7
+
+def test_read_only(database):
+    insert_halos(database, range(2))
+    with Database(database.filename, read_only=True) as reader:
+        assert count_halos(reader) == 2
+        with pytest.raises(sqlite3.OperationalError):
+            insert_halos(reader, [5])
+
+def test_data_version(database):
+    version = database.get_data_version()
+    assert database.get_data_version() == version
+    # Commits of the same connection
+    insert_halos(database, [0])
+    assert database.get_data_version() != version
+
+    # Commits of another connection
+    version = database.get_data_version()
+    with Database(database.filename) as writer:
+        insert_halos(writer, [1])
+    assert database.get_data_version() != version
+
+def test_iter_execute(database):
+    insert_halos(database, range(25))
+    chunks = list(database.iter_execute("SELECT ID FROM halos ORDER BY ID", chunk_size=10))
+    assert [len(rows) for _, rows in chunks] == [10, 10, 5]
+    assert chunks[0][0] == ["ID"]
+    assert [row[0] for _, rows in chunks for row in rows] == list(range(25))
+
+def test_array_columns(database):
+    create_table("subhalos", {"subhaloID" : "INTEGER", "SubhaloPos" : "ARRAY"}, database=database)
+    position = np.array([1.0, 2.5, 3.0])
+    populate_table("subhalos", ["subhaloID", "SubhaloPos"], [(0, position)], database=database)
+    np.testing.assert_array_equal(database.execute("SELECT SubhaloPos FROM subhalos")[0]["SubhaloPos"], position)
@@ -0,0 +1,105 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database_helpers import Database, create_table, populate_table
+from index_helpers import create_indexes
+from filter_data_helpers import get_halo_profiles, iter_halo_profiles, _build_halo_profiles_query, _get_halo_profiles_columns
+
+SIMULATION_IDS = ["IllustrisTNG_LH_0", "IllustrisTNG_LH_1", "SIMBA_LH_0"]
+PROPERTIES = ["gas_density", "gas_pressure", "metallicity", "temperature"]
+RADII = [0.01, 0.1, 1.0]
+NUMBER_HALOS = 200
+
+
+@pytest.fixture(scope="module")
+def database(tmp_path_factory):
+    database = Database(str(tmp_path_factory.mktemp("filter_data_helpers") / "test.db"))
+    rng = np.random.default_rng(0)
+
+    create_table("halos", {"snapshot" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "ID" : "INTEGER", "M_Crit200" : "REAL"}, unique=("snapshot", "simulation_unique_id", "ID"), database=database)
+    create_table("profiles", {"ID" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "snapshot" : "INTEGER NOT NULL", "radius" : "REAL NOT NULL", "property_key" : "TEXT NOT NULL", "property_value" : "REAL"}, unique=("ID", "simulation_unique_id", "snapshot", "radius", "property_key"), database=database)
+    create_table("profiles_packed", {"ID" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "snapshot" : "INTEGER NOT NULL", "property_keys" : "TEXT NOT NULL", "radius" : "ARRAY NOT NULL", "property_values" : "ARRAY NOT NULL"}, unique=("ID", "simulation_unique_id", "snapshot"), database=database)
+
+    halos = [(snapshot, s, i, float(10**rng.uniform(0, 4))) for s in SIMULATION_IDS for snapshot in (32, 33) for i in range(NUMBER_HALOS)]
+    values = rng.normal(size=(len(halos), len(PROPERTIES), len(RADII)))
+    # Rows inserted in another order than (halo, property_key, radius)
+    profiles = [(i, s, snapshot, r, k, float(values[h, p, b])) for b, r in reversed(list(enumerate(RADII))) for p, k in enumerate(PROPERTIES) for h, (snapshot, s, i, _) in enumerate(halos)]
+    profiles_packed = [(i, s, snapshot, ",".join(PROPERTIES), np.array(RADII), values[h]) for h, (snapshot, s, i, _) in enumerate(halos)]
+    with database.transaction():
+        populate_table("halos", ["snapshot", "simulation_unique_id", "ID", "M_Crit200"], halos, database=database)
+        populate_table("profiles", ["ID", "simulation_unique_id", "snapshot", "radius", "property_key", "property_value"], profiles, database=database)
+        populate_table("profiles_packed", ["ID", "simulation_unique_id", "snapshot", "property_keys", "radius", "property_values"], profiles_packed, database=database)
+    create_indexes(database=database)
+
+    yield database, halos, values
+    database.close()
+
+
+def get_expected_profiles(halos, values, list_of_inequality_filters, list_of_equality_filters, list_of_properties):
+    # {(ID, simulation_unique_id, snapshot) : {property : profile}} of the selected halos
+    expected = {}
+    for h, (snapshot, s, i, mass) in enumerate(halos):
+        row = {"snapshot" : snapshot, "simulation_unique_id" : s, "ID" : i, "M_Crit200" : mass}
+        if any((low is not None and row[c] < low) or (high is not None and row[c] > high) for c, low, high in list_of_inequality_filters):
+            continue
+        if any(row[c] not in v for c, v in list_of_equality_filters):
+            continue
+        expected[(i, s, snapshot)] = {k : values[h, PROPERTIES.index(k)] for k in list_of_properties}
+    return expected
+
+def check_halo_profiles(expected, halos, radii, profiles):
+    keys = list(zip(halos.ID, halos.simulation_unique_id, halos.snapshot))
+    assert sorted(keys) == sorted(expected)
+    np.testing.assert_array_equal(radii, np.tile(RADII, (len(keys), 1)))
+    for j, key in enumerate(keys):
+        for k, profile in expected[key].items():
+            np.testing.assert_array_equal(profiles[k][j], profile)
+
+
+FILTERS = [
+    ([("M_Crit200", 30, 200)], []),
+    ([("M_Crit200", 5000, None)], []),
+    ([("M_Crit200", None, 100)], [("simulation_unique_id", SIMULATION_IDS[1:])]),
+    ([], [("snapshot", [33]), ("ID", list(range(0, NUMBER_HALOS, 3)))]),
+]
+
+####################
+# Joined halos and profiles
+
+@pytest.mark.parametrize("packed", [False, True])
+@pytest.mark.parametrize("filters", FILTERS)
+def test_halo_profiles(database, filters, packed):
+    database, halos, values = database
+    list_of_properties = ["temperature", "gas_density"]
+    expected = get_expected_profiles(halos, values, *filters, list_of_properties)
+    assert len(expected) != 0
+
+    check_halo_profiles(expected, *get_halo_profiles(*filters, list_of_properties, packed=packed, database=database))
+
+    chunks = list(iter_halo_profiles(*filters, list_of_properties, packed=packed, chunk_size=7, database=database))
+    assert all(len(chunk_halos) <= 7 for chunk_halos, _, _ in chunks)
+    assert sum(len(chunk_halos) for chunk_halos, _, _ in chunks) == len(expected)
+    for chunk in chunks:
+        check_halo_profiles({key : expected[key] for key in zip(chunk[0].ID, chunk[0].simulation_unique_id, chunk[0].snapshot)}, *chunk)
+
+@pytest.mark.parametrize("packed", [False, True])
+@pytest.mark.parametrize("filters", FILTERS)
+def test_halo_profiles_are_not_sorted_as_a_whole(database, filters, packed):
+    database, _, _ = database
+    halo_columns = _get_halo_profiles_columns(["M_Crit200"], database=database)
+    query = _build_halo_profiles_query(*filters, ["gas_density"], halo_columns, packed=packed)
+    plan = query.explain(database=database)
+    # halos is the outer loop, and no sort buffers all joined rows
+    assert "halos" in plan[0]
+    assert not any("TEMP B-TREE FOR ORDER BY" in detail for detail in plan)
+
+def test_halo_profiles_use_the_mass_index(database):
+    database, _, _ = database
+    halo_columns = _get_halo_profiles_columns(["M_Crit200"], database=database)
+    query = _build_halo_profiles_query([("M_Crit200", 5000, None)], [], ["gas_density"], halo_columns)
+    assert "idx_halos_M_Crit200" in query.explain(database=database)[0]
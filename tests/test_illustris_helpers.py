@@ -0,0 +1,61 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+# illustris_python and h5py stand-ins, reading the synthetic data
+sys.path.insert(0, os.path.join(REPOSITORY, "benchmarks"))
+
+from synthetic_data import generate_simulations
+from illustris_helpers import get_tree_ranges, get_root_trees, iter_trees, load_tree, _get_tree_windows
+import illustris_python as il
+
+
+@pytest.fixture(scope="module")
+def basepath(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("illustris_helpers")
+    generate_simulations(str(directory), number_simulations=1, halos_per_simulation=100, tree_files=3, number_radial_bins=2)
+    return os.path.join(str(directory), "simulations", "IllustrisTNG", "LH_0") + "/"
+
+@pytest.fixture(scope="module")
+def tree_ranges(basepath):
+    subfind_ids = np.arange(len(il.groupcat.loadSubhalos(basepath, 33, fields=["SubhaloMass"])))
+    snapshots = np.full(len(subfind_ids), 33)
+    ranges = get_tree_ranges(basepath, snapshots, subfind_ids)
+    roots = get_root_trees(ranges[0], ranges[1])
+    return subfind_ids[roots], [r[roots] for r in ranges]
+
+@pytest.fixture(scope="module")
+def expected_trees(basepath, tree_ranges):
+    subfind_ids, _ = tree_ranges
+    return [load_tree(basepath, 33, int(subfind_id)) for subfind_id in subfind_ids]
+
+
+@pytest.mark.parametrize("max_window_rows", [1, 50, 2**20])
+def test_iter_trees_matches_load_tree(basepath, tree_ranges, expected_trees, max_window_rows):
+    subfind_ids, ranges = tree_ranges
+    trees = list(iter_trees(basepath, *ranges, max_window_rows=max_window_rows))
+    assert sorted(i for i, _ in trees) == list(range(len(subfind_ids)))
+    for i, tree in trees:
+        expected = expected_trees[i]
+        assert tree["count"] == expected["count"]
+        for field in expected:
+            np.testing.assert_array_equal(tree[field], expected[field])
+
+@pytest.mark.parametrize("max_window_rows", [1, 50, 200])
+def test_tree_windows_are_bounded(basepath, tree_ranges, max_window_rows):
+    _, (tree_subhalo_ids, tree_last_progenitor_ids, tree_row_numbers) = tree_ranges
+    offsets = il.sublink.subLinkOffsets(basepath, "SubLink")
+    row_stops = tree_row_numbers + (tree_last_progenitor_ids - tree_subhalo_ids) + 1
+    file_numbers = np.searchsorted(offsets, tree_row_numbers, side="right") - 1
+    order = np.lexsort((tree_row_numbers, file_numbers))
+
+    windows = _get_tree_windows(order, file_numbers, tree_row_numbers, row_stops, max_window_rows)
+    assert np.array_equal(np.concatenate(windows), order)
+    for window in windows:
+        assert len(set(file_numbers[window])) == 1
+        # Larger trees have their own window
+        assert row_stops[window].max() - tree_row_numbers[window].min() <= max_window_rows or len(window) == 1
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database_helpers import Database, create_table
+from index_helpers import SECONDARY_INDEXES, create_indexes, get_existing_indexes, get_helper_queries, report_index_usage
+
+
+@pytest.fixture(scope="module")
+def database(tmp_path_factory):
+    # Rows layout: no profiles_packed table, and no subhalos or mergertree tables
+    database = Database(str(tmp_path_factory.mktemp("index_helpers") / "test.db"))
+    create_table("halos", {"snapshot" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "ID" : "INTEGER", "M_Crit200" : "REAL"}, unique=("snapshot", "simulation_unique_id", "ID"), database=database)
+    create_table("profiles", {"ID" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "snapshot" : "INTEGER NOT NULL", "radius" : "REAL NOT NULL", "property_key" : "TEXT NOT NULL", "property_value" : "REAL"}, unique=("ID", "simulation_unique_id", "snapshot", "radius", "property_key"), database=database)
+    create_indexes(database=database)
+    yield database
+    database.close()
+
+
+def test_indexes_of_existing_tables(database):
+    expected = {name for name, (table_name, _) in SECONDARY_INDEXES.items() if table_name in ("halos", "profiles")}
+    assert set(get_existing_indexes(database=database)) == expected
+
+def test_helper_queries_list_their_tables():
+    for description, table_names, query in get_helper_queries():
+        assert query.table_name in table_names, description
+        for join in query.joins:
+            # e.g. "CROSS JOIN profiles ON ...", without the temporary tables of long IN lists
+            joined_table = join.split(" ON ")[0].split()[-1]
+            assert joined_table.startswith("temp.") or joined_table in table_names, description
+
+def test_report_skips_missing_tables(database, capsys):
+    report_index_usage(database=database)
+    output = capsys.readouterr().out
+    assert "(no profiles_packed table)" in output
+    assert "(no subhalos table)" in output
+    assert "idx_halos_M_Crit200" in output
@@ -0,0 +1,89 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database_helpers import Database, create_table, populate_table
+from parameter_helpers import PARAMETERS, normalize_parameters, get_parameter_index, get_simulations_in_parameter_box, get_nearest_simulations, join_simulation_parameters
+
+simulations_columns = {
+    "simulation_unique_id" : "TEXT PRIMARY KEY",
+    "simulation_suite" : "TEXT NOT NULL",
+    "simulation_name" : "TEXT NOT NULL",
+    **{p : "REAL NOT NULL" for p in PARAMETERS},
+    "seed" : "REAL NOT NULL",
+}
+
+
+def get_rows(suite, first, number, rng):
+    return [
+        [f"{suite}_LH_{i}", suite, f"LH_{i}", rng.uniform(0.1, 0.5), rng.uniform(0.6, 1.0), rng.uniform(0.25, 4), rng.uniform(0.25, 4), rng.uniform(0.5, 2), rng.uniform(0.5, 2), i]
+        for i in range(first, first + number)
+    ]
+
+@pytest.fixture
+def database(tmp_path):
+    database = Database(str(tmp_path / "test.db"))
+    create_table("simulations", simulations_columns, database=database)
+    rng = np.random.default_rng(3)
+    populate_table("simulations", list(simulations_columns), get_rows("IllustrisTNG", 0, 50, rng) + get_rows("SIMBA", 0, 30, rng), database=database)
+    yield database
+    database.close()
+
+def get_all_simulations(database):
+    return pd.DataFrame(database.execute("SELECT * FROM simulations ORDER BY simulation_unique_id"))
+
+
+def test_parameter_box(database):
+    simulations = get_all_simulations(database)
+    result = get_simulations_in_parameter_box({"Omega_m" : 0.2}, {"Omega_m" : 0.4, "A_SN1" : 1}, simulation_suites=["IllustrisTNG"], database=database)
+    mask = (simulations["Omega_m"] >= 0.2) & (simulations["Omega_m"] <= 0.4) & (simulations["A_SN1"] <= 1) & (simulations["simulation_suite"] == "IllustrisTNG")
+    assert len(result) > 0
+    assert list(result["simulation_unique_id"]) == list(simulations["simulation_unique_id"][mask])
+
+    assert len(get_simulations_in_parameter_box(database=database)) == len(simulations)
+
+@pytest.mark.parametrize("k", [1, 5, 200])
+def test_nearest_simulations(database, k):
+    simulations = get_all_simulations(database)
+    point = {"Omega_m" : 0.3, "sigma_8" : 0.8, "A_SN1" : 1.0, "A_AGN1" : 1.0, "A_SN2" : 1.0, "A_AGN2" : 1.0}
+    result = get_nearest_simulations(point, k, database=database)
+
+    distances = np.sqrt(np.sum((normalize_parameters(simulations[PARAMETERS].to_numpy()) - normalize_parameters([point[p] for p in PARAMETERS])) ** 2, axis=1))
+    expected = np.argsort(distances, kind="stable")[:k]
+    assert list(result["simulation_unique_id"]) == list(simulations["simulation_unique_id"].iloc[expected])
+    np.testing.assert_allclose(result["distance"], distances[expected])
+
+    # Over a subset of the parameters, e.g. the cosmology only
+    result = get_nearest_simulations({"Omega_m" : 0.3, "sigma_8" : 0.8}, k, simulation_suites=["SIMBA"], database=database)
+    assert (result["simulation_suite"] == "SIMBA").all()
+    assert len(result) == min(k, 30)
+    assert result["distance"].is_monotonic_increasing
+
+def test_index_is_reloaded_when_the_database_changes(database):
+    index = get_parameter_index(database=database)
+    assert get_parameter_index(database=database) is index
+
+    populate_table("simulations", list(simulations_columns), get_rows("IllustrisTNG", 50, 1, np.random.default_rng(4)), database=database)
+    index = get_parameter_index(database=database)
+    assert len(index.simulations) == 81
+    assert "IllustrisTNG_LH_50" in set(get_simulations_in_parameter_box(database=database)["simulation_unique_id"])
+
+    # Commits of another connection
+    with Database(database.filename) as writer:
+        populate_table("simulations", list(simulations_columns), get_rows("IllustrisTNG", 51, 1, np.random.default_rng(5)), database=writer)
+    assert len(get_parameter_index(database=database).simulations) == 82
+
+def test_join_simulation_parameters(database):
+    simulations = get_all_simulations(database).set_index("simulation_unique_id")
+    halos = pd.DataFrame({"ID" : [0, 1, 2], "simulation_unique_id" : ["SIMBA_LH_3", "IllustrisTNG_LH_7", "Astrid_LH_0"]})
+
+    joined = join_simulation_parameters(halos, ["Omega_m", "A_AGN2"], database=database)
+    assert list(joined.columns) == ["ID", "simulation_unique_id", "Omega_m", "A_AGN2"]
+    assert "Omega_m" not in halos
+    np.testing.assert_allclose(joined["Omega_m"][:2], simulations.loc[["SIMBA_LH_3", "IllustrisTNG_LH_7"], "Omega_m"])
+    assert np.isnan(joined["A_AGN2"][2])
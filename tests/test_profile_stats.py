@@ -0,0 +1,90 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database_helpers import Database, create_table, populate_table
+from filter_data_helpers import get_halo_profiles
+from profile_stats import BinnedProfileStats, get_binned_profile_stats, get_value_edges
+
+SIMULATION_IDS = ["IllustrisTNG_LH_0", "SIMBA_LH_0"]
+PROPERTIES = ["gas_density", "gas_pressure"]
+RADII = [0.01, 0.1, 1.0]
+NUMBER_HALOS = 300
+
+
+@pytest.fixture(scope="module")
+def database(tmp_path_factory):
+    database = Database(str(tmp_path_factory.mktemp("profile_stats") / "test.db"))
+    rng = np.random.default_rng(0)
+
+    create_table("halos", {"snapshot" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "ID" : "INTEGER", "M_Crit200" : "REAL"}, unique=("snapshot", "simulation_unique_id", "ID"), database=database)
+    create_table("profiles", {"ID" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "snapshot" : "INTEGER NOT NULL", "radius" : "REAL NOT NULL", "property_key" : "TEXT NOT NULL", "property_value" : "REAL"}, unique=("ID", "simulation_unique_id", "snapshot", "radius", "property_key"), database=database)
+
+    halos = [(33, s, i, float(10**rng.uniform(0, 3))) for s in SIMULATION_IDS for i in range(NUMBER_HALOS)]
+    # Code units: densities around 1e-2 and pressures around 1e-3, i.e. about 1e7 Msun kpc^-3 and 1e-24 Msun kpc^-1 s^-2
+    scales = {"gas_density" : 1e-2, "gas_pressure" : 1e-3}
+    profiles = [(i, s, snapshot, r, k, float(scales[k] * 10**rng.normal(0, 0.5))) for (snapshot, s, i, _) in halos for r in RADII for k in PROPERTIES]
+    with database.transaction():
+        populate_table("halos", ["snapshot", "simulation_unique_id", "ID", "M_Crit200"], halos, database=database)
+        populate_table("profiles", ["ID", "simulation_unique_id", "snapshot", "radius", "property_key", "property_value"], profiles, database=database)
+
+    yield database
+    database.close()
+
+
+QUANTILES = (0.16, 0.5, 0.84)
+# Relative width of the histogram bins, with the default 200 bins per decade
+BIN_WIDTH = 10 ** (1 / 200) - 1
+
+def check_quantile(quantile, values, q):
+    # Between the two sorted values around the quantile (as interpolated by np.quantile), up to the width of a bin
+    sorted_values = np.sort(values, axis=0)
+    k = int(np.floor(q * (len(values) - 1)))
+    low, high = sorted_values[k], sorted_values[min(k + 1, len(values) - 1)]
+    assert np.all(quantile >= np.minimum(low * (1 - BIN_WIDTH), low * (1 + BIN_WIDTH)))
+    assert np.all(quantile <= np.maximum(high * (1 - BIN_WIDTH), high * (1 + BIN_WIDTH)))
+    # and close to np.quantile for these well-sampled cells
+    np.testing.assert_allclose(quantile, np.quantile(values, q, axis=0), rtol=0.03)
+
+@pytest.mark.parametrize("physical_units", [False, True])
+def test_quantiles_match_numpy(database, physical_units):
+    halos, _, profiles = get_halo_profiles([], [], PROPERTIES, halo_columns=["M_Crit200"], physical_units=physical_units, database=database)
+    mass_bins = [halos["M_Crit200"].min(), halos["M_Crit200"].median(), halos["M_Crit200"].max() + 1]
+    stats = get_binned_profile_stats([], [], PROPERTIES, mass_bins, quantiles=QUANTILES, chunk_size=50, physical_units=physical_units, database=database)
+
+    mass_index = np.searchsorted(mass_bins, halos["M_Crit200"], side="right") - 1
+    for property_key in PROPERTIES:
+        for m in range(len(mass_bins) - 1):
+            rows = stats[(stats["property_key"] == property_key) & (stats["mass_bin"] == m)].sort_values("radial_bin")
+            values = profiles[property_key][mass_index == m]
+            np.testing.assert_array_equal(rows["count"], len(values))
+            for i, q in enumerate(QUANTILES):
+                check_quantile(rows[f"quantile_{q:g}"].to_numpy(), values, q)
+            np.testing.assert_allclose(rows["mean"], values.mean(axis=0), rtol=1e-10)
+
+def test_merge_with_other_value_ranges():
+    rng = np.random.default_rng(1)
+    values = [scale * 10**rng.normal(0, 0.5, size=(500, 2)) for scale in (1e-20, 1.0, 1e20)]
+    values[1][:10] = 0
+    values[1][10:20] *= -1
+
+    stats = [BinnedProfileStats([0, 1], ["p"]) for _ in values]
+    for s, v in zip(stats, values):
+        s.add(np.full(len(v), 0.5), np.ones(v.shape), {"p" : v})
+    merged = BinnedProfileStats([0, 1], ["p"])
+    for s in stats:
+        merged.merge(s)
+
+    all_values = np.concatenate(values)
+    for i, q in enumerate(QUANTILES):
+        check_quantile(merged.get_quantiles()[i, 0, 0], all_values, q)
+    assert merged.histograms[0].sum() == all_values.size
+
+def test_fixed_value_edges_warn_out_of_range():
+    stats = BinnedProfileStats([0, 1], ["gas_pressure"], value_edges=get_value_edges(value_range=(1e-10, 1e10)))
+    with pytest.warns(UserWarning, match="gas_pressure"):
+        stats.add([0.5, 0.5], np.ones((2, 1)), {"gas_pressure" : np.array([[1e-24], [1.0]])})
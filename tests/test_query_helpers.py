@@ -0,0 +1,183 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database_helpers import Database, create_table, populate_table
+from query_helpers import Query, MIN_IN_LIST_LENGTH, TEMP_TABLE_THRESHOLD
+
+SIMULATION_IDS = ["IllustrisTNG_LH_0", "IllustrisTNG_LH_1", "SIMBA_LH_0"]
+PROPERTIES = ["gas_density", "gas_pressure", "metallicity", "temperature"]
+NUMBER_HALOS = 600
+
+
+@pytest.fixture(scope="module")
+def database(tmp_path_factory):
+    database = Database(str(tmp_path_factory.mktemp("query_helpers") / "test.db"))
+    rng = np.random.default_rng(0)
+
+    create_table("halos", {"snapshot" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "ID" : "INTEGER", "M_Crit200" : "REAL"}, unique=("snapshot", "simulation_unique_id", "ID"), database=database)
+    create_table("profiles", {"ID" : "INTEGER NOT NULL", "simulation_unique_id" : "TEXT NOT NULL", "snapshot" : "INTEGER NOT NULL", "radius" : "REAL NOT NULL", "property_key" : "TEXT NOT NULL", "property_value" : "REAL"}, unique=("ID", "simulation_unique_id", "snapshot", "radius", "property_key"), database=database)
+
+    halos = [(snapshot, s, i, float(rng.uniform(1, 1000))) for s in SIMULATION_IDS for snapshot in (32, 33) for i in range(NUMBER_HALOS)]
+    profiles = [(i, s, snapshot, r, k, float(rng.normal())) for (snapshot, s, i, _) in halos for r in (0.1, 1.0) for k in PROPERTIES]
+    with database.transaction():
+        populate_table("halos", ["snapshot", "simulation_unique_id", "ID", "M_Crit200"], halos, database=database)
+        populate_table("profiles", ["ID", "simulation_unique_id", "snapshot", "radius", "property_key", "property_value"], profiles, database=database)
+
+    yield database
+    database.close()
+
+
+####################
+# SQL built with f-strings by the helpers before query_helpers.Query (see git history of filter_data_helpers.py)
+
+def get_old_halos_sql(list_of_inequality_filters, list_of_equality_filters):
+    query = "SELECT * FROM halos"
+    query_where_clauses = []
+    for (column_name, lower_limit, upper_limit) in list_of_inequality_filters:
+        if lower_limit is not None:
+            query_where_clauses.append(f"{column_name} >= {lower_limit}")
+        if upper_limit is not None:
+            query_where_clauses.append(f"{column_name} <= {upper_limit}")
+    for (column_name, values) in list_of_equality_filters:
+        if isinstance(values[0], str):
+            values = [f"'{v}'" for v in values]
+        query_where_clauses.append(f"{column_name} IN ({','.join([str(v) for v in values])})")
+    if len(query_where_clauses) != 0:
+        query += " WHERE " + " AND ".join(query_where_clauses)
+    return query
+
+def get_old_profiles_sql(list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_properties):
+    query = "SELECT * FROM profiles"
+    query_where_clauses = []
+    if len(list_of_halo_ids) != 0:
+        query_where_clauses.append("ID IN (" + ",".join([f"'{h}'" for h in list_of_halo_ids]) + ")")
+    if len(list_of_simulation_ids) != 0:
+        query_where_clauses.append("simulation_unique_id IN (" + ",".join([f"'{s}'" for s in list_of_simulation_ids]) + ")")
+    if len(list_of_snapshots) != 0:
+        query_where_clauses.append("snapshot IN (" + ",".join([f"'{s}'" for s in list_of_snapshots]) + ")")
+    if len(list_of_properties) != 0:
+        query_where_clauses.append("property_key IN (" + ",".join([f"'{p}'" for p in list_of_properties]) + ")")
+    if len(query_where_clauses) != 0:
+        query += " WHERE " + " AND ".join(query_where_clauses)
+    return query
+
+def get_profiles_query(list_of_halo_ids, list_of_simulation_ids, list_of_snapshots, list_of_properties):
+    query = Query("profiles")
+    query.where_in("ID", list_of_halo_ids)
+    query.where_in("simulation_unique_id", list_of_simulation_ids)
+    query.where_in("snapshot", list_of_snapshots)
+    query.where_in("property_key", list_of_properties)
+    return query
+
+def get_sorted_rows(rows):
+    return sorted(tuple(row.values()) for row in rows)
+
+
+####################
+# Same results as the f-string SQL
+
+# Lengths below, at and above the padding sizes, and above the temporary table threshold
+HALO_LIST_LENGTHS = [1, 3, MIN_IN_LIST_LENGTH, 5, 8, 9, TEMP_TABLE_THRESHOLD, TEMP_TABLE_THRESHOLD + 1, 500]
+
+@pytest.mark.parametrize("length", HALO_LIST_LENGTHS)
+def test_profiles_query_matches_old_sql(database, length):
+    rng = np.random.default_rng(length)
+    halo_ids = rng.choice(NUMBER_HALOS + 10, length, replace=False) # Including IDs without rows
+    arguments = (halo_ids.tolist(), SIMULATION_IDS[:2], [33], PROPERTIES[:3])
+
+    query = get_profiles_query(*arguments)
+    assert (len(query.temp_tables) != 0) == (length > TEMP_TABLE_THRESHOLD)
+
+    expected = get_sorted_rows(database.execute(get_old_profiles_sql(*arguments)))
+    assert len(expected) != 0
+    assert get_sorted_rows(query.execute(database=database)) == expected
+
+def test_duplicate_and_numpy_values(database):
+    halo_ids = np.array([5, 5, 7, 1, 7], dtype=np.int64)
+    query = get_profiles_query(halo_ids, np.array(SIMULATION_IDS[:1]), [np.int32(33)], [])
+    expected = get_sorted_rows(database.execute(get_old_profiles_sql(halo_ids.tolist(), SIMULATION_IDS[:1], [33], [])))
+    assert get_sorted_rows(query.execute(database=database)) == expected
+
+    # Same with a temporary table
+    halo_ids = np.repeat(np.arange(200), 2)
+    query = get_profiles_query(halo_ids, [], [32], ["temperature"])
+    assert len(query.temp_tables) == 1
+    expected = get_sorted_rows(database.execute(get_old_profiles_sql(halo_ids.tolist(), [], [32], ["temperature"])))
+    assert get_sorted_rows(query.execute(database=database)) == expected
+
+@pytest.mark.parametrize("filters", [
+    ([("M_Crit200", 30, 200)], []),
+    ([("M_Crit200", None, 100)], [("simulation_unique_id", SIMULATION_IDS[1:])]),
+    ([("M_Crit200", 500, None)], [("ID", list(range(0, 600, 2)))]), # Temporary table
+    ([], [("snapshot", [32]), ("ID", [1, 2, 3, 4, 5])]),
+])
+def test_halos_query_matches_old_sql(database, filters):
+    list_of_inequality_filters, list_of_equality_filters = filters
+    query = Query("halos")
+    for (column_name, lower_limit, upper_limit) in list_of_inequality_filters:
+        query.where_range(column_name, lower_limit, upper_limit)
+    for (column_name, values) in list_of_equality_filters:
+        query.where_in(column_name, values)
+
+    expected = get_sorted_rows(database.execute(get_old_halos_sql(list_of_inequality_filters, list_of_equality_filters)))
+    assert len(expected) != 0
+    assert get_sorted_rows(query.execute(database=database)) == expected
+    chunked_rows = [dict(zip(columns, row)) for columns, chunk in query.iter_execute(chunk_size=100, database=database) for row in chunk]
+    assert get_sorted_rows(chunked_rows) == expected
+
+def test_join_with_temp_table_matches_old_sql(database):
+    halo_ids = list(range(0, NUMBER_HALOS, 2))
+    query = Query("halos", ["ID", "simulation_unique_id", "snapshot", "M_Crit200"])
+    query.where_in("ID", halo_ids)
+    query.where_equal("snapshot", 33)
+    query.join("profiles", ["ID", "simulation_unique_id", "snapshot"], ["property_key", "radius", "property_value"])
+    query.where_in("property_key", ["gas_density"], table_name="profiles")
+    assert len(query.temp_tables) == 1
+
+    old_sql = f"""
+    SELECT halos.ID, halos.simulation_unique_id, halos.snapshot, halos.M_Crit200, profiles.property_key, profiles.radius, profiles.property_value
+    FROM halos JOIN profiles ON halos.ID = profiles.ID AND halos.simulation_unique_id = profiles.simulation_unique_id AND halos.snapshot = profiles.snapshot
+    WHERE halos.ID IN ({','.join([str(h) for h in halo_ids])}) AND halos.snapshot = 33 AND profiles.property_key IN ('gas_density')
+    """
+    expected = get_sorted_rows(database.execute(old_sql))
+    assert len(expected) == len(halo_ids) * len(SIMULATION_IDS) * 2
+    assert get_sorted_rows(query.execute(database=database)) == expected
+
+    # The temporary tables are dropped after the query
+    assert len(database.execute("SELECT name FROM temp.sqlite_master WHERE type = 'table'")) == 0
+
+
+####################
+# Query shapes
+
+def test_in_lists_are_padded_to_powers_of_2():
+    sql = {}
+    for length in range(1, TEMP_TABLE_THRESHOLD + 1):
+        query = Query("profiles").where_in("ID", list(range(length)))
+        padded_length = len(query.params)
+        assert padded_length >= max(length, MIN_IN_LIST_LENGTH)
+        assert padded_length & (padded_length - 1) == 0
+        assert query.params[length:] == [length - 1] * (padded_length - length)
+        sql.setdefault(padded_length, set()).add(query.sql)
+    # One statement per padded length
+    assert all(len(statements) == 1 for statements in sql.values())
+    assert sorted(sql) == [4, 8, 16, 32, 64, 128, 256]
+
+def test_values_are_bound():
+    query = Query("halos").where_in("simulation_unique_id", ["a'); DROP TABLE halos; --"])
+    assert "DROP" not in query.sql
+    with pytest.raises(ValueError):
+        Query("halos").where_in("ID; DROP TABLE halos", [1])
+
+def test_cache_key_ignores_temp_table_names():
+    halo_ids = list(range(TEMP_TABLE_THRESHOLD + 1))
+    first = Query("profiles").where_in("ID", halo_ids)
+    second = Query("profiles").where_in("ID", halo_ids)
+    assert first.sql != second.sql
+    assert first.cache_key == second.cache_key
+    assert first.cache_key != Query("profiles").where_in("ID", halo_ids[:-1] + [10**6]).cache_key
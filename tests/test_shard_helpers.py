@@ -0,0 +1,66 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+sys.path.insert(0, os.path.join(REPOSITORY, "benchmarks"))
+
+from synthetic_data import generate_simulations
+from shard_helpers import ShardedDatabase, populate_shards
+from units_helpers import HUBBLE
+
+NUMBER_HALOS = 30
+
+
+@pytest.fixture(scope="module")
+def shard_directory(tmp_path_factory):
+    # Populated with paths relative to the current directory, which is not the directory of the scripts
+    directory = tmp_path_factory.mktemp("shard_helpers")
+    generate_simulations(str(directory / "synthetic"), number_simulations=2, halos_per_simulation=NUMBER_HALOS, tree_files=1, number_radial_bins=5)
+
+    current_directory = os.getcwd()
+    os.chdir(directory)
+    try:
+        profile_filenames = sorted(os.path.join("synthetic", "profiles", f) for f in os.listdir(os.path.join("synthetic", "profiles")))
+        populate_shards("shards", profile_filenames, profile_layout="both")
+    finally:
+        os.chdir(current_directory)
+    return str(directory / "shards")
+
+
+def test_relative_paths(shard_directory):
+    assert sorted(f for f in os.listdir(shard_directory) if f.endswith(".db")) == ["IllustrisTNG_LH_0.db", "IllustrisTNG_LH_1.db", "catalog.db"]
+
+    with ShardedDatabase(shard_directory) as sharded:
+        halos = sharded.get_halos_based_on_filters([], [])
+        assert len(halos) == 2 * NUMBER_HALOS
+        assert sorted(halos["simulation_unique_id"].unique()) == ["IllustrisTNG_LH_0", "IllustrisTNG_LH_1"]
+
+        halos = sharded.get_halos_based_on_filters([], [("simulation_unique_id", ["IllustrisTNG_LH_1"])])
+        assert len(halos) == NUMBER_HALOS
+
+def test_sharded_halo_profiles(shard_directory):
+    with ShardedDatabase(shard_directory) as sharded:
+        halos, radii, profiles = sharded.get_halo_profiles([], [], ["gas_density"])
+        packed_halos, packed_radii, packed_profiles = sharded.get_halo_profiles([], [], ["gas_density"], packed=True)
+
+    assert len(halos) == 2 * NUMBER_HALOS
+    order = np.lexsort((halos.ID, halos.simulation_unique_id))
+    packed_order = np.lexsort((packed_halos.ID, packed_halos.simulation_unique_id))
+    np.testing.assert_allclose(radii[order], packed_radii[packed_order])
+    np.testing.assert_allclose(profiles["gas_density"][order], packed_profiles["gas_density"][packed_order])
+
+def test_sharded_physical_units(shard_directory):
+    with ShardedDatabase(shard_directory) as sharded:
+        halos, radii, profiles = sharded.get_halo_profiles([], [], ["gas_density"])
+        converted_halos, converted_radii, converted_profiles = sharded.get_halo_profiles([], [], ["gas_density"], physical_units=True)
+        # Snapshot 33, at z = 0
+        np.testing.assert_allclose(converted_halos["M_Crit200"], halos["M_Crit200"] * 1e10 / HUBBLE)
+        np.testing.assert_allclose(converted_radii, radii / HUBBLE)
+        np.testing.assert_allclose(converted_profiles["gas_density"], profiles["gas_density"] * 1e10 * HUBBLE ** 2)
+
+        converted_halos = next(sharded.iter_halos_based_on_filters([], [], physical_units=True))
+        assert converted_halos["M_Crit200"].iloc[0] == pytest.approx(halos["M_Crit200"].iloc[0] * 1e10 / HUBBLE)
@@ -0,0 +1,87 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database_helpers import Database, create_table, populate_table, execute_query
+from spatial_helpers import BOX_SIZE, build_spatial_index, update_spatial_index, has_spatial_index, get_subhalos_in_box, get_subhalos_in_sphere, get_nearest_subhalos, get_halo_position
+
+SIMULATION = "IllustrisTNG_LH_0"
+NUMBER_SUBHALOS = 500
+
+
+def get_offsets(positions, center):
+    # Nearest periodic image
+    offsets = positions - center
+    return offsets - BOX_SIZE * np.round(offsets / BOX_SIZE)
+
+@pytest.fixture(scope="module")
+def database(tmp_path_factory):
+    database = Database(str(tmp_path_factory.mktemp("spatial_helpers") / "test.db"))
+    create_table("subhalos", {"subhaloID" : "INTEGER", "haloID" : "INTEGER", "simulation_unique_id" : "TEXT NOT NULL", "snapshot" : "INTEGER NOT NULL", "SubhaloMass" : "REAL", "SubhaloPos" : "ARRAY"}, unique=("subhaloID", "haloID", "simulation_unique_id", "snapshot"), database=database)
+
+    rng = np.random.default_rng(2)
+    positions = rng.uniform(0, BOX_SIZE, (NUMBER_SUBHALOS, 3))
+    rows = [(i, i // 5, SIMULATION, snapshot, float(i), positions[i]) for snapshot in [32, 33] for i in range(NUMBER_SUBHALOS)]
+    populate_table("subhalos", ["subhaloID", "haloID", "simulation_unique_id", "snapshot", "SubhaloMass", "SubhaloPos"], rows, database=database)
+
+    assert not has_spatial_index(database=database)
+    build_spatial_index(database=database)
+    yield database, positions
+    database.close()
+
+
+def test_box_wraps_around(database):
+    database, positions = database
+    # Around a corner of the box
+    low, high = np.array([-2000.0, 23000.0, -3000.0]), np.array([4000.0, 27000.0, 5000.0])
+    subhalos = get_subhalos_in_box(SIMULATION, 33, low, high, columns=["SubhaloMass"], database=database)
+
+    center, half_size = (low + high) / 2, (high - low) / 2
+    expected = np.flatnonzero(np.all(np.abs(get_offsets(positions, center)) <= half_size, axis=1))
+    assert len(expected) > 0
+    assert sorted(subhalos["subhaloID"]) == list(expected)
+    np.testing.assert_array_equal(subhalos["SubhaloMass"], subhalos["subhaloID"].astype(float))
+
+    # Without periodic boundaries
+    subhalos = get_subhalos_in_box(SIMULATION, 33, low, high, box_size=None, database=database)
+    expected = np.flatnonzero(np.all((positions >= low) & (positions <= high), axis=1))
+    assert sorted(subhalos["subhaloID"]) == list(expected)
+
+def test_sphere(database):
+    database, positions = database
+    center, radius = np.array([24000.0, 1000.0, 12500.0]), 4000.0
+    subhalos = get_subhalos_in_sphere(SIMULATION, 33, center, radius, database=database)
+
+    distances = np.sqrt(np.sum(get_offsets(positions, center) ** 2, axis=1))
+    expected = np.flatnonzero(distances <= radius)
+    assert sorted(subhalos["subhaloID"]) == list(expected)
+    assert subhalos["distance"].is_monotonic_increasing
+    np.testing.assert_allclose(subhalos["distance"], distances[subhalos["subhaloID"]])
+
+@pytest.mark.parametrize("k", [1, 10, NUMBER_SUBHALOS + 10])
+def test_nearest_subhalos(database, k):
+    database, positions = database
+    center = get_halo_position(7, SIMULATION, 33, database=database)
+    np.testing.assert_array_equal(center, positions[35])
+
+    subhalos = get_nearest_subhalos(SIMULATION, 33, center, k, database=database)
+    distances = np.sqrt(np.sum(get_offsets(positions, center) ** 2, axis=1))
+    assert list(subhalos["subhaloID"]) == list(np.argsort(distances, kind="stable")[:k])
+    assert subhalos["subhaloID"].iloc[0] == 35
+
+def test_update_spatial_index(database):
+    database, positions = database
+    execute_query("UPDATE subhalos SET SubhaloPos = ? WHERE subhaloID = 0 AND snapshot = 32", (np.array([1.0, 2.0, 3.0]),), database=database)
+    assert update_spatial_index(SIMULATION, 32, database=database) == NUMBER_SUBHALOS
+
+    subhalos = get_subhalos_in_box(SIMULATION, 32, [0, 0, 0], [5, 5, 5], box_size=None, database=database)
+    assert list(subhalos["subhaloID"]) == [0]
+    # Other partitions are not changed
+    assert len(get_subhalos_in_box(SIMULATION, 33, [0, 0, 0], [BOX_SIZE] * 3, database=database)) == NUMBER_SUBHALOS
+
+    with pytest.raises(ValueError, match="spatial index"):
+        get_subhalos_in_box(SIMULATION, 20, [0, 0, 0], [1, 1, 1], database=database)
@@ -0,0 +1,111 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+sys.path.insert(0, os.path.join(REPOSITORY, "benchmarks"))
+
+from async_helpers import AsyncQueryPool
+from columnar_replica import ColumnarReplica, export_replica
+from database_helpers import Database
+from filter_data_helpers import get_halos_based_on_filters, get_halo_profiles, get_profiles, get_subhalos, iter_profiles
+from synthetic_data import generate_simulations, get_snapshot_redshift
+from units_helpers import HUBBLE, get_stored_redshifts
+
+SNAPSHOT = 30
+NUMBER_HALOS = 20
+
+
+def run_script(arguments):
+    # With the illustris_python and h5py stand-ins of the benchmarks directory
+    environment = dict(os.environ, PYTHONPATH=os.path.join(REPOSITORY, "benchmarks"))
+    subprocess.run([sys.executable] + arguments, cwd=REPOSITORY, env=environment, check=True, stdout=subprocess.DEVNULL)
+
+@pytest.fixture(scope="module")
+def database(tmp_path_factory):
+    # Synthetic simulation of another snapshot than 33, ingested with the usual scripts
+    directory = str(tmp_path_factory.mktemp("units_helpers"))
+    profile_filenames = generate_simulations(directory, number_simulations=1, halos_per_simulation=NUMBER_HALOS, snapshot=SNAPSHOT, tree_files=1, number_radial_bins=4)
+    database_filename = os.path.join(directory, "test.db")
+
+    run_script(["create_empty_database.py", "-f", database_filename, "--profile_filename", profile_filenames[0], "--profile_layout", "both"])
+    run_script(["bulk_populate_profiles.py", "-f", database_filename, "--profile_layout", "both", "-j", "1"] + profile_filenames)
+
+    database = Database(database_filename)
+    yield database, os.path.join(directory, "simulations") + "/"
+    database.close()
+
+@pytest.fixture(scope="module")
+def loaded_database(database):
+    # With the redshift stored (by test_redshifts_are_stored_with_the_subhalos, if it ran first)
+    database, basepath = database
+    if len(get_stored_redshifts(database=database)) == 0:
+        run_script(["bulk_populate_subhalos.py", "-f", database.filename, "--basepath", basepath])
+    return database
+
+
+def test_redshifts_are_stored_with_the_subhalos(database):
+    database, basepath = database
+    with pytest.raises(ValueError, match=f"snapshot {SNAPSHOT}"):
+        get_halos_based_on_filters([], [], physical_units=True, database=database)
+
+    run_script(["bulk_populate_subhalos.py", "-f", database.filename, "--basepath", basepath])
+    redshift = get_snapshot_redshift(SNAPSHOT)
+    assert redshift != 0
+    assert get_stored_redshifts(database=database) == {("IllustrisTNG_LH_0", SNAPSHOT) : pytest.approx(redshift)}
+
+    halos = get_halos_based_on_filters([], [], physical_units=True, database=database)
+    code_halos = get_halos_based_on_filters([], [], database=database)
+    assert len(halos) == NUMBER_HALOS
+    # Comoving ckpc/h to physical kpc, and 1e10 Msun/h to Msun
+    np.testing.assert_allclose(halos["R_Crit200"], code_halos["R_Crit200"] / (1 + redshift) / HUBBLE)
+    np.testing.assert_allclose(halos["M_Crit200"], code_halos["M_Crit200"] * 1e10 / HUBBLE)
+
+    _, radii, profiles = get_halo_profiles([], [], ["gas_density"], physical_units=True, database=database)
+    _, code_radii, code_profiles = get_halo_profiles([], [], ["gas_density"], database=database)
+    np.testing.assert_allclose(radii, code_radii / (1 + redshift) / HUBBLE)
+    np.testing.assert_allclose(profiles["gas_density"], code_profiles["gas_density"] * 1e10 * HUBBLE ** 2 * (1 + redshift) ** 3)
+
+def test_packed_profiles_of_all_properties(loaded_database):
+    database = loaded_database
+    halos, radii, profiles = get_profiles([], [], [], [], packed=True, physical_units=True, database=database)
+    _, code_radii, code_profiles = get_profiles([], [], [], [], packed=True, database=database)
+    assert profiles.shape == code_profiles.shape and profiles.shape[0] == NUMBER_HALOS
+    assert not np.allclose(radii, code_radii)
+
+    property_keys = list(get_halo_profiles([], [], [], packed=True, database=database)[2])
+    _, _, explicit_profiles = get_profiles([], [], [], property_keys, packed=True, physical_units=True, database=database)
+    np.testing.assert_allclose(profiles, explicit_profiles)
+
+    chunks = list(iter_profiles([], [], [], [], packed=True, physical_units=True, database=database))
+    np.testing.assert_allclose(np.concatenate([chunk[2] for chunk in chunks]), profiles)
+
+def test_replica_and_async_physical_units(loaded_database, tmp_path):
+    database = loaded_database
+    halos = get_halos_based_on_filters([], [], physical_units=True, database=database)
+    _, radii, profiles = get_halo_profiles([], [], ["gas_density"], physical_units=True, database=database)
+    subhalos = get_subhalos([], [], [], [], [], [], columns=["subhaloID", "simulation_unique_id", "snapshot", "SubhaloMass"], physical_units=True, database=database)
+
+    # The replica converts with the exported snapshots table, without the database
+    export_replica(str(tmp_path / "replica"), database=database)
+    replica = ColumnarReplica(str(tmp_path / "replica"))
+    assert replica.get_stored_redshifts() == get_stored_redshifts(database=database)
+    replica_halos = replica.get_halos_based_on_filters([], [], physical_units=True)
+    order = np.argsort(halos["ID"].to_numpy())
+    np.testing.assert_allclose(replica_halos["M_Crit200"], halos["M_Crit200"].to_numpy()[order])
+    _, replica_radii, replica_profiles = replica.get_halo_profiles([], [], ["gas_density"], physical_units=True)
+    np.testing.assert_allclose(replica_radii, radii[order])
+    np.testing.assert_allclose(replica_profiles["gas_density"], profiles["gas_density"][order])
+    replica_subhalos = replica.get_subhalos([], [], [], [], [], [], columns=["subhaloID", "simulation_unique_id", "snapshot", "SubhaloMass"], physical_units=True)
+    np.testing.assert_allclose(np.sort(replica_subhalos["SubhaloMass"]), np.sort(subhalos["SubhaloMass"]))
+
+    async def fetch():
+        async with AsyncQueryPool(database.filename) as pool:
+            return await pool.get_halos_based_on_filters([], [], physical_units=True)
+    async_halos = asyncio.run(fetch())
+    np.testing.assert_allclose(async_halos["M_Crit200"], halos["M_Crit200"])
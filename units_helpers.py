@@ -0,0 +1,182 @@
+# Conversion of the CAMELS code units (ckpc/h, 1e10 Msun/h, ...) of the fetched halos, subhalos and
+# profiles to physical units (kpc, Msun, ...).
+# Each column is converted with one vectorized multiplication by a per-row factor. The factors only depend on
+# the kind of quantity, h and the scale factor of the snapshot, so they are computed (and cached) once per
+# (kind, simulation, snapshot), and mapped to the rows with the (simulation, snapshot) of each row.
+#
+# The fetch functions of filter_data_helpers.py convert their results with physical_units=True, e.g.
+#   get_halo_profiles([("M_Crit200", 30, 200)], [], ["gas_density"], physical_units=True)
+# (filters are still applied in code units).
+#
+# The redshift of each (simulation, snapshot) is stored in the snapshots table of the database, from the header
+# of its group catalog, when its subhalos are loaded (bulk_populate_subhalos.py or populate_subhalos.py).
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from database_helpers import create_table, execute_query
+
+# Hubble parameter of all CAMELS simulations
+HUBBLE = 0.6711
+
+KM_PER_KPC = 3.0857e16
+
+# Redshifts of the snapshots that are not in the snapshots table of the database.
+# Snapshot 33 is z = 0 in all CAMELS suites, so databases with profiles only can be converted at z = 0.
+SNAPSHOT_REDSHIFTS = {33 : 0.0}
+
+SNAPSHOTS_TABLE = "snapshots"
+
+snapshots_columns = {
+    "simulation_unique_id" : "TEXT NOT NULL",
+    "snapshot" : "INTEGER NOT NULL",
+    "redshift" : "REAL NOT NULL", # From the header of the group catalog (illustris_helpers.load_redshift)
+}
+
+# Kind of quantity : (exponent of h, exponent of the scale factor a, constant factor, physical unit)
+# e.g. a length in ckpc/h is multiplied by a / h to get physical kpc
+UNITS = {
+    "length" : (-1, 1, 1.0, "kpc"),
+    "mass" : (-1, 0, 1e10, "Msun"),
+    "density" : (2, -3, 1e10, "Msun kpc^-3"), # (1e10 Msun/h) / (ckpc/h)^3
+    "pressure" : (2, -3, 1e10 / KM_PER_KPC ** 2, "Msun kpc^-1 s^-2"), # (1e10 Msun/h) / (ckpc/h)^3 * (km/s)^2
+}
+
+# Column (or profile property) : kind of quantity. Other columns are already in physical units, or dimensionless.
+COLUMN_UNITS = {
+    ### halos
+    **{c : "mass" for c in ["M_Crit200", "M_Crit500", "M_Mean200", "M_TopHat200", "GroupMass", "GroupBHMass", "GroupWindMass"]},
+    **{c : "length" for c in ["R_Crit200", "R_Crit500", "R_Mean200", "R_TopHat200"]},
+    ### profiles
+    "radius" : "length",
+    "gas_density" : "density",
+    "gas_pressure" : "pressure",
+    ### subhalos
+    **{c : "mass" for c in ["SubhaloMass", "SubhaloBHMass", "SubhaloMassInHalfRad", "SubhaloMassInMaxRad", "SubhaloMassInRad", "SubhaloWindMass", "SubhaloMassType", "SubhaloMassInHalfRadType", "SubhaloMassInMaxRadType", "SubhaloMassInRadType"]},
+    **{c : "length" for c in ["SubhaloPos", "SubhaloCM", "SubhaloHalfmassRad", "SubhaloHalfmassRadType", "SubhaloVmaxRad", "SubhaloStellarPhotometricsRad"]},
+}
+
+def create_snapshots_table(database=None):
+    """ Create the snapshots table, if it does not exist (e.g. in databases created before the table) """
+    create_table(SNAPSHOTS_TABLE, snapshots_columns, primary_key=("simulation_unique_id", "snapshot"), database=database)
+
+def store_snapshot_redshift(simulation_unique_id, snapshot, redshift, database=None):
+    execute_query(f"INSERT OR REPLACE INTO {SNAPSHOTS_TABLE} (simulation_unique_id, snapshot, redshift) VALUES (?, ?, ?)", (simulation_unique_id, int(snapshot), float(redshift)), database=database)
+
+def get_stored_redshifts(database=None):
+    """ {(simulation_unique_id, snapshot) : redshift} of the snapshots table (empty if the database has no snapshots table) """
+    if len(execute_query("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (SNAPSHOTS_TABLE,), database=database)) == 0:
+        return {}
+    data = execute_query(f"SELECT simulation_unique_id, snapshot, redshift FROM {SNAPSHOTS_TABLE}", database=database)
+    return {(row["simulation_unique_id"], row["snapshot"]) : row["redshift"] for row in data}
+
+def set_snapshot_redshifts(snapshot_redshifts):
+    """ Add or replace the redshifts of snapshots that are not in the snapshots table, {snapshot : redshift} """
+    SNAPSHOT_REDSHIFTS.update({int(k) : float(v) for k, v in snapshot_redshifts.items()})
+
+def get_redshift(simulation_unique_id, snapshot, stored_redshifts):
+    """ Redshift of a snapshot, from the stored_redshifts of get_stored_redshifts, or SNAPSHOT_REDSHIFTS """
+    if (simulation_unique_id, int(snapshot)) in stored_redshifts:
+        return stored_redshifts[(simulation_unique_id, int(snapshot))]
+    if int(snapshot) not in SNAPSHOT_REDSHIFTS:
+        raise ValueError(f"Unknown redshift of snapshot {snapshot} of {simulation_unique_id}: load its subhalos (which stores the redshift in the snapshots table), or see set_snapshot_redshifts")
+    return SNAPSHOT_REDSHIFTS[int(snapshot)]
+
+def get_hubble(simulation_unique_id):
+    # All CAMELS simulations have the same h, Omega_m and sigma_8 only vary the matter content
+    return HUBBLE
+
+@lru_cache(maxsize=None)
+def get_conversion_factor(kind, simulation_unique_id, redshift):
+    """ Factor converting a quantity of the given kind from code units to physical units """
+    h_exponent, a_exponent, constant, _ = UNITS[kind]
+    return constant * get_hubble(simulation_unique_id) ** h_exponent * (1 / (1 + redshift)) ** a_exponent
+
+def get_conversion_factors(kinds, simulation_unique_ids, snapshots, database=None, stored_redshifts=None):
+    """ {kind : ndarray of the conversion factors of each row}, computed once per (simulation, snapshot)
+    stored_redshifts: as returned by get_stored_redshifts (default: read from the database)
+    """
+    simulation_codes, unique_simulation_ids = pd.factorize(np.asarray(simulation_unique_ids, dtype=object))
+    snapshot_codes, unique_snapshots = pd.factorize(np.asarray(snapshots))
+    shape = (len(unique_simulation_ids), len(unique_snapshots))
+
+    if stored_redshifts is None:
+        stored_redshifts = get_stored_redshifts(database=database)
+    redshifts = [(s, get_redshift(s, n, stored_redshifts)) for s in unique_simulation_ids for n in unique_snapshots]
+
+    factors = {}
+    for kind in kinds:
+        # (simulations, snapshots) table of factors, indexed with the codes of each row
+        table = np.array([get_conversion_factor(kind, s, z) for s, z in redshifts], dtype=np.float64).reshape(shape)
+        factors[kind] = table[simulation_codes, snapshot_codes]
+    return factors
+
+def _multiply(values, factors):
+    """ values * factors, for numeric columns or columns of arrays (e.g. SubhaloPos), with factors per row """
+    values = np.asarray(values)
+    if values.dtype != object:
+        return values * factors
+    if len(values) == 0:
+        return values
+    # ARRAY columns: a single multiplication of the stacked arrays, split back into one array per row
+    stacked = np.stack([np.asarray(v) for v in values])
+    converted = stacked * factors.reshape((-1,) + (1,) * (stacked.ndim - 1))
+    result = np.empty(len(values), dtype=object)
+    result[:] = list(converted)
+    return result
+
+def to_physical_units(df, database=None, stored_redshifts=None):
+    """ Copy of a DataFrame of halos, subhalos or profiles (with the simulation_unique_id and snapshot columns),
+    with its columns converted to physical units. For rows of the profiles table, property_value is converted
+    according to property_key. The redshifts are read from the snapshots table of the database, unless
+    stored_redshifts is given (e.g. by a columnar replica).
+    """
+    columns = [c for c in df.columns if c in COLUMN_UNITS]
+    convert_profile_values = "property_key" in df.columns and "property_value" in df.columns
+    if len(columns) == 0 and not convert_profile_values:
+        return df
+    if "simulation_unique_id" not in df.columns or "snapshot" not in df.columns:
+        raise ValueError("The simulation_unique_id and snapshot columns are needed to convert to physical units")
+
+    property_keys = [k for k in pd.unique(df["property_key"]) if k in COLUMN_UNITS] if convert_profile_values else []
+    factors = get_conversion_factors({COLUMN_UNITS[c] for c in columns + property_keys}, df["simulation_unique_id"].to_numpy(), df["snapshot"].to_numpy(), database=database, stored_redshifts=stored_redshifts)
+
+    # Shallow copy, so that cached results are not modified
+    df = df.copy(deep=False)
+    for c in columns:
+        df[c] = _multiply(df[c].to_numpy(), factors[COLUMN_UNITS[c]])
+
+    if convert_profile_values:
+        row_property_keys = df["property_key"].to_numpy()
+        row_factors = np.ones(len(df))
+        for property_key in property_keys:
+            mask = row_property_keys == property_key
+            row_factors[mask] = factors[COLUMN_UNITS[property_key]][mask]
+        df["property_value"] = df["property_value"].to_numpy() * row_factors
+
+    return df
+
+def profiles_to_physical_units(halos, radii, profiles, list_of_properties=None, database=None, stored_redshifts=None):
+    """ Convert the (halos, radii, profiles) results of get_halo_profiles or get_profiles(..., packed=True)
+    profiles: dict {property : (halos, radial bins)}, or ndarray (halos, properties, radial bins) with the properties in list_of_properties
+    """
+    if not isinstance(profiles, dict) and not list_of_properties:
+        raise ValueError("list_of_properties is needed to convert profiles given as an ndarray")
+    if len(halos) == 0:
+        return to_physical_units(halos, database=database, stored_redshifts=stored_redshifts), radii, profiles
+    property_keys = list(profiles.keys()) if isinstance(profiles, dict) else list(list_of_properties)
+    factors = get_conversion_factors({"length"} | {COLUMN_UNITS[k] for k in property_keys if k in COLUMN_UNITS}, halos["simulation_unique_id"].to_numpy(), halos["snapshot"].to_numpy(), database=database, stored_redshifts=stored_redshifts)
+
+    radii = radii * factors["length"][:, None]
+    property_factors = np.ones((len(halos), len(property_keys)))
+    for i, k in enumerate(property_keys):
+        if k in COLUMN_UNITS:
+            property_factors[:, i] = factors[COLUMN_UNITS[k]]
+
+    if isinstance(profiles, dict):
+        profiles = {k : v * property_factors[:, i, None] for i, (k, v) in enumerate(profiles.items())}
+    else:
+        profiles = profiles * property_factors[:, :, None]
+
+    return to_physical_units(halos, database=database, stored_redshifts=stored_redshifts), radii, profiles